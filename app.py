@@ -3,14 +3,35 @@ import json
 import time
 import re
 import hashlib
+import functools
+import heapq
+import math
+import zlib
+import gzip
 import sqlite3
+import shutil
 from datetime import datetime
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    import httpx  # приходит с python-telegram-bot; нужен только в RUNTIME=async
+except ImportError:
+    httpx = None
 import logging
 from typing import Dict, List, Set, Optional, Tuple
+import sys
 import threading
-from dataclasses import dataclass, asdict
+import queue
+import atexit
+import multiprocessing
+import asyncio
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, asdict, field
 from enum import Enum
 
 # ========== КОНФИГУРАЦИЯ ==========
@@ -18,6 +39,115 @@ TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 ALLOWED_IDS = [int(x.strip()) for x in os.environ.get("ALLOWED_IDS", "").split(",") if x.strip()]
 PORT = int(os.environ.get("PORT", 10000))
 
+# Шардирование по процессам: обновления чата всегда идут в один процесс
+SHARDS = int(os.environ.get("SHARDS", 1))
+SHARD_QUEUE_SIZE = int(os.environ.get("SHARD_QUEUE_SIZE", 10000))
+# Номер шарда выставляет главный процесс при запуске дочернего
+SHARD_INDEX = os.environ.get("TGMON_SHARD_INDEX")
+
+# Адрес Bot API (свой сервер или fake_bot_api.py для тестов)
+TELEGRAM_API_BASE = os.environ.get("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+
+# Источник обновлений: webhook или polling (getUpdates)
+INGEST_MODE = os.environ.get("INGEST_MODE", "webhook")
+POLL_LIMIT = int(os.environ.get("POLL_LIMIT", 100))
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", 30))
+
+# Исполнение исходящих запросов: "threads" - блокирующие requests в пулах потоков,
+# "async" - один цикл asyncio с пулом keep-alive соединений httpx
+RUNTIME = os.environ.get("RUNTIME", "threads")
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", 100))
+ASYNC_MAX_INFLIGHT = int(os.environ.get("ASYNC_MAX_INFLIGHT", 1000))
+
+# База данных
+DB_PATH = os.environ.get("DB_PATH", "telegram_monitor.db")
+SQLITE_CACHE_MB = int(os.environ.get("SQLITE_CACHE_MB", 64))
+SQLITE_MMAP_MB = int(os.environ.get("SQLITE_MMAP_MB", 256))
+
+# Хранилище событий: "sqlite" - таблица events, "eventlog" - журнал сегментов
+# (чаты, пользователи и счётчики в обоих случаях остаются в SQLite)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")
+EVENT_LOG_DIR = os.environ.get("EVENT_LOG_DIR", "event_log")
+EVENT_LOG_SEGMENT_MB = int(os.environ.get("EVENT_LOG_SEGMENT_MB", 64))
+
+# Обслуживание хранилища: свёртка и вынос старых событий, справочник строк, VACUUM
+RETENTION_DAYS = float(os.environ.get("RETENTION_DAYS", 90))  # 0 - сырые события не выносятся
+RETENTION_ARCHIVE_DIR = os.environ.get("RETENTION_ARCHIVE_DIR", "")  # пусто - вынесенные строки SQLite удаляются
+ROLLUP_HOURLY_DAYS = float(os.environ.get("ROLLUP_HOURLY_DAYS", 365))
+COMPACT_AFTER_HOURS = float(os.environ.get("COMPACT_AFTER_HOURS", 24))
+MAINTENANCE_INTERVAL = float(os.environ.get("MAINTENANCE_INTERVAL", 3600))  # 0 - выключено
+MAINTENANCE_BATCH = int(os.environ.get("MAINTENANCE_BATCH", 2000))
+MAINTENANCE_PAUSE_MS = int(os.environ.get("MAINTENANCE_PAUSE_MS", 50))
+
+# Очередь входящих обновлений
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 4))
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", 10000))
+INGEST_DEDUPE_WINDOW = int(os.environ.get("INGEST_DEDUPE_WINDOW", 50000))
+# Сколько накопившихся обновлений обработчик забирает за раз (process_updates)
+INGEST_BATCH = int(os.environ.get("INGEST_BATCH", 100))
+
+# Запись в базу: "batched" - пачками в фоне, "sync" - события пишутся сразу
+PERSIST_MODE = os.environ.get("PERSIST_MODE", "batched")
+PERSIST_BATCH_SIZE = int(os.environ.get("PERSIST_BATCH_SIZE", 500))
+PERSIST_FLUSH_MS = int(os.environ.get("PERSIST_FLUSH_MS", 200))
+
+# Справочник пользователей и чатов: в памяти только горячие записи
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 100000))
+CHAT_CACHE_SIZE = int(os.environ.get("CHAT_CACHE_SIZE", 20000))
+DIRECTORY_TOTALS_TTL = float(os.environ.get("DIRECTORY_TOTALS_TTL", 60))
+
+# Доверие: штрафы за события затухают, топ самых рискованных - в памяти
+TRUST_HALF_LIFE_HOURS = float(os.environ.get("TRUST_HALF_LIFE_HOURS", 168))
+TRUST_TOP_K = int(os.environ.get("TRUST_TOP_K", 100))
+
+# Кэш сообщений для поиска копирования
+MESSAGE_CACHE_SIZE = int(os.environ.get("MESSAGE_CACHE_SIZE", 50000))
+MESSAGE_CACHE_PER_CHAT = int(os.environ.get("MESSAGE_CACHE_PER_CHAT", 5000))
+MESSAGE_CACHE_TTL = int(os.environ.get("MESSAGE_CACHE_TTL", 24 * 3600))
+MESSAGE_CACHE_MB = int(os.environ.get("MESSAGE_CACHE_MB", 64))
+
+# Отпечатки текстов наших чатов для поиска копий
+FINGERPRINT_MAX_DOCS = int(os.environ.get("FINGERPRINT_MAX_DOCS", 100000))
+FINGERPRINT_THRESHOLD = float(os.environ.get("FINGERPRINT_THRESHOLD", 0.7))
+FINGERPRINT_MIN_LENGTH = int(os.environ.get("FINGERPRINT_MIN_LENGTH", 40))
+
+# Рассылка оповещений (лимиты Telegram: ~30 сообщений/с всего, ~1/с в чат)
+NOTIFY_WORKERS = int(os.environ.get("NOTIFY_WORKERS", 8))
+NOTIFY_GLOBAL_RATE = float(os.environ.get("NOTIFY_GLOBAL_RATE", 30))
+NOTIFY_CHAT_RATE = float(os.environ.get("NOTIFY_CHAT_RATE", 1))
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get("NOTIFY_MAX_ATTEMPTS", 10))
+
+# Группировка оповещений: первое сразу, остальные за окно - одной сводкой
+ALERT_WINDOW_SECONDS = float(os.environ.get("ALERT_WINDOW_SECONDS", 60))
+ALERT_DIGEST_SAMPLES = int(os.environ.get("ALERT_DIGEST_SAMPLES", 5))
+
+# Кэш статуса бота в чатах (getChatMember)
+ADMIN_STATUS_TTL = float(os.environ.get("ADMIN_STATUS_TTL", 3600))
+ADMIN_NEGATIVE_TTL = float(os.environ.get("ADMIN_NEGATIVE_TTL", 300))
+
+# Агрегаты событий для /api/stats
+METRICS_BUCKET_SECONDS = int(os.environ.get("METRICS_BUCKET_SECONDS", 300))
+METRICS_HISTORY_HOURS = int(os.environ.get("METRICS_HISTORY_HOURS", 24))
+METRICS_TOP_CHATS = int(os.environ.get("METRICS_TOP_CHATS", 10))
+
+# История событий (/api/dashboard)
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", 50))
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get("HISTORY_MAX_PAGE_SIZE", 500))
+
+# Живой поток событий для дашборда (SSE / long-poll)
+STREAM_BUFFER = int(os.environ.get("STREAM_BUFFER", 256))
+STREAM_HISTORY = int(os.environ.get("STREAM_HISTORY", 1000))
+STREAM_MAX_SUBSCRIBERS = int(os.environ.get("STREAM_MAX_SUBSCRIBERS", 200))
+STREAM_HEARTBEAT_SECONDS = float(os.environ.get("STREAM_HEARTBEAT_SECONDS", 15))
+STREAM_POLL_TIMEOUT = float(os.environ.get("STREAM_POLL_TIMEOUT", 25))
+
+# Метрики процесса (/metrics)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+
+# Шаблоны детекторов (JSON), перечитываются при изменении файла
+PATTERNS_FILE = os.environ.get("PATTERNS_FILE")
+PATTERNS_RELOAD_SECONDS = float(os.environ.get("PATTERNS_RELOAD_SECONDS", 5))
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -38,18 +168,40 @@ class Severity(Enum):
     HIGH = "ВЫСОКИЙ"
     CRITICAL = "КРИТИЧЕСКИЙ"
 
+SEVERITY_ORDER = [Severity.LOW, Severity.MEDIUM, Severity.HIGH, Severity.CRITICAL]
+
+# Статусы бота в чате
+ADMIN_STATUSES = ("administrator", "creator")
+GONE_STATUSES = ("left", "kicked")
+
 # ========== МОДЕЛИ ==========
-@dataclass
+# Записи справочника (ChatData, UserData) держатся в памяти сотнями тысяч:
+# без __dict__, строки интернированы, время - целые секунды эпохи
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if value else value
+
+def _epoch(value) -> int:
+    """Время из базы (ISO-строка) -> секунды эпохи"""
+    if not value:
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        return 0
+
+@dataclass(slots=True)
 class ChatData:
     chat_id: int
     title: str
     username: Optional[str]
     type: str
     is_our_chat: bool = False
-    added_at: str = None
+    added_at: int = 0
     message_count: int = 0
 
-@dataclass
+@dataclass(slots=True)
 class UserData:
     user_id: int
     username: str
@@ -58,7 +210,15 @@ class UserData:
     screenshot_count: int = 0
     forward_count: int = 0
     copy_count: int = 0
-    last_seen: str = None
+    last_seen: int = 0
+    risk_key: Optional[float] = None
+
+@dataclass
+class SendResult:
+    ok: bool
+    retry_after: Optional[float] = None
+    retryable: bool = False
+    error: Optional[str] = None
 
 @dataclass
 class AlertData:
@@ -76,159 +236,4001 @@ class AlertData:
     source_chat_id: Optional[int] = None
     source_chat_title: Optional[str] = None
 
+@dataclass
+class AlertGroup:
+    group_id: str
+    first: AlertData
+    window_end: float
+    total: int = 1
+    suppressed: int = 0
+    severity: Severity = Severity.LOW
+    samples: List[AlertData] = field(default_factory=list)
+
+# ========== МЕТРИКИ ПРОЦЕССА ==========
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин"""
+    
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+def _label_value(value) -> str:
+    """Экранирование значения метки"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    """{name="value",...} для текстового формата Prometheus"""
+    pairs = [f'{name}="{_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class MetricsRegistry:
+    """Счётчики и гистограммы в памяти, текстовый формат Prometheus.
+    
+    Запись - O(1) на событие; текст собирается только при запросе
+    /metrics. Значения из stats() компонентов отдаются как gauge
+    через коллекторы, которые тоже вызываются только при запросе.
+    """
+    
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        # имя -> (тип, описание, имена меток)
+        self._meta: Dict[str, Tuple[str, str, Tuple[str, ...]]] = {}
+        self._histograms: Dict[str, Dict[Tuple, Histogram]] = {}
+        self._counters: Dict[str, Counter] = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+    
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self._meta[name] = ("histogram", help_text, labels)
+        self._histograms[name] = {}
+    
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self._meta[name] = ("counter", help_text, labels)
+        self._counters[name] = Counter()
+    
+    def series(self, name: str, labels: Tuple = ()) -> Histogram:
+        """Гистограмма с заданными метками"""
+        series = self._histograms[name]
+        histogram = series.get(labels)
+        if histogram is None:
+            with self._lock:
+                histogram = series.setdefault(labels, Histogram())
+        return histogram
+    
+    def observe(self, name: str, labels: Tuple, value: float):
+        """Записать значение в гистограмму"""
+        self.series(name, labels).observe(value)
+    
+    def inc(self, name: str, labels: Tuple = (), amount: float = 1):
+        """Увеличить счётчик"""
+        with self._lock:
+            self._counters[name][labels] += amount
+    
+    def timed(self, stage: str):
+        """Декоратор: время вызова в tgmon_stage_seconds{stage=...}"""
+        def decorator(func):
+            if not self.enabled:
+                return func
+            
+            observe = self.series("tgmon_stage_seconds", (stage,)).observe
+            clock = time.perf_counter
+            
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = clock()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    observe(clock() - started)
+            return wrapper
+        return decorator
+    
+    def add_collector(self, collector):
+        """Функция -> список (имя, описание, {метка: значение}, число) для gauge"""
+        self._collectors.append(collector)
+    
+    def render(self) -> str:
+        """Текстовый формат Prometheus"""
+        lines = []
+        for name, (kind, help_text, label_names) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                with self._lock:
+                    items = list(self._counters[name].items())
+                for labels, value in items:
+                    lines.append(f"{name}{_format_labels(label_names, labels)} {value}")
+                continue
+            
+            for labels, histogram in list(self._histograms[name].items()):
+                with histogram._lock:
+                    counts, total, count = list(histogram.counts), histogram.sum, histogram.count
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    le = 'le="+Inf"' if bound == float("inf") else f'le="{bound!r}"'
+                    lines.append(f"{name}_bucket{_format_labels(label_names, labels, le)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(label_names, labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(label_names, labels)} {count}")
+        
+        # Текущие значения компонентов
+        gauges: Dict[str, Tuple[str, List[Tuple[Dict, float]]]] = {}
+        for collector in self._collectors:
+            for name, help_text, labels, value in collector():
+                gauges.setdefault(name, (help_text, []))[1].append((labels, value))
+        for name, (help_text, samples) in gauges.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}")
+        
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry(enabled=METRICS_ENABLED)
+METRICS.histogram("tgmon_stage_seconds", "Время этапов обработки", ("stage",))
+METRICS.histogram("tgmon_sqlite_commit_seconds", "Время транзакции пакетной записи")
+METRICS.counter("tgmon_alerts_total", "Оповещения по типу и важности", ("type", "severity"))
+METRICS.counter("tgmon_telegram_requests_total", "Запросы к Bot API по методу и исходу", ("method", "result"))
+
+# ========== ФОРМАТИРОВАНИЕ ОПОВЕЩЕНИЙ ==========
+ALERT_EMOJI = {
+    AlertType.SCREENSHOT: "📸",
+    AlertType.FORWARD_OUT: "🚨",
+    AlertType.FORWARD_IN: "📨",
+    AlertType.COPY: "📋",
+    AlertType.COPY_DETECTED: "📝"
+}
+
+FORWARD_FOOTERS = {
+    AlertType.FORWARD_OUT: "<b>⚠️ УТЕЧКА ИЗ ЗАЩИЩЕННОГО ЧАТА!</b>",
+    AlertType.FORWARD_IN: "<b>📥 ВХОДЯЩЕЕ СООБЩЕНИЕ</b>"
+}
+
+ALERT_TEMPLATE = """{emoji} <b>СИСТЕМА ОБНАРУЖЕНИЯ</b>
+<b>Тип:</b> {type}
+<b>Серьёзность:</b> {{severity}}
+<b>Уверенность:</b> {{confidence}}%
+
+<b>👤 ПОЛЬЗОВАТЕЛЬ</b>
+├ <b>Username:</b> @{{username}}
+├ <b>User ID:</b> <code>{{user_id}}</code>
+
+<b>💬 КОНТЕКСТ</b>
+├ <b>Чат:</b> {{chat_title}}
+├ <b>Chat ID:</b> <code>{{chat_id}}</code>
+├ <b>Message ID:</b> <code>{{message_id}}</code>
+├ <b>Время:</b> {{timestamp}}
+
+<b>📊 ДЕТАЛИ</b>
+{{details}}
+"""
+
+FORWARD_TEMPLATE = """
+<b>📍 НАПРАВЛЕНИЕ ПЕРЕСЫЛКИ</b>
+├ <b>Из чата:</b> {{source_chat_title}}
+├ <b>В чат:</b> {{chat_title}}
+└ {footer}
+"""
+
+DIGEST_TEMPLATE = """📦 <b>СВОДКА ОПОВЕЩЕНИЙ</b>
+<b>Тип:</b> {type}
+<b>Макс. серьёзность:</b> {severity}
+<b>Всего за {window:.0f} с:</b> {total} (после первого: {suppressed})
+
+<b>👤 ПОЛЬЗОВАТЕЛЬ</b>
+├ <b>Username:</b> @{username}
+├ <b>User ID:</b> <code>{user_id}</code>
+
+<b>💬 КОНТЕКСТ</b>
+├ <b>Чат:</b> {chat_title}
+├ <b>Из чата:</b> {source_chat_title}
+
+<b>🧾 ПОСЛЕДНИЕ СОБЫТИЯ</b>
+{samples}
+
+<code>Группа: {group_id}</code>"""
+
+def _html(value) -> str:
+    """Текст из сообщений и названий чатов - только как текст, не как разметка"""
+    if value.__class__ is not str:
+        value = str(value)
+    # html.escape(quote=False) без лишнего вызова - на горячем пути рассылки
+    if "&" in value:
+        value = value.replace("&", "&amp;")
+    if "<" in value:
+        value = value.replace("<", "&lt;")
+    if ">" in value:
+        value = value.replace(">", "&gt;")
+    return value
+
+class AlertRenderer:
+    """HTML оповещений по заранее собранным шаблонам.
+    
+    Шаблон на каждый AlertType (и вариант с направлением пересылки)
+    собирается один раз, подписи деталей кэшируются по ключу. Всё, что
+    пришло от пользователей (username, названия чатов, значения деталей),
+    экранируется. Текст рендерится один раз и уходит всем админам.
+    """
+    
+    def __init__(self):
+        self._templates: Dict[Tuple[AlertType, bool], str] = {}
+        for alert_type in AlertType:
+            base = ALERT_TEMPLATE.format(emoji=ALERT_EMOJI.get(alert_type, "🔔"), type=alert_type.value)
+            self._templates[(alert_type, False)] = base + "\n<code>ID: {alert_id}</code>"
+            footer = FORWARD_FOOTERS.get(alert_type)
+            if footer:
+                self._templates[(alert_type, True)] = (
+                    base + FORWARD_TEMPLATE.format(footer=footer) + "\n<code>ID: {alert_id}</code>"
+                )
+        # Ключи деталей задаёт код детекторов - набор конечный
+        self._labels: Dict[str, str] = {}
+    
+    def _label(self, key: str) -> str:
+        label = self._labels.get(key)
+        if label is None:
+            label = self._labels[key] = f"<b>├ {_html(key.replace('_', ' ').title())}:</b> "
+        return label
+    
+    @staticmethod
+    def _value(value) -> str:
+        if value.__class__ is str:
+            return _html(value)
+        if isinstance(value, bool):
+            return "✅ Да" if value else "❌ Нет"
+        if isinstance(value, list):
+            shown = ", ".join(str(v) for v in value[:3])
+            if len(value) > 3:
+                shown += f" ... (+{len(value) - 3})"
+            return _html(shown)
+        if value is None:
+            return "—"
+        return _html(value)
+    
+    def render(self, alert: AlertData) -> str:
+        """Сообщение оповещения"""
+        labels = self._labels
+        parts = []
+        for key, value in alert.details.items():
+            if key.startswith("_"):  # Скрытые поля
+                continue
+            parts.append(labels.get(key) or self._label(key))
+            parts.append(self._value(value))
+            parts.append("\n")
+        details = "".join(parts)
+        
+        template = self._templates.get((alert.type, bool(alert.source_chat_title)))
+        if template is None:
+            template = self._templates[(alert.type, False)]
+        
+        return template.format(
+            severity=alert.severity.value,
+            confidence=alert.confidence,
+            username=_html(alert.username),
+            user_id=alert.user_id,
+            chat_title=_html(alert.chat_title),
+            chat_id=alert.chat_id,
+            message_id=alert.message_id,
+            timestamp=alert.timestamp,
+            details=details,
+            source_chat_title=_html(alert.source_chat_title),
+            alert_id=alert.alert_id
+        )
+    
+    def render_digest(self, group: AlertGroup, window: float) -> str:
+        """Сводка по группе оповещений"""
+        alert = group.first
+        samples = "\n".join(
+            f"├ {sample.timestamp} · <code>{sample.message_id}</code> · "
+            f"{_html(sample.details.get('message_preview') or sample.details.get('reply_text_preview') or sample.details.get('notification_text') or '—')}"
+            for sample in group.samples
+        )
+        
+        return DIGEST_TEMPLATE.format(
+            type=alert.type.value,
+            severity=group.severity.value,
+            window=window,
+            total=group.total,
+            suppressed=group.suppressed,
+            username=_html(alert.username),
+            user_id=alert.user_id,
+            chat_title=_html(alert.chat_title),
+            source_chat_title=_html(alert.source_chat_title or '—'),
+            samples=samples,
+            group_id=group.group_id
+        )
+
 # ========== ИСПРАВЛЕННЫЙ ТЕЛЕГРАМ API ==========
+# Разбор ответов общий для EnhancedTelegramAPI и AsyncTelegramAPI
+ALLOWED_UPDATES = ["message", "edited_message", "channel_post", "edited_channel_post", "my_chat_member"]
+
+def _message_payload(chat_id: int, text: str) -> Dict:
+    return {
+        "chat_id": chat_id,
+        "text": text,
+        "parse_mode": "HTML",
+        "disable_web_page_preview": True,
+        "disable_notification": False
+    }
+
+def _webhook_payload(url: str) -> Dict:
+    return {"url": url, "max_connections": 100, "allowed_updates": ALLOWED_UPDATES}
+
+def _send_result(status_code: int, result: Dict) -> SendResult:
+    """Ответ sendMessage -> SendResult"""
+    if result.get("ok"):
+        METRICS.inc("tgmon_telegram_requests_total", ("sendMessage", "ok"))
+        return SendResult(ok=True)
+    
+    # 429: Telegram сообщает, сколько подождать
+    retry_after = (result.get("parameters") or {}).get("retry_after")
+    METRICS.inc("tgmon_telegram_requests_total", (
+        "sendMessage", "rate_limited" if status_code == 429 else f"http_{status_code}"
+    ))
+    return SendResult(
+        ok=False,
+        retry_after=float(retry_after) if retry_after is not None else None,
+        retryable=retry_after is not None or status_code >= 500,
+        error=result.get("description", f"HTTP {status_code}")
+    )
+
+def _member_status(status_code: int, result: Dict) -> Optional[str]:
+    """Ответ getChatMember -> статус (None - Telegram не ответил)"""
+    if not result.get("ok"):
+        # Бота нет в чате - это тоже ответ
+        if status_code in (400, 403):
+            return "left"
+        return None
+    return result["result"].get("status", "")
+
 class EnhancedTelegramAPI:
-    def __init__(self, token):
+    def __init__(self, token, api_base: str = TELEGRAM_API_BASE):
         self.token = token
-        self.base_url = f"https://api.telegram.org/bot{token}"
+        self.base_url = f"{api_base}/bot{token}"
+        self.bot_id = int(token.split(':')[0]) if token and ':' in token else None  # ID бота из токена
+        
+        # Пул keep-alive соединений на все потоки рассылки
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, NOTIFY_WORKERS * 2))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.renderer = AlertRenderer()
     
-    def send_alert(self, chat_id: int, alert: AlertData) -> bool:
-        """Отправить детальное оповещение"""
+    @METRICS.timed("send_message")
+    def send_message(self, chat_id: int, text: str) -> SendResult:
+        """Отправить HTML-сообщение и разобрать ответ Telegram"""
         try:
-            message = self._format_alert_message(alert)
-            
-            data = {
-                "chat_id": chat_id,
-                "text": message,
-                "parse_mode": "HTML",
-                "disable_web_page_preview": True,
-                "disable_notification": False
-            }
-            
-            response = self.session.post(f"{self.base_url}/sendMessage", json=data, timeout=10)
+            response = self.session.post(f"{self.base_url}/sendMessage", json=_message_payload(chat_id, text), timeout=10)
             result = response.json()
-            
-            return result.get("ok", False)
-        except Exception as e:
-            logger.error(f"Send alert error: {e}")
+        except (requests.RequestException, ValueError) as e:
+            METRICS.inc("tgmon_telegram_requests_total", ("sendMessage", "network_error"))
+            return SendResult(ok=False, retryable=True, error=str(e))
+        return _send_result(response.status_code, result)
+    
+    def get_chat_member_status(self, chat_id: int, user_id: int) -> Optional[str]:
+        """Статус участника чата или None, если Telegram не ответил"""
+        try:
+            response = self.session.post(
+                f"{self.base_url}/getChatMember",
+                json={"chat_id": chat_id, "user_id": user_id},
+                timeout=5
+            )
+            result = response.json()
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"Get chat member error: {e}")
+            return None
+        return _member_status(response.status_code, result)
+    
+    def get_updates(self, offset: Optional[int], limit: int = 100, timeout: int = 30) -> Optional[List[Dict]]:
+        """Long-poll getUpdates. None - запрос не удался"""
+        data = {
+            "limit": limit,
+            "timeout": timeout,
+            "allowed_updates": ALLOWED_UPDATES
+        }
+        if offset is not None:
+            data["offset"] = offset
+        
+        try:
+            response = self.session.post(f"{self.base_url}/getUpdates", json=data, timeout=timeout + 10)
+            result = response.json()
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"Get updates error: {e}")
+            return None
+        
+        if not result.get("ok"):
+            logger.error(f"Get updates failed: {result.get('description')}")
+            return None
+        return result["result"]
+    
+    def delete_webhook(self) -> bool:
+        """Снять вебхук: иначе getUpdates отвечает 409"""
+        try:
+            response = self.session.post(f"{self.base_url}/deleteWebhook", json={}, timeout=10)
+            return bool(response.json().get("ok"))
+        except (requests.RequestException, ValueError) as e:
+            logger.error(f"Delete webhook error: {e}")
             return False
     
+    def get_me(self) -> Dict:
+        try:
+            return self.session.post(f"{self.base_url}/getMe", json={}, timeout=10).json()
+        except (requests.RequestException, ValueError) as e:
+            return {"ok": False, "description": str(e)}
+    
+    def set_webhook(self, url: str) -> Dict:
+        try:
+            return self.session.post(f"{self.base_url}/setWebhook", json=_webhook_payload(url), timeout=10).json()
+        except (requests.RequestException, ValueError) as e:
+            return {"ok": False, "description": str(e)}
+    
+    @METRICS.timed("send_alert")
+    def send_alert(self, chat_id: int, alert: AlertData) -> bool:
+        """Отправить детальное оповещение"""
+        result = self.send_message(chat_id, self._format_alert_message(alert))
+        if not result.ok:
+            logger.error(f"Send alert error: {result.error}")
+        return result.ok
+    
     def _format_alert_message(self, alert: AlertData) -> str:
         """Форматировать сообщение оповещения"""
+        return self.renderer.render(alert)
+    
+    def _format_digest_message(self, group: AlertGroup, window: float) -> str:
+        """Форматировать сводку по группе оповещений"""
+        return self.renderer.render_digest(group, window)
+
+# ========== АСИНХРОННЫЙ РЕЖИМ ==========
+class AsyncTelegramAPI:
+    """Клиент Bot API на httpx.AsyncClient.
+    
+    Один пул keep-alive соединений на цикл событий: тысячи запросов в
+    полёте ждут ответа в одном потоке, а не в потоке на запрос. Ответы
+    разбираются теми же функциями, что и в EnhancedTelegramAPI.
+    """
+    
+    def __init__(self, token, api_base: str = TELEGRAM_API_BASE, max_connections: int = 100):
+        if httpx is None:
+            raise RuntimeError("RUNTIME=async requires httpx")
+        
+        self.token = token
+        self.bot_id = int(token.split(':')[0]) if token and ':' in token else None
+        # Ожидание свободного соединения не ограничено: очередь держат семафоры вызывающих
+        self.client = httpx.AsyncClient(
+            base_url=f"{api_base}/bot{token}",
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(10.0, pool=None)
+        )
+    
+    async def _post(self, method: str, data: Dict, timeout: float = 10.0) -> Tuple[int, Dict]:
+        response = await self.client.post(f"/{method}", json=data, timeout=httpx.Timeout(timeout, pool=None))
+        return response.status_code, response.json()
+    
+    async def send_message(self, chat_id: int, text: str) -> SendResult:
+        """Отправить HTML-сообщение и разобрать ответ Telegram"""
+        started = time.perf_counter()
+        try:
+            status_code, result = await self._post("sendMessage", _message_payload(chat_id, text))
+        except (httpx.HTTPError, ValueError) as e:
+            METRICS.inc("tgmon_telegram_requests_total", ("sendMessage", "network_error"))
+            return SendResult(ok=False, retryable=True, error=str(e) or type(e).__name__)
+        finally:
+            METRICS.observe("tgmon_stage_seconds", ("send_message",), time.perf_counter() - started)
+        return _send_result(status_code, result)
+    
+    async def get_chat_member_status(self, chat_id: int, user_id: int) -> Optional[str]:
+        """Статус участника чата или None, если Telegram не ответил"""
+        try:
+            status_code, result = await self._post("getChatMember", {"chat_id": chat_id, "user_id": user_id}, timeout=5)
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error(f"Get chat member error: {e}")
+            return None
+        return _member_status(status_code, result)
+    
+    async def get_me(self) -> Dict:
+        try:
+            return (await self._post("getMe", {}))[1]
+        except (httpx.HTTPError, ValueError) as e:
+            return {"ok": False, "description": str(e)}
+    
+    async def set_webhook(self, url: str) -> Dict:
+        try:
+            return (await self._post("setWebhook", _webhook_payload(url)))[1]
+        except (httpx.HTTPError, ValueError) as e:
+            return {"ok": False, "description": str(e)}
+    
+    async def aclose(self):
+        await self.client.aclose()
+
+class AsyncRuntime:
+    """Цикл asyncio в отдельном потоке для исходящих запросов.
+    
+    Потоки обработки не ждут сеть: submit() ставит корутину в цикл и
+    сразу возвращает concurrent.futures.Future. Блокирующая работа с
+    базой из корутин уходит в пул цикла (asyncio.to_thread).
+    """
+    
+    def __init__(self, token, api_base: str = TELEGRAM_API_BASE, max_connections: int = 100):
+        self.loop = asyncio.new_event_loop()
+        self.api = AsyncTelegramAPI(token, api_base, max_connections=max_connections)
+        self.inflight = 0
+        self.submitted = 0
         
-        # Эмодзи и цвета по типу
-        type_config = {
-            AlertType.SCREENSHOT: ("📸", "#FF5252"),
-            AlertType.FORWARD_OUT: ("🚨", "#FF4081"),
-            AlertType.FORWARD_IN: ("📨", "#2196F3"),
-            AlertType.COPY: ("📋", "#FF9800"),
-            AlertType.COPY_DETECTED: ("📝", "#FF9800")
+        self._thread = threading.Thread(target=self._run, name="async-runtime", daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+    
+    async def _tracked(self, coro):
+        self.inflight += 1
+        try:
+            return await coro
+        finally:
+            self.inflight -= 1
+    
+    def submit(self, coro) -> Future:
+        """Запустить корутину в цикле (из любого потока)"""
+        self.submitted += 1
+        return asyncio.run_coroutine_threadsafe(self._tracked(coro), self.loop)
+    
+    def run(self, coro, timeout: float = 30.0):
+        """Выполнить корутину и дождаться результата (не из самого цикла)"""
+        return self.submit(coro).result(timeout)
+    
+    def stats(self) -> Dict:
+        return {
+            "inflight": self.inflight,
+            "submitted": self.submitted,
+            "tasks": len(asyncio.all_tasks(self.loop)) if self.loop.is_running() else 0
         }
+    
+    def close(self, timeout: float = 5.0):
+        """Закрыть клиент и остановить цикл; незавершённые задачи отменяются"""
+        if not self.loop.is_running():
+            return
+        try:
+            self.run(self.api.aclose(), timeout)
+        except Exception as e:
+            logger.error(f"Async runtime close error: {e}")
         
-        emoji, color = type_config.get(alert.type, ("🔔", "#2196F3"))
+        async def _cancel_all():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
         
-        # Форматируем детали
-        details_html = ""
-        for key, value in alert.details.items():
-            if key.startswith("_"):  # Скрытые поля
+        try:
+            asyncio.run_coroutine_threadsafe(_cancel_all(), self.loop).result(timeout)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+# ========== ДЕТЕКТОР ШАБЛОНОВ ==========
+# (шаблон, номер группы с username)
+DEFAULT_SCREENSHOT_PATTERNS = [
+    # Русские шаблоны
+    (r'Пользователь\s+(@?\w+)\s+сделал\s+снимок\s+экрана', 1),
+    (r'(@?\w+)\s+сделал\s+скриншот', 1),
+    (r'(@?\w+)\s+заскринил', 1),
+    (r'Обнаружен\s+снимок\s+экрана\s+от\s+(@?\w+)', 1),
+    (r'(@?\w+)\s+снял\s+скрин', 1),
+    
+    # Английские шаблоны
+    (r'User\s+(@?\w+)\s+made\s+a\s+screenshot', 1),
+    (r'(@?\w+)\s+made\s+a\s+screenshot', 1),
+    (r'(@?\w+)\s+took\s+a\s+screenshot', 1),
+    (r'Screenshot\s+detected\s+from\s+(@?\w+)', 1),
+    (r'(@?\w+)\s+screenshotted', 1),
+    
+    # Украинские шаблоны
+    (r'Користувач\s+(@?\w+)\s+зробив\s+знімок\s+екрану', 1),
+    (r'(@?\w+)\s+зробив\s+скріншот', 1),
+]
+
+DEFAULT_COPY_PATTERNS = [
+    (r'скопировал', 0),
+    (r'copy', 0),
+    (r'copied', 0),
+    (r'сохранил', 0),
+    (r'saved', 0),
+    (r'взял текст', 0),
+    (r'text copied', 0),
+]
+
+@dataclass
+class PatternMatch:
+    family: str
+    pattern: str
+    group: int
+    match: re.Match
+
+def _required_literal(pattern: str) -> Optional[str]:
+    """Самое длинное слово, без которого шаблон не может совпасть.
+    
+    Для шаблонов с альтернативами, классами символов и счётчиками {m,n}
+    слово не ищется, такие шаблоны всегда проверяются регулярным
+    выражением. Содержимое необязательных групп ((...)?, (...)*,
+    (...)+?) и проверок (?=...), (?!...) в слова не попадает.
+    """
+    if re.search(r'(?<!\\)[|\[{]', pattern):
+        return None
+    
+    # Стек групп: [текст группы, группа не нужна для совпадения]
+    stack = [[[], False]]
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            stack[-1][0].append(" ")
+            i += 2
+            continue
+        
+        if char == "(":
+            drop = False
+            i += 1
+            if pattern.startswith("?", i):
+                if pattern.startswith("?:", i):
+                    i += 2
+                elif pattern.startswith("?P<", i):
+                    i = pattern.index(">", i) + 1
+                elif pattern.startswith(("?=", "?!"), i):
+                    drop, i = True, i + 2
+                elif pattern.startswith(("?<=", "?<!"), i):
+                    drop, i = True, i + 3
+                else:
+                    return None  # флаги, ссылки на группы - не разбираем
+            stack.append([[], drop])
+            continue
+        
+        if char == ")":
+            if len(stack) == 1:
+                return None
+            text, drop = stack.pop()
+            i += 1
+            following = pattern[i:i + 2]
+            if following[:1] in ("?", "*") or following == "+?":
+                drop = True
+            stack[-1][0].append(" " if drop else " " + "".join(text) + " ")
+            continue
+        
+        # Символ с ? или * после него необязателен
+        if char in "?*+.^$" or pattern[i + 1:i + 2] in ("?", "*"):
+            stack[-1][0].append(" ")
+        else:
+            stack[-1][0].append(char)
+        i += 1
+    
+    if len(stack) != 1:
+        return None
+    
+    best = max(re.findall(r'\w+', "".join(stack[0][0])), key=len, default="")
+    return best.lower() if len(best) >= 3 else None
+
+class PatternFamily:
+    """Скомпилированное семейство шаблонов с фильтром по ключевым словам"""
+    
+    def __init__(self, name: str, patterns: List[Tuple[str, int]]):
+        self.name = name
+        self.patterns = patterns
+        self.compiled = [re.compile(pattern, re.IGNORECASE) for pattern, _ in patterns]
+        self.literals = [_required_literal(pattern) for pattern, _ in patterns]
+    
+    def search(self, text: str, lowered: str) -> Optional[PatternMatch]:
+        """Первый сработавший шаблон в порядке объявления"""
+        for index, literal in enumerate(self.literals):
+            if literal is not None and literal not in lowered:
                 continue
-                
-            if isinstance(value, bool):
-                display_value = "✅ Да" if value else "❌ Нет"
-            elif isinstance(value, list):
-                display_value = ", ".join(str(v) for v in value[:3])
-                if len(value) > 3:
-                    display_value += f" ... (+{len(value)-3})"
-            elif value is None:
-                display_value = "—"
-            else:
-                display_value = str(value)
             
-            # Форматируем ключи
-            formatted_key = key.replace("_", " ").title()
-            details_html += f"<b>├ {formatted_key}:</b> {display_value}\n"
+            match = self.compiled[index].search(text)
+            if match:
+                pattern, group = self.patterns[index]
+                return PatternMatch(self.name, pattern, group, match)
         
-        # Базовое сообщение
-        message = f"""
-{emoji} <b>СИСТЕМА ОБНАРУЖЕНИЯ</b>
-<b>Тип:</b> {alert.type.value}
-<b>Серьёзность:</b> {alert.severity.value}
-<b>Уверенность:</b> {alert.confidence}%
-
-<b>👤 ПОЛЬЗОВАТЕЛЬ</b>
-├ <b>Username:</b> @{alert.username}
-├ <b>User ID:</b> <code>{alert.user_id}</code>
-
-<b>💬 КОНТЕКСТ</b>
-├ <b>Чат:</b> {alert.chat_title}
-├ <b>Chat ID:</b> <code>{alert.chat_id}</code>
-├ <b>Message ID:</b> <code>{alert.message_id}</code>
-├ <b>Время:</b> {alert.timestamp}
+        return None
 
-<b>📊 ДЕТАЛИ</b>
-{details_html}
-"""
+class PatternDetector:
+    """Детектор шаблонов: компилирует семейства один раз и
+    перечитывает их из PATTERNS_FILE при изменении файла.
+    
+    Формат файла: {"screenshot": [["шаблон", группа], ...], "copy": ["шаблон", ...]}
+    """
+    
+    DEFAULTS = {
+        "screenshot": DEFAULT_SCREENSHOT_PATTERNS,
+        "copy": DEFAULT_COPY_PATTERNS,
+    }
+    
+    def __init__(self, path: Optional[str] = None, reload_interval: float = 5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._mtime = None
+        self._next_check = 0.0
+        self._reload_lock = threading.Lock()
+        self.families: Dict[str, PatternFamily] = self._compile(self.DEFAULTS)
+        self.maybe_reload(force=True)
+    
+    def _compile(self, config: Dict) -> Dict[str, PatternFamily]:
+        """Скомпилировать все семейства"""
+        families = {}
+        for name, default in self.DEFAULTS.items():
+            patterns = []
+            for entry in config.get(name, default):
+                if isinstance(entry, str):
+                    patterns.append((entry, 0))
+                else:
+                    patterns.append((entry[0], int(entry[1])))
+            families[name] = PatternFamily(name, patterns)
+        return families
+    
+    def maybe_reload(self, force: bool = False):
+        """Перечитать файл шаблонов, если он изменился"""
+        if not self.path:
+            return
         
-        # Дополнительная информация для разных типов
-        if alert.type == AlertType.FORWARD_OUT and alert.source_chat_title:
-            message += f"""
-<b>📍 НАПРАВЛЕНИЕ ПЕРЕСЫЛКИ</b>
-├ <b>Из чата:</b> {alert.source_chat_title}
-├ <b>В чат:</b> {alert.chat_title}
-└ <b>⚠️ УТЕЧКА ИЗ ЗАЩИЩЕННОГО ЧАТА!</b>
-"""
-        elif alert.type == AlertType.FORWARD_IN and alert.source_chat_title:
-            message += f"""
-<b>📍 НАПРАВЛЕНИЕ ПЕРЕСЫЛКИ</b>
-├ <b>Из чата:</b> {alert.source_chat_title}
-├ <b>В чат:</b> {alert.chat_title}
-└ <b>📥 ВХОДЯЩЕЕ СООБЩЕНИЕ</b>
-"""
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return
+        if not self._reload_lock.acquire(blocking=False):
+            return
         
-        message += f"\n<code>ID: {alert.alert_id}</code>"
-        return message.strip()
+        try:
+            self._next_check = now + self.reload_interval
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return
+            
+            with open(self.path, encoding="utf-8") as f:
+                config = json.load(f)
+            
+            # Подменяем целиком, чтобы обработчики не видели полусобранных шаблонов
+            self.families = self._compile(config)
+            self._mtime = mtime
+            logger.info(f"🔁 Шаблоны загружены из {self.path}")
+        except FileNotFoundError:
+            logger.warning(f"⚠️ Файл шаблонов не найден: {self.path}")
+        except (ValueError, TypeError, IndexError, re.error) as e:
+            logger.error(f"Patterns reload error: {e}")
+        finally:
+            self._reload_lock.release()
+    
+    def detect(self, family: str, text: str) -> Optional[PatternMatch]:
+        """Найти первый сработавший шаблон семейства"""
+        self.maybe_reload()
+        return self.families[family].search(text, text.lower())
 
-# ========== ИСПРАВЛЕННАЯ СИСТЕМА МОНИТОРИНГА ==========
-class FixedTelegramMonitor:
-    def __init__(self, token: str, allowed_ids: List[int]):
-        self.tg = EnhancedTelegramAPI(token)
-        self.allowed_ids = allowed_ids
+# ========== РАССЫЛКА ОПОВЕЩЕНИЙ ==========
+class TokenBucket:
+    """Ведро токенов: не больше rate отправок в секунду"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+    
+    def reserve(self) -> float:
+        """Занять токен и вернуть, сколько секунд ждать до отправки"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.paused_until - now)
+    
+    def acquire(self):
+        """Дождаться токена"""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+    
+    def pause(self, seconds: float):
+        """Остановить выдачу токенов (ответ 429)"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+@dataclass(order=True)
+class OutboxJob:
+    due: float
+    outbox_id: int
+    chat_id: int = 0
+    text: str = ""
+    attempts: int = 0
+
+class AlertNotifier:
+    """Параллельная рассылка с учётом лимитов Telegram.
+    
+    Каждое сообщение сначала записывается в таблицу outbox и удаляется
+    только после успешной доставки, поэтому при сбое сети или перезапуске
+    оповещения не теряются. Ответ 429 откладывает повтор на retry_after,
+    сетевые ошибки и 5xx - на экспоненциальную паузу.
+    
+    С runtime отправки идут корутинами в его цикле: ожидание токена и
+    ответа не занимает потоков, в полёте до max_inflight сообщений.
+    """
+    
+    def __init__(self, tg: EnhancedTelegramAPI, conn: sqlite3.Connection, lock,
+                 workers: int = 8, global_rate: float = 30, chat_rate: float = 1,
+                 max_attempts: int = 10, runtime: Optional[AsyncRuntime] = None,
+                 max_inflight: int = 1000):
+        self.tg = tg
+        self.conn = conn
+        self.lock = lock
+        self.max_attempts = max_attempts
+        self.chat_rate = chat_rate
+        self.runtime = runtime
         
-        # База данных
-        self.conn = sqlite3.connect('telegram_monitor.db', check_same_thread=False)
-        self.init_database()
+        self.global_bucket = TokenBucket(global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
         
-        # Кэш данных
-        self.our_chats: Set[int] = set()
-        self.users: Dict[int, UserData] = {}
-        self.chats: Dict[int, ChatData] = {}
+        self._jobs: List[OutboxJob] = []
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._executor = None
+        self._inflight = None
+        if runtime is None:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="notify")
+        else:
+            self._inflight = threading.BoundedSemaphore(max_inflight)
         
-        # Загружаем данные
-        self.load_data()
+        # Счётчики
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
         
-        # Для отслеживания копирования
-        self.message_cache: Dict[Tuple[int, int], str] = {}  # (chat_id, message_id) -> text
-        self.copy_patterns = [
-            r'скопировал',
-            r'copy',
-            r'copied',
-            r'взял текст',
-            r'сохранил сообщение'
-        ]
+        self._restore()
+        self._thread = threading.Thread(target=self._dispatch, name="notify-dispatch", daemon=True)
+        self._thread.start()
+    
+    def _restore(self):
+        """Поднять неотправленные сообщения после перезапуска"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, chat_id, text, attempts, next_attempt FROM outbox ORDER BY id"
+            ).fetchall()
         
-        logger.info(f"✅ Монитор инициализирован. Наших чатов: {len(self.our_chats)}")
+        for outbox_id, chat_id, text, attempts, next_attempt in rows:
+            heapq.heappush(self._jobs, OutboxJob(next_attempt or 0.0, outbox_id, chat_id, text, attempts))
+        
+        if rows:
+            logger.info(f"📬 Неотправленных оповещений: {len(rows)}")
     
-    def init_database(self):
-        """Инициализировать базу данных"""
-        cursor = self.conn.cursor()
+    def notify(self, chat_ids: List[int], text: str):
+        """Поставить сообщение в очередь для каждого получателя"""
+        if not chat_ids:
+            return
         
-        # Таблица чатов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chats (
-                chat_id INTEGER PRIMARY KEY,
-                title TEXT,
-                username TEXT,
-                type TEXT,
-                is_our_chat INTEGER DEFAULT 0,
-                added_at TIMESTAMP,
-                message_count INTEGER DEFAULT 0
-            )
-        ''')
+        now = time.time()
+        with self.lock:
+            with self.conn:
+                ids = []
+                for chat_id in chat_ids:
+                    cursor = self.conn.execute(
+                        "INSERT INTO outbox (chat_id, text, attempts, next_attempt, created_at) VALUES (?, ?, 0, ?, ?)",
+                        (chat_id, text, now, now)
+                    )
+                    ids.append((cursor.lastrowid, chat_id))
         
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
+        with self._cond:
+            for outbox_id, chat_id in ids:
+                heapq.heappush(self._jobs, OutboxJob(now, outbox_id, chat_id, text, 0))
+            self._cond.notify()
+    
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate))
+        return bucket
+    
+    def _dispatch(self):
+        """Передавать наступившие задачи в пул отправки"""
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    if self._jobs:
+                        delay = self._jobs[0].due - time.time()
+                        if delay <= 0:
+                            break
+                        self._cond.wait(min(delay, 1.0))
+                    else:
+                        self._cond.wait(1.0)
+                
+                if self._stopping:
+                    return
+                job = heapq.heappop(self._jobs)
+            
+            if self.runtime is None:
+                self._executor.submit(self._deliver, job)
+                continue
+            
+            # Не больше max_inflight корутин: остальное ждёт в куче
+            while not self._inflight.acquire(timeout=1.0):
+                if self._stopping:
+                    with self._cond:
+                        heapq.heappush(self._jobs, job)
+                    return
+            future = self.runtime.submit(self._deliver_async(job))
+            future.add_done_callback(lambda _: self._inflight.release())
+    
+    def _deliver(self, job: OutboxJob):
+        """Отправить одно сообщение"""
+        self.global_bucket.acquire()
+        self._chat_bucket(job.chat_id).acquire()
+        
+        self._handle_result(job, self.tg.send_message(job.chat_id, job.text))
+    
+    async def _deliver_async(self, job: OutboxJob):
+        """Отправить одно сообщение из цикла runtime"""
+        for bucket in (self.global_bucket, self._chat_bucket(job.chat_id)):
+            wait = bucket.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        
+        result = await self.runtime.api.send_message(job.chat_id, job.text)
+        # Запись в outbox - блокирующая работа с базой, не в цикле
+        await asyncio.to_thread(self._handle_result, job, result)
+    
+    def _handle_result(self, job: OutboxJob, result: SendResult):
+        """Удалить доставленное или запланировать повтор"""
+        if result.ok:
+            self.sent += 1
+            self._finish(job)
+            logger.info(f"✅ Оповещение отправлено {job.chat_id}")
+            return
+        
+        job.attempts += 1
+        if result.retry_after is not None:
+            self.rate_limited += 1
+            self._chat_bucket(job.chat_id).pause(result.retry_after)
+            delay = result.retry_after
+        elif result.retryable:
+            delay = min(300.0, 2.0 ** job.attempts)
+        else:
+            delay = None
+        
+        if delay is None or job.attempts >= self.max_attempts:
+            self.failed += 1
+            self._finish(job)
+            logger.error(f"❌ Не удалось отправить {job.chat_id}: {result.error}")
+            return
+        
+        self.retried += 1
+        job.due = time.time() + delay
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?",
+                    (job.attempts, job.due, job.outbox_id)
+                )
+        with self._cond:
+            heapq.heappush(self._jobs, job)
+            self._cond.notify()
+        logger.warning(f"⏳ Повтор отправки {job.chat_id} через {delay:.0f} с: {result.error}")
+    
+    def _finish(self, job: OutboxJob):
+        """Убрать сообщение из outbox"""
+        with self.lock:
+            with self.conn:
+                self.conn.execute("DELETE FROM outbox WHERE id = ?", (job.outbox_id,))
+    
+    def stats(self) -> Dict:
+        """Метрики рассылки"""
+        return {
+            "pending": len(self._jobs),
+            "runtime": "async" if self.runtime else "threads",
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "rate_limited": self.rate_limited
+        }
+    
+    def close(self, timeout: float = 10.0):
+        """Остановить рассылку; недоставленное остаётся в outbox"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+# ========== СТАТУС БОТА В ЧАТАХ ==========
+class ChatAdminResolver:
+    """Кэш статуса бота в чатах.
+    
+    Поиск никогда не блокирует обработку: неизвестный или устаревший
+    статус запрашивается в фоне, а одновременные запросы по одному чату
+    схлопываются в один вызов getChatMember. Результат передаётся в
+    on_status. Ответы "не админ" и ошибки кэшируются на negative_ttl,
+    обновления my_chat_member записываются в кэш сразу. С runtime запросы
+    идут корутинами в его цикле вместо пула потоков. В кэше не больше
+    max_entries чатов: вытесняются давно не обновлявшиеся.
+    """
+    
+    def __init__(self, tg: EnhancedTelegramAPI, on_status, ttl: float = 3600,
+                 negative_ttl: float = 300, workers: int = 2,
+                 runtime: Optional[AsyncRuntime] = None, max_entries: int = 20000):
+        self.tg = tg
+        self.on_status = on_status
+        self.runtime = runtime
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max(1, max_entries)
+        
+        # chat_id -> (статус или None, когда истекает); порядок - по обновлению
+        self._cache: "OrderedDict[int, Tuple[Optional[str], float]]" = OrderedDict()
+        self._inflight: Dict[int, object] = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        if runtime is None:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="admin-resolve")
+        
+        self.lookups = 0
+        self.coalesced = 0
+        self.evictions = 0
+    
+    def peek(self, chat_id: int) -> Optional[str]:
+        """Известный статус (возможно устаревший)"""
+        entry = self._cache.get(chat_id)
+        return entry[0] if entry else None
+    
+    def ensure(self, chat_id: int):
+        """Запросить статус в фоне, если его нет или он устарел"""
+        entry = self._cache.get(chat_id)
+        if entry is not None and time.monotonic() < entry[1]:
+            return
+        self.lookup(chat_id)
+    
+    def lookup(self, chat_id: int):
+        """Запросить статус в фоне (один запрос на чат)"""
+        if self.tg.bot_id is None:
+            return None
+        
+        with self._lock:
+            future = self._inflight.get(chat_id)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if self.runtime is None:
+                future = self._executor.submit(self._resolve, chat_id)
+            else:
+                future = self.runtime.submit(self._resolve_async(chat_id))
+            self._inflight[chat_id] = future
+            return future
+    
+    def _resolve(self, chat_id: int) -> Optional[str]:
+        """Запрос getChatMember"""
+        try:
+            self.lookups += 1
+            status = self.tg.get_chat_member_status(chat_id, self.tg.bot_id)
+            self._store(chat_id, status)
+            if status is not None:
+                self.on_status(chat_id, status)
+            return status
+        except Exception as e:
+            logger.error(f"Check bot admin error: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._inflight.pop(chat_id, None)
+    
+    async def _resolve_async(self, chat_id: int) -> Optional[str]:
+        """Запрос getChatMember из цикла runtime"""
+        try:
+            self.lookups += 1
+            status = await self.runtime.api.get_chat_member_status(chat_id, self.tg.bot_id)
+            self._store(chat_id, status)
+            if status is not None:
+                # on_status пишет в базу - в пул цикла
+                await asyncio.to_thread(self.on_status, chat_id, status)
+            return status
+        except Exception as e:
+            logger.error(f"Check bot admin error: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._inflight.pop(chat_id, None)
+    
+    def _store(self, chat_id: int, status: Optional[str]):
+        ttl = self.ttl if status in ADMIN_STATUSES else self.negative_ttl
+        with self._lock:
+            previous = self._cache.pop(chat_id, None)
+            # Ошибку запроса не записываем поверх известного статуса
+            if status is None and previous is not None:
+                status = previous[0]
+            self._cache[chat_id] = (status, time.monotonic() + ttl)
+            
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+    
+    def update_from_member(self, chat_id: int, status: str):
+        """Статус из обновления my_chat_member"""
+        self._store(chat_id, status)
+    
+    def stats(self) -> Dict:
+        """Метрики кэша"""
+        return {
+            "cached": len(self._cache),
+            "inflight": len(self._inflight),
+            "lookups": self.lookups,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions
+        }
+    
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+# ========== ГРУППИРОВКА ОПОВЕЩЕНИЙ ==========
+class AlertAggregator:
+    """Схлопывает шторм оповещений в сводки.
+    
+    Оповещения группируются по (тип, пользователь, исходный чат). Первое
+    в окне отправляется сразу, остальные только считаются; по закрытии
+    окна уходит одна сводка с количеством и примерами.
+    """
+    
+    def __init__(self, on_digest, window: float = 60.0, samples: int = 5):
+        self.on_digest = on_digest
+        self.window = window
+        self.max_samples = samples
+        
+        self._groups: Dict[Tuple, AlertGroup] = {}
+        self._cond = threading.Condition()
+        self._stopping = False
+        
+        self.digests = 0
+        self.suppressed = 0
+        
+        self._thread = threading.Thread(target=self._run, name="alert-digest", daemon=True)
+        self._thread.start()
+    
+    @staticmethod
+    def key(alert: AlertData) -> Tuple:
+        return (alert.type, alert.user_id, alert.source_chat_id or alert.chat_id)
+    
+    def add(self, alert: AlertData) -> Tuple[str, bool]:
+        """Учесть оповещение. Возвращает (group_id, отправлять ли сразу)"""
+        if self.window <= 0:
+            return alert.alert_id, True
+        
+        key = self.key(alert)
+        now = time.monotonic()
+        closed = []
+        with self._cond:
+            group = self._groups.get(key)
+            if group is None or now >= group.window_end:
+                if group is not None:
+                    closed = self._close([key])
+                self._groups[key] = AlertGroup(
+                    group_id=alert.alert_id,
+                    first=alert,
+                    window_end=now + self.window,
+                    severity=alert.severity
+                )
+                self._cond.notify()
+                result = (alert.alert_id, True)
+            else:
+                group.total += 1
+                group.suppressed += 1
+                if SEVERITY_ORDER.index(alert.severity) > SEVERITY_ORDER.index(group.severity):
+                    group.severity = alert.severity
+                group.samples.append(alert)
+                if len(group.samples) > self.max_samples:
+                    del group.samples[0]
+                self.suppressed += 1
+                result = (group.group_id, False)
+        
+        self._emit(closed)
+        return result
+    
+    def _close(self, keys: List[Tuple]) -> List[AlertGroup]:
+        """Закрыть окна групп (под блокировкой); сводки отдаёт _emit"""
+        groups = [self._groups.pop(key) for key in keys]
+        groups = [group for group in groups if group.suppressed]
+        self.digests += len(groups)
+        return groups
+    
+    def _emit(self, groups: List[AlertGroup]):
+        """Отдать сводки (без блокировки: рендер, поток и outbox не держат add)"""
+        for group in groups:
+            try:
+                self.on_digest(group)
+            except Exception as e:
+                logger.error(f"Alert digest error: {e}", exc_info=True)
+    
+    def _run(self):
+        """Закрывать истёкшие окна"""
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                now = time.monotonic()
+                closed = self._close([k for k, g in self._groups.items() if now >= g.window_end])
+                if not closed:
+                    next_end = min((g.window_end for g in self._groups.values()), default=now + 1.0)
+                    self._cond.wait(max(0.05, min(next_end - now, 1.0)))
+            
+            self._emit(closed)
+    
+    def stats(self) -> Dict:
+        """Метрики группировки"""
+        return {
+            "window_seconds": self.window,
+            "open_groups": len(self._groups),
+            "suppressed": self.suppressed,
+            "digests": self.digests
+        }
+    
+    def close(self):
+        """Отправить сводки по открытым окнам и остановиться"""
+        with self._cond:
+            self._stopping = True
+            closed = self._close(list(self._groups))
+            self._cond.notify()
+        self._thread.join(5)
+        self._emit(closed)
+
+# ========== ЖИВОЙ ПОТОК СОБЫТИЙ ==========
+@dataclass
+class StreamEvent:
+    id: Optional[int]
+    kind: str
+    data: Dict
+    
+    def encode(self) -> str:
+        """Кадр Server-Sent Events"""
+        frame = f"id: {self.id}\n" if self.id is not None else ""
+        return f"{frame}event: {self.kind}\ndata: {json.dumps(self.data, ensure_ascii=False)}\n\n"
+    
+    def to_dict(self) -> Dict:
+        return {"id": self.id, "kind": self.kind, "data": self.data}
+
+class StreamSubscriber:
+    """Подписчик потока с ограниченным буфером"""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.events: deque = deque()
+        self.overflowed = False
+        self.delivered = 0
+
+class AlertStream:
+    """Рассылка событий открытым дашбордам.
+    
+    Каждый подписчик получает свой буфер на maxsize событий. Медленный
+    подписчик, переполнивший буфер, отключается с событием overflow и
+    переподключается с Last-Event-ID: недостающее отдаётся из общей
+    истории последних history событий. Если клиент отстал сильнее,
+    он получает reset и перечитывает данные целиком.
+    """
+    
+    def __init__(self, buffer_size: int = 256, history: int = 1000, max_subscribers: int = 200):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._history: deque = deque(maxlen=history)
+        self._subscribers: Set[StreamSubscriber] = set()
+        self._cond = threading.Condition()
+        self._closed = False
+        
+        # Номера событий растут и между перезапусками (старт - время в мс),
+        # поэтому Last-Event-ID от прошлого запуска не путается с новыми
+        self._last_id = int(time.time() * 1000)
+        
+        self.published = 0
+        self.overflows = 0
+    
+    def publish(self, kind: str, data: Dict) -> StreamEvent:
+        """Отправить событие всем подписчикам"""
+        with self._cond:
+            self._last_id += 1
+            event = StreamEvent(self._last_id, kind, data)
+            self._history.append(event)
+            self.published += 1
+            for subscriber in self._subscribers:
+                if subscriber.overflowed:
+                    continue
+                if len(subscriber.events) >= subscriber.maxsize:
+                    subscriber.overflowed = True
+                    subscriber.events.clear()
+                    self.overflows += 1
+                else:
+                    subscriber.events.append(event)
+            self._cond.notify_all()
+        return event
+    
+    def _backlog(self, after: Optional[int], limit: int) -> List[StreamEvent]:
+        """События после after из истории (под self._cond)"""
+        if after is None:
+            return []
+        if after < self._last_id - len(self._history):
+            # Клиент отстал сильнее, чем хранит история
+            return [StreamEvent(None, "reset", {"last_event_id": self._last_id})]
+        
+        backlog = [event for event in self._history if event.id > after]
+        if len(backlog) > limit:
+            return [StreamEvent(None, "reset", {"last_event_id": self._last_id})]
+        return backlog
+    
+    def subscribe(self, last_event_id: Optional[int] = None) -> Optional[StreamSubscriber]:
+        """Подписаться; None - если подписчиков уже слишком много"""
+        with self._cond:
+            if self._closed or len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscriber = StreamSubscriber(self.buffer_size)
+            subscriber.events.extend(self._backlog(last_event_id, self.buffer_size))
+            self._subscribers.add(subscriber)
+            return subscriber
+    
+    def unsubscribe(self, subscriber: StreamSubscriber):
+        with self._cond:
+            self._subscribers.discard(subscriber)
+    
+    def take(self, subscriber: StreamSubscriber, timeout: float) -> Optional[List[StreamEvent]]:
+        """Забрать накопленные события; [] - таймаут, None - пора отключаться"""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: subscriber.events or subscriber.overflowed or self._closed,
+                timeout
+            )
+            if subscriber.overflowed or self._closed:
+                return None
+            events = list(subscriber.events)
+            subscriber.events.clear()
+            subscriber.delivered += len(events)
+            return events
+    
+    def poll(self, after: Optional[int], timeout: float) -> Tuple[List[StreamEvent], int]:
+        """Long-poll: события после after (ждём до timeout) и последний номер"""
+        with self._cond:
+            if after is not None:
+                self._cond.wait_for(lambda: self._last_id > after or self._closed, timeout)
+            return self._backlog(after, self.buffer_size), self._last_id
+    
+    def stats(self) -> Dict:
+        """Метрики потока"""
+        with self._cond:
+            return {
+                "subscribers": len(self._subscribers),
+                "published": self.published,
+                "overflows": self.overflows,
+                "last_event_id": self._last_id,
+                "buffered": sum(len(s.events) for s in self._subscribers)
+            }
+    
+    def close(self):
+        """Отключить всех подписчиков"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+# ========== ОЧЕРЕДЬ ВХОДЯЩИХ ОБНОВЛЕНИЙ ==========
+def _update_chat_id(update: Dict) -> Optional[int]:
+    """Достать chat_id из обновления любого типа"""
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post", "my_chat_member"):
+        payload = update.get(key)
+        if isinstance(payload, dict):
+            return payload.get("chat", {}).get("id")
+    return None
+
+def _channel_message(post: Dict) -> Dict:
+    """Пост канала приходит без from: автором считается сам канал"""
+    if post.get("from"):
+        return post
+    sender = post.get("sender_chat") or post.get("chat") or {}
+    author = {"id": sender.get("id"), "is_bot": False, "first_name": sender.get("title", "")}
+    if sender.get("username"):
+        author["username"] = sender["username"]
+    return {**post, "from": author}
+
+class IngestQueue:
+    """Ограниченная очередь обновлений с пулом обработчиков.
+    
+    Каждый обработчик читает свою очередь, а обновления распределяются
+    по chat_id, поэтому сообщения одного чата обрабатываются по порядку.
+    С batch_handler обработчик забирает всё накопившееся (до batch_size)
+    и передаёт одной пачкой.
+    """
+    
+    def __init__(self, handler, workers: int = 4, maxsize: int = 10000, dedupe_window: int = 50000,
+                 batch_handler=None, batch_size: int = 100):
+        self.handler = handler
+        self.batch_handler = batch_handler
+        self.batch_size = max(1, batch_size)
+        self.workers = max(1, workers)
+        self.capacity = max(self.workers, maxsize)
+        per_worker = max(1, self.capacity // self.workers)
+        self.queues = [queue.Queue(maxsize=per_worker) for _ in range(self.workers)]
+        
+        # Окно последних update_id для отсева повторных доставок
+        self.dedupe_window = dedupe_window
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        
+        # Счётчики
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.batches = 0
+        self.lag_avg = 0.0
+        self.lag_max = 0.0
+        
+        self._threads = []
+        for index, worker_queue in enumerate(self.queues):
+            thread = threading.Thread(
+                target=self._worker, args=(worker_queue,), name=f"ingest-{index}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+    
+    def submit(self, update: Dict) -> bool:
+        """Поставить обновление в очередь. False - очередь переполнена"""
+        update_id = update.get("update_id")
+        
+        with self._lock:
+            if update_id is not None:
+                if update_id in self._seen:
+                    self.duplicates += 1
+                    return True
+                self._seen[update_id] = None
+                if len(self._seen) > self.dedupe_window:
+                    self._seen.popitem(last=False)
+        
+        chat_id = _update_chat_id(update) or 0
+        worker_queue = self.queues[hash(chat_id) % self.workers]
+        
+        try:
+            worker_queue.put_nowait((time.monotonic(), update))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+                # Telegram повторит доставку - не считаем её дублем
+                if update_id is not None:
+                    self._seen.pop(update_id, None)
+            return False
+        
+        with self._lock:
+            self.accepted += 1
+        return True
+    
+    def _take(self, worker_queue: queue.Queue) -> Tuple[list, bool]:
+        """Следующая пачка: (элементы, пора ли остановиться)"""
+        item = worker_queue.get()
+        if item is None:
+            return [], True
+        
+        items = [item]
+        if self.batch_handler is not None:
+            while len(items) < self.batch_size:
+                try:
+                    item = worker_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    return items, True
+                items.append(item)
+        return items, False
+    
+    def _worker(self, worker_queue: queue.Queue):
+        """Цикл обработчика"""
+        stopping = False
+        while not stopping:
+            items, stopping = self._take(worker_queue)
+            if not items:
+                break
+            
+            now = time.monotonic()
+            lags = [now - enqueued_at for enqueued_at, _ in items]
+            
+            try:
+                if self.batch_handler is not None:
+                    self.batch_handler([update for _, update in items])
+                else:
+                    self.handler(items[0][1])
+                failed = False
+            except Exception as e:
+                logger.error(f"Ingest handler error: {e}", exc_info=True)
+                failed = True
+            
+            with self._lock:
+                self.batches += 1
+                for lag in lags:
+                    self.processed += 1
+                    if failed:
+                        self.failed += 1
+                    self.lag_avg = lag if self.processed == 1 else self.lag_avg * 0.9 + lag * 0.1
+                    self.lag_max = max(self.lag_max, lag)
+    
+    def depth(self) -> int:
+        """Количество ожидающих обновлений"""
+        return sum(q.qsize() for q in self.queues)
+    
+    def oldest_age(self) -> float:
+        """Возраст самого старого ожидающего обновления, сек"""
+        now = time.monotonic()
+        oldest = 0.0
+        for worker_queue in self.queues:
+            with worker_queue.mutex:
+                if worker_queue.queue and worker_queue.queue[0] is not None:
+                    oldest = max(oldest, now - worker_queue.queue[0][0])
+        return oldest
+    
+    def stats(self) -> Dict:
+        """Метрики очереди"""
+        with self._lock:
+            counters = {
+                "accepted": self.accepted,
+                "duplicates": self.duplicates,
+                "rejected": self.rejected,
+                "processed": self.processed,
+                "failed": self.failed,
+                "batches": self.batches,
+                "lag_ms_avg": round(self.lag_avg * 1000, 2),
+                "lag_ms_max": round(self.lag_max * 1000, 2),
+            }
+        
+        return {
+            "depth": self.depth(),
+            "capacity": self.capacity,
+            "workers": self.workers,
+            "oldest_ms": round(self.oldest_age() * 1000, 2),
+            **counters
+        }
+    
+    def shutdown(self, timeout: float = 10.0):
+        """Дождаться обработки очереди и остановить обработчики"""
+        for worker_queue in self.queues:
+            try:
+                worker_queue.put(None, timeout=timeout)
+            except queue.Full:
+                logger.warning("⚠️ Очередь не освободилась до остановки")
+        
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+# ========== ПОЛУЧЕНИЕ ОБНОВЛЕНИЙ (getUpdates) ==========
+class UpdatePoller:
+    """Long-poll getUpdates вместо вебхука.
+    
+    Обновления пачками до limit штук уходят в ту же очередь, что и
+    вебхук. Смещение сохраняется в таблице state после каждой пачки,
+    так что перезапуск продолжает с места остановки; повторно
+    полученные обновления отсекает очередь по update_id.
+    """
+    
+    OFFSET_KEY = "updates_offset"
+    
+    def __init__(self, tg: EnhancedTelegramAPI, conn: sqlite3.Connection, lock: threading.RLock,
+                 ingest: "IngestQueue", limit: int = 100, timeout: int = 30):
+        self.tg = tg
+        self.conn = conn
+        self.lock = lock
+        self.ingest = ingest
+        self.limit = max(1, min(limit, 100))
+        self.timeout = timeout
+        self.offset = self._load_offset()
+        
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        
+        self.polls = 0
+        self.received = 0
+        self.errors = 0
+        self.waits = 0
+    
+    def _load_offset(self) -> Optional[int]:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM state WHERE key = ?", (self.OFFSET_KEY,)).fetchone()
+        return int(row[0]) if row else None
+    
+    def _save_offset(self):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                (self.OFFSET_KEY, str(self.offset))
+            )
+    
+    def start(self):
+        """Снять вебхук и начать опрос"""
+        if not self.tg.delete_webhook():
+            logger.warning("⚠️ Не удалось снять вебхук, getUpdates может вернуть 409")
+        self._thread = threading.Thread(target=self._run, name="update-poller", daemon=True)
+        self._thread.start()
+        logger.info(f"📡 Опрос getUpdates запущен (offset {self.offset})")
+    
+    def _run(self):
+        """Цикл опроса"""
+        backoff = 1.0
+        while not self._stop.is_set():
+            updates = self.tg.get_updates(self.offset, self.limit, self.timeout)
+            if updates is None:
+                self.errors += 1
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+                continue
+            backoff = 1.0
+            self.polls += 1
+            
+            if updates:
+                self._dispatch(updates)
+                self._save_offset()
+    
+    def _dispatch(self, updates: List[Dict]):
+        """Передать пачку в очередь (при переполнении - ждать, не теряя)"""
+        for update in updates:
+            while not self.ingest.submit(update):
+                self.waits += 1
+                if self._stop.wait(0.05):
+                    return
+            self.offset = update["update_id"] + 1
+            self.received += 1
+    
+    def stats(self) -> Dict:
+        """Метрики опроса"""
+        return {
+            "offset": self.offset,
+            "polls": self.polls,
+            "received": self.received,
+            "errors": self.errors,
+            "queue_full_waits": self.waits,
+            "avg_batch": round(self.received / self.polls, 1) if self.polls else 0
+        }
+    
+    def close(self, timeout: float = 5.0):
+        """Остановить опрос (текущий запрос дожидаться не обязательно)"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+# ========== ШАРДИРОВАНИЕ ПО ПРОЦЕССАМ ==========
+def _alert_to_wire(alert: AlertData) -> Dict:
+    """Оповещение для передачи между процессами (enum -> значение)"""
+    data = asdict(alert)
+    data["type"] = alert.type.value
+    data["severity"] = alert.severity.value
+    return data
+
+def _alert_from_wire(data: Dict) -> AlertData:
+    data = dict(data)
+    data["type"] = AlertType(data["type"])
+    data["severity"] = Severity(data["severity"])
+    return AlertData(**data)
+
+class ShardRouter:
+    """Раздача обновлений по процессам-шардам.
+    
+    Обновление уходит в шард hash(chat_id) % shards, поэтому порядок
+    внутри чата сохраняется, а чаты обрабатываются на всех ядрах.
+    Шарды присылают обратно оповещения, команды админов и изменения
+    общего состояния: чаты (our_chats), пользователей и тексты наших
+    чатов. Главный процесс применяет их у себя и раздаёт остальным
+    шардам, так что проверки пересылок и копирования видят все чаты.
+    Рассылка, сводки, поток и история событий остаются в главном
+    процессе. В базу пишет только он: пачки PersistenceWriter шардов
+    приходят сюда и ставятся в очередь его собственной записи.
+    """
+    
+    def __init__(self, monitor: "FixedTelegramMonitor", shards: int, maxsize: int = 10000):
+        self.monitor = monitor
+        self.shards = shards
+        context = multiprocessing.get_context("spawn")
+        self.results = context.Queue()
+        self.inboxes = [context.Queue(maxsize=max(1, maxsize // shards)) for _ in range(shards)]
+        
+        self.processes = []
+        for index, inbox in enumerate(self.inboxes):
+            # Дочерний процесс импортирует модуль заново и по этой
+            # переменной создаёт монитор в режиме шарда
+            os.environ["TGMON_SHARD_INDEX"] = str(index)
+            try:
+                process = context.Process(
+                    target=_shard_main, args=(inbox, self.results), name=f"shard-{index}", daemon=True
+                )
+                process.start()
+            finally:
+                os.environ.pop("TGMON_SHARD_INDEX", None)
+            self.processes.append(process)
+        
+        self.routed = [0] * shards
+        self.rejected = 0
+        self.received: Counter = Counter()
+        
+        self._collector = threading.Thread(target=self._collect, name="shard-results", daemon=True)
+        self._collector.start()
+        logger.info(f"🧩 Запущено шардов: {shards}")
+    
+    def shard_of(self, chat_id: Optional[int]) -> int:
+        return hash(chat_id or 0) % self.shards
+    
+    def submit(self, update: Dict) -> bool:
+        """Отправить обновление в шард. False - очередь шарда переполнена"""
+        index = self.shard_of(_update_chat_id(update))
+        try:
+            self.inboxes[index].put_nowait(("update", None, update))
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.routed[index] += 1
+        return True
+    
+    def broadcast(self, message: Tuple, exclude: Optional[int] = None):
+        """Разослать служебное сообщение шардам (кроме exclude)"""
+        for index, inbox in enumerate(self.inboxes):
+            if index != exclude:
+                inbox.put(message)
+    
+    def _collect(self):
+        """Приём сообщений от шардов"""
+        while True:
+            message = self.results.get()
+            if message is None:
+                break
+            
+            kind, origin, payload = message
+            self.received[kind] += 1
+            try:
+                if kind == "alert":
+                    self.monitor._send_alert(_alert_from_wire(payload))
+                elif kind == "command":
+                    self.monitor._handle_command(*payload)
+                elif kind == "chat":
+                    self.monitor._cache_chat(*payload)
+                    self.broadcast(message, exclude=origin)
+                elif kind == "user":
+                    self.monitor._cache_user(*payload)
+                elif kind == "rows":
+                    self.monitor.writer.queue_batch(*payload)
+                elif kind == "replica":
+                    self.broadcast(message, exclude=origin)
+            except Exception as e:
+                logger.error(f"Shard message error ({kind}): {e}", exc_info=True)
+    
+    def stats(self) -> Dict:
+        """Метрики шардов"""
+        depths = []
+        for inbox in self.inboxes:
+            try:
+                depths.append(inbox.qsize())
+            except NotImplementedError:
+                depths.append(-1)
+        return {
+            "shards": self.shards,
+            "alive": sum(1 for p in self.processes if p.is_alive()),
+            "accepted": sum(self.routed),
+            "rejected": self.rejected,
+            "depth": sum(d for d in depths if d > 0),
+            "routed": list(self.routed),
+            "shard_depths": depths,
+            "received": dict(self.received)
+        }
+    
+    def shutdown(self, timeout: float = 10.0):
+        """Остановить шарды (они дорабатывают свои очереди)"""
+        self.broadcast(("stop", None, None))
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+        self.results.put(None)
+        self._collector.join(timeout)
+
+class ShardLink:
+    """Связь шарда с главным процессом"""
+    
+    def __init__(self, index: int, results):
+        self.index = index
+        self.results = results
+    
+    def send(self, kind: str, payload):
+        self.results.put((kind, self.index, payload))
+    
+    def write_batch(self, chats: list, users: list, usernames: list, fingerprints: list,
+                    events: list, user_stats: list):
+        """Пачка PersistenceWriter шарда - в главный процесс (вместо Storage.write_batch)"""
+        self.send("rows", (chats, users, usernames, fingerprints, events, user_stats))
+
+def _shard_main(inbox, results):
+    """Точка входа процесса-шарда"""
+    shard = monitor
+    shard.upstream = ShardLink(int(SHARD_INDEX), results)
+    # Пишет в базу только главный процесс: накопленные строки уходят ему
+    shard.writer.storage = shard.upstream
+    logger.info(f"🧩 Шард {SHARD_INDEX} запущен (pid {os.getpid()})")
+    
+    while True:
+        kind, _, payload = inbox.get()
+        if kind == "stop":
+            break
+        if kind == "update":
+            # Обновление уже прошло очередь главного процесса: ждём, а не теряем
+            while not shard.ingest.submit(payload):
+                time.sleep(0.01)
+        elif kind == "chat":
+            shard._cache_chat(*payload)
+        elif kind == "replica":
+            shard._apply_replica(*payload)
+    
+    shard.shutdown()
+
+# ========== БАЗА ДАННЫХ ==========
+ALERT_TIMESTAMP_FORMAT = "%H:%M:%S %d.%m.%Y"
+
+# Версия схемы хранится в PRAGMA user_version
+SCHEMA_VERSION = 9
+
+def open_database(path: str, durable: bool = False) -> sqlite3.Connection:
+    """Открыть SQLite с профилем под нагрузку"""
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30, cached_statements=256)
+    
+    # WAL: читатели не блокируют запись, fsync только на checkpoint
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={'FULL' if durable else 'NORMAL'}")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_MB * 1024}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+def _parse_alert_timestamp(value: Optional[str]) -> Optional[float]:
+    """Перевести строку времени события в unix time"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, ALERT_TIMESTAMP_FORMAT).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+# ========== КЭШ СООБЩЕНИЙ ==========
+@dataclass
+class CachedMessage:
+    chat_id: int
+    message_id: int
+    user_id: int
+    text: str
+    digest: int
+    cached_at: float
+    size: int
+
+def normalize_text(text: str) -> str:
+    """Текст для сравнения: нижний регистр, пробелы схлопнуты"""
+    return " ".join(text.lower().split())
+
+class MessageCache:
+    """LRU-кэш текстов сообщений с TTL и учётом памяти.
+    
+    Ограничения: общее число записей, записей на чат и примерный объём.
+    Хранит индекс по нормализованному тексту, чтобы находить дословные
+    повторы уже виденных сообщений. Порядок LRU и порядок записи для
+    TTL ведутся раздельно: обращение не продлевает жизнь записи.
+    """
+    
+    # Примерные накладные расходы на запись: объект, ключ, ссылки в индексах
+    ENTRY_OVERHEAD = 500
+    
+    def __init__(self, max_entries: int = 50000, per_chat: int = 5000,
+                 ttl: float = 86400, max_bytes: int = 64 * 1024 * 1024, max_text: int = 500):
+        self.max_entries = max_entries
+        self.per_chat = per_chat
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_text = max_text
+        
+        self._entries: "OrderedDict[Tuple[int, int], CachedMessage]" = OrderedDict()
+        self._by_age: "OrderedDict[Tuple[int, int], None]" = OrderedDict()
+        self._chat_entries: Dict[int, "OrderedDict[int, None]"] = {}
+        self._by_digest: Dict[int, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+        
+        # Счётчики
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = {"lru": 0, "ttl": 0, "chat": 0, "memory": 0}
+    
+    def put(self, chat_id: int, message_id: int, user_id: int, text: str):
+        """Запомнить сообщение"""
+        text = text[:self.max_text]
+        digest = hash(normalize_text(text))
+        size = sys.getsizeof(text) + self.ENTRY_OVERHEAD
+        key = (chat_id, message_id)
+        now = time.monotonic()
+        
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            
+            entry = CachedMessage(chat_id, message_id, user_id, text, digest, now, size)
+            self._entries[key] = entry
+            self._by_age[key] = None
+            self._chat_entries.setdefault(chat_id, OrderedDict())[message_id] = None
+            # Индекс указывает на первое появление текста - оригинал
+            if self._by_digest.get(digest) not in self._entries:
+                self._by_digest[digest] = key
+            self.bytes += size
+            
+            self._evict(chat_id, now)
+    
+    def get(self, chat_id: int, message_id: int) -> Optional[CachedMessage]:
+        """Получить сообщение по ключу"""
+        key = (chat_id, message_id)
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+    
+    def find_copy(self, text: str) -> Optional[CachedMessage]:
+        """Найти самое раннее сообщение с тем же текстом"""
+        normalized = normalize_text(text[:self.max_text])
+        with self._lock:
+            key = self._by_digest.get(hash(normalized))
+            entry = self._live(key) if key else None
+            if entry is None or normalize_text(entry.text) != normalized:
+                self.misses += 1
+                return None
+            
+            self.hits += 1
+            return entry
+    
+    def _expired(self, entry: CachedMessage, now: float) -> bool:
+        return now - entry.cached_at > self.ttl
+    
+    def _live(self, key: Tuple[int, int]) -> Optional[CachedMessage]:
+        """Запись по ключу; устаревшая удаляется (под блокировкой)"""
+        entry = self._entries.get(key)
+        if entry is not None and self._expired(entry, time.monotonic()):
+            self._remove(key)
+            self.evictions["ttl"] += 1
+            return None
+        return entry
+    
+    def _remove(self, key: Tuple[int, int]):
+        """Удалить запись из всех индексов (под блокировкой)"""
+        entry = self._entries.pop(key)
+        del self._by_age[key]
+        self.bytes -= entry.size
+        
+        chat_entries = self._chat_entries.get(entry.chat_id)
+        if chat_entries is not None:
+            chat_entries.pop(entry.message_id, None)
+            if not chat_entries:
+                del self._chat_entries[entry.chat_id]
+        
+        if self._by_digest.get(entry.digest) == key:
+            del self._by_digest[entry.digest]
+    
+    def _evict(self, chat_id: int, now: float):
+        """Применить ограничения (под блокировкой)"""
+        # Устаревшие записи лежат в начале порядка записи
+        while self._by_age:
+            key = next(iter(self._by_age))
+            if not self._expired(self._entries[key], now):
+                break
+            self._remove(key)
+            self.evictions["ttl"] += 1
+        
+        chat_entries = self._chat_entries.get(chat_id)
+        while chat_entries and len(chat_entries) > self.per_chat:
+            oldest = next(iter(chat_entries))
+            self._remove((chat_id, oldest))
+            self.evictions["chat"] += 1
+        
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions["lru"] += 1
+        
+        while self._entries and self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions["memory"] += 1
+    
+    def __len__(self) -> int:
+        return len(self._entries)
+    
+    def stats(self) -> Dict:
+        """Метрики кэша"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "chats": len(self._chat_entries),
+                "memory_mb": round(self.bytes / 1024 / 1024, 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": dict(self.evictions)
+            }
+
+# ========== ОТПЕЧАТКИ ТЕКСТОВ ==========
+@dataclass
+class FingerprintMatch:
+    chat_id: int
+    message_id: int
+    user_id: int
+    similarity: float
+
+class FingerprintIndex:
+    """Индекс почти-дубликатов по bottom-k MinHash.
+    
+    Отпечаток - k наименьших crc32 от символьных n-грамм нормализованного
+    текста. Похожесть двух текстов оценивается по доле общих значений
+    среди k наименьших в объединении отпечатков (оценка Жаккара).
+    В обратный индекс попадают только `anchors` наименьших значений:
+    у близких текстов они почти всегда пересекаются, а память
+    остаётся ограниченной. Оценивается не больше `max_candidates`
+    текстов, совпавших хотя бы по `min_anchor_hits` якорям.
+    """
+    
+    def __init__(self, max_docs: int = 100000, shingle: int = 5, k: int = 64,
+                 anchors: int = 8, max_postings: int = 64,
+                 min_anchor_hits: int = 2, max_candidates: int = 32):
+        self.max_docs = max_docs
+        self.shingle = shingle
+        self.k = k
+        self.anchors = anchors
+        self.max_postings = max_postings
+        self.min_anchor_hits = min_anchor_hits
+        self.max_candidates = max_candidates
+        
+        # (chat_id, message_id) -> (user_id, отпечаток)
+        self._docs: "OrderedDict[Tuple[int, int], Tuple[int, array]]" = OrderedDict()
+        self._postings: Dict[int, List[Tuple[int, int]]] = {}
+        self._lock = threading.Lock()
+        
+        self.lookups = 0
+        self.scored = 0
+        self.matches = 0
+    
+    def sketch(self, text: str) -> array:
+        """Отпечаток текста (пустой для слишком коротких)"""
+        normalized = normalize_text(text)
+        size = self.shingle
+        hashes = {zlib.crc32(normalized[i:i + size].encode()) for i in range(len(normalized) - size + 1)}
+        return array('I', sorted(heapq.nsmallest(self.k, hashes)))
+    
+    def similarity(self, a: array, b: array) -> float:
+        """Оценка сходства Жаккара по двум отпечаткам.
+        
+        Оба отпечатка отсортированы, поэтому k наименьших значений
+        объединения и общие среди них находятся одним слиянием.
+        """
+        i = j = taken = common = 0
+        len_a, len_b = len(a), len(b)
+        while taken < self.k and i < len_a and j < len_b:
+            x, y = a[i], b[j]
+            if x == y:
+                common += 1
+                i += 1
+                j += 1
+            elif x < y:
+                i += 1
+            else:
+                j += 1
+            taken += 1
+        
+        # Один из отпечатков кончился: остаток другого - только объединение
+        taken = min(self.k, taken + len_a - i + len_b - j)
+        return common / taken if taken else 0.0
+    
+    def add(self, chat_id: int, message_id: int, user_id: int, sketch: array):
+        """Добавить текст в индекс"""
+        if not sketch:
+            return
+        
+        key = (chat_id, message_id)
+        with self._lock:
+            if key in self._docs:
+                self._remove(key)
+            
+            self._docs[key] = (user_id, sketch)
+            for value in sketch[:self.anchors]:
+                posting = self._postings.setdefault(value, [])
+                posting.append(key)
+                if len(posting) > self.max_postings:
+                    del posting[0]
+            
+            while len(self._docs) > self.max_docs:
+                self._remove(next(iter(self._docs)))
+    
+    def _remove(self, key: Tuple[int, int]):
+        """Удалить текст из индекса (под блокировкой)"""
+        _, sketch = self._docs.pop(key)
+        for value in sketch[:self.anchors]:
+            posting = self._postings.get(value)
+            if posting and key in posting:
+                posting.remove(key)
+                if not posting:
+                    del self._postings[value]
+    
+    def find(self, sketch: array, exclude: Tuple[int, int], threshold: float,
+             user_id: Optional[int] = None) -> Optional[FingerprintMatch]:
+        """Самый похожий текст из другого чата или от другого автора"""
+        if not sketch:
+            return None
+        
+        with self._lock:
+            self.lookups += 1
+            # Сколько якорей запроса встретилось у каждого текста
+            hits: Dict[Tuple[int, int], int] = {}
+            for value in sketch[:self.anchors]:
+                for key in self._postings.get(value, ()):
+                    hits[key] = hits.get(key, 0) + 1
+            hits.pop(exclude, None)
+            
+            # Случайные совпадения дают один якорь; у близких текстов их больше
+            min_hits = min(self.min_anchor_hits, len(sketch))
+            candidates = [key for key, count in hits.items() if count >= min_hits]
+            if len(candidates) > self.max_candidates:
+                candidates = heapq.nlargest(self.max_candidates, candidates, key=hits.__getitem__)
+            self.scored += len(candidates)
+            
+            best = None
+            for key in candidates:
+                doc_user_id, doc_sketch = self._docs[key]
+                if key[0] == exclude[0] and doc_user_id == user_id:
+                    continue  # автор повторяет себя в том же чате
+                
+                score = self.similarity(sketch, doc_sketch)
+                if score >= threshold and (best is None or score > best.similarity):
+                    best = FingerprintMatch(key[0], key[1], doc_user_id, score)
+            
+            if best:
+                self.matches += 1
+            return best
+    
+    def __len__(self) -> int:
+        return len(self._docs)
+    
+    def stats(self) -> Dict:
+        """Метрики индекса"""
+        with self._lock:
+            postings = sum(len(p) for p in self._postings.values())
+            return {
+                "docs": len(self._docs),
+                "postings": postings,
+                "memory_mb": round((len(self._docs) * (self.k * 4 + 200) + postings * 60) / 1024 / 1024, 2),
+                "lookups": self.lookups,
+                "scored": self.scored,
+                "matches": self.matches
+            }
+
+# ========== ИНДЕКС USERNAME ==========
+class UsernameIndex:
+    """Индекс username -> user_id без учёта регистра"""
+    
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def key(username: str) -> str:
+        """Ключ индекса: без @ и в нижнем регистре"""
+        return sys.intern(username.lstrip('@').lower())
+    
+    def get(self, username: str) -> Optional[int]:
+        """Найти user_id"""
+        return self._ids.get(self.key(username))
+    
+    def update(self, user_id: int, old: Optional[str], new: Optional[str]):
+        """Перевести пользователя со старого username на новый"""
+        with self._lock:
+            if old:
+                old_key = self.key(old)
+                if self._ids.get(old_key) == user_id:
+                    del self._ids[old_key]
+            if new:
+                self._ids[self.key(new)] = user_id
+    
+    def __len__(self) -> int:
+        return len(self._ids)
+
+class LazyCache:
+    """LRU-кэш записей с подгрузкой по требованию.
+    
+    Промах вызывает load(key) вне замка; если за это время запись уже
+    положил другой поток, остаётся она (изменения на месте не теряются).
+    Отсутствующие в хранилище ключи не кэшируются. При вытеснении
+    вызывается on_evict(key, value).
+    """
+    
+    def __init__(self, load, max_entries: int = 100000, on_evict=None):
+        self.load = load
+        self.max_entries = max(1, max_entries)
+        self.on_evict = on_evict
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        
+        # Счётчики
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        
+        value = self.load(key)
+        if value is None:
+            return default
+        with self._lock:
+            existing = self._data.get(key)
+            if existing is not None:
+                return existing
+            self._insert(key, value)
+        return value
+    
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._insert(key, value)
+    
+    def _insert(self, key, value):
+        self._data[key] = value
+        while len(self._data) > self.max_entries:
+            old_key, old_value = self._data.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict:
+                self.on_evict(old_key, old_value)
+    
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+# ========== ДОВЕРИЕ ПОЛЬЗОВАТЕЛЕЙ ==========
+# Штраф к доверию за событие (затухает с периодом полураспада TRUST_HALF_LIFE_HOURS)
+TRUST_PENALTIES = {
+    AlertType.SCREENSHOT: 10,
+    AlertType.FORWARD_OUT: 5,
+    AlertType.FORWARD_IN: 5,
+    AlertType.COPY: 3,
+    AlertType.COPY_DETECTED: 3
+}
+
+class TrustScorer:
+    """Доверие с затуханием штрафов и топ самых рискованных.
+    
+    Штрафы затухают экспоненциально, поэтому вся история пользователя
+    сводится к одному числу - ключу риска key = log2(R) + t / half_life,
+    где R - сумма затухших штрафов на момент t. Ключ не меняется со
+    временем: текущий риск равен 2^(key - now / half_life), а порядок по
+    ключу совпадает с порядком по текущему риску. Балл считается при
+    чтении, а топ-K обновляется только при событиях: ключ пользователя
+    может лишь расти, и вытесненный из топа туда без события не вернётся.
+    """
+    
+    def __init__(self, half_life: float, top_k: int = 100, base: int = 100):
+        self.half_life = half_life
+        self.top_k = max(1, top_k)
+        self.base = base
+        
+        # Мин-куча (ключ, user_id) топа с устаревшими записями; актуальные - в _top
+        self._heap: List[Tuple[float, int]] = []
+        self._top: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        
+        self.updates = 0
+    
+    def risk(self, key: Optional[float], now: Optional[float] = None) -> float:
+        """Сумма штрафов с учётом затухания"""
+        if key is None:
+            return 0.0
+        if now is None:
+            now = time.time()
+        return 2.0 ** (key - now / self.half_life)
+    
+    def score(self, key: Optional[float], now: Optional[float] = None) -> int:
+        """Доверие: base минус текущий риск"""
+        return max(0, round(self.base - self.risk(key, now)))
+    
+    def penalize(self, key: Optional[float], penalty: float, now: Optional[float] = None) -> float:
+        """Ключ после нового штрафа"""
+        if now is None:
+            now = time.time()
+        return math.log2(self.risk(key, now) + penalty) + now / self.half_life
+    
+    def offer(self, user_id: int, key: float):
+        """Учесть новый ключ пользователя в топе"""
+        with self._lock:
+            self.updates += 1
+            if user_id not in self._top and len(self._top) >= self.top_k:
+                self._prune()
+                if key <= self._heap[0][0]:
+                    return
+                _, evicted = heapq.heappop(self._heap)
+                del self._top[evicted]
+            
+            self._top[user_id] = key
+            heapq.heappush(self._heap, (key, user_id))
+            
+            # Устаревших записей не больше, чем актуальных
+            if len(self._heap) > 2 * self.top_k:
+                self._heap = [(key, user_id) for user_id, key in self._top.items()]
+                heapq.heapify(self._heap)
+    
+    def _prune(self):
+        """Снять устаревшие записи с вершины кучи (под блокировкой)"""
+        while self._heap and self._top.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+    
+    def load(self, rows):
+        """Топ из хранилища: [(user_id, ключ)]"""
+        for user_id, key in rows:
+            self.offer(user_id, key)
+    
+    def top(self, limit: Optional[int] = None, now: Optional[float] = None) -> List[Tuple[int, float]]:
+        """Самые рискованные: [(user_id, текущий риск)] по убыванию"""
+        with self._lock:
+            ranked = sorted(self._top.items(), key=lambda item: item[1], reverse=True)
+        if now is None:
+            now = time.time()
+        return [(user_id, self.risk(key, now)) for user_id, key in ranked[:limit or self.top_k]]
+    
+    def stats(self) -> Dict:
+        return {
+            "tracked": len(self._top),
+            "top_k": self.top_k,
+            "half_life_hours": round(self.half_life / 3600, 2),
+            "updates": self.updates
+        }
+
+# ========== ОТЛОЖЕННАЯ ЗАПИСЬ В БАЗУ ==========
+UPSERT_CHAT_SQL = '''
+    INSERT INTO chats (chat_id, title, username, type, is_our_chat, added_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(chat_id) DO UPDATE SET
+        title = excluded.title,
+        username = excluded.username,
+        type = excluded.type,
+        is_our_chat = excluded.is_our_chat,
+        added_at = excluded.added_at
+'''
+
+UPSERT_USER_SQL = '''
+    INSERT INTO users (user_id, username, first_name, last_seen)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_seen = excluded.last_seen
+'''
+
+UPDATE_USER_STATS_SQL = '''
+    UPDATE users SET
+        screenshot_count = ?,
+        forward_count = ?,
+        copy_count = ?,
+        trust_score = ?,
+        risk_key = ?,
+        last_seen = ?
+    WHERE user_id = ?
+'''
+
+UPSERT_USERNAME_HISTORY_SQL = '''
+    INSERT INTO username_history (user_id, username, first_seen, last_seen)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id, username) DO UPDATE SET last_seen = excluded.last_seen
+'''
+
+UPSERT_FINGERPRINT_SQL = '''
+    INSERT OR REPLACE INTO fingerprints (chat_id, message_id, user_id, created_at, sketch)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+INSERT_EVENT_SQL = '''
+    INSERT INTO events
+    (alert_id, type, severity, user_id, username, chat_id, chat_title,
+     message_id, timestamp, details, confidence, source_chat_id, source_chat_title, created_at, group_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(alert_id) DO NOTHING
+'''
+
+class PersistenceWriter:
+    """Отложенная запись пользователей, чатов и событий.
+    
+    Изменения копятся в памяти: повторные обновления одного пользователя
+    или чата схлопываются в одну строку. Накопленное пишется одним
+    вызовом Storage.write_batch - по достижении batch_size строк или
+    раз в flush_interval секунд. В режиме sync события пишутся сразу.
+    """
+    
+    def __init__(self, storage: "Storage", lock, mode: str = "batched",
+                 batch_size: int = 500, flush_interval: float = 0.2):
+        self.storage = storage
+        self.lock = lock
+        self.sync = mode == "sync"
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        
+        self._cond = threading.Condition()
+        self._chats: Dict[int, tuple] = {}
+        self._users: Dict[int, tuple] = {}
+        self._user_stats: Dict[int, tuple] = {}
+        self._usernames: Dict[Tuple[int, str], tuple] = {}
+        self._fingerprints: Dict[Tuple[int, int], tuple] = {}
+        self._events: List[tuple] = []
+        # Пачка, которая пишется прямо сейчас (видна lookup до коммита)
+        self._inflight: Dict[str, Dict] = {}
+        self._stopping = False
+        # Глубина hold() в текущем потоке
+        self._local = threading.local()
+        
+        # Счётчики
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+    
+    def queue_chat(self, row: tuple):
+        """Поставить в очередь upsert чата (chat_id первым полем)"""
+        with self._cond:
+            self._chats[row[0]] = row
+            self._wake()
+    
+    def queue_user(self, row: tuple):
+        """Поставить в очередь upsert пользователя (user_id первым полем)"""
+        with self._cond:
+            self._users[row[0]] = row
+            self._wake()
+    
+    def queue_user_stats(self, row: tuple):
+        """Поставить в очередь счётчики пользователя (user_id последним полем)"""
+        with self._cond:
+            self._user_stats[row[-1]] = row
+            self._wake()
+    
+    def queue_username(self, row: tuple):
+        """Поставить в очередь запись истории username (user_id, username, ...)"""
+        with self._cond:
+            self._usernames[(row[0], row[1])] = row
+            self._wake()
+    
+    def queue_fingerprint(self, row: tuple):
+        """Поставить в очередь отпечаток текста (chat_id, message_id, ...)"""
+        with self._cond:
+            self._fingerprints[(row[0], row[1])] = row
+            self._wake()
+    
+    def queue_batch(self, chats: list, users: list, usernames: list, fingerprints: list,
+                    events: list, user_stats: list):
+        """Поставить в очередь пачку другого писателя (порядок аргументов как у write_batch)"""
+        with self._cond:
+            for row in chats:
+                self._chats[row[0]] = row
+            for row in users:
+                self._users[row[0]] = row
+            for row in usernames:
+                self._usernames[(row[0], row[1])] = row
+            for row in fingerprints:
+                self._fingerprints[(row[0], row[1])] = row
+            for row in user_stats:
+                self._user_stats[row[-1]] = row
+            self._events.extend(events)
+            self._wake()
+    
+    def queue_event(self, row: tuple):
+        """Поставить в очередь событие"""
+        with self._cond:
+            self._events.append(row)
+            self._wake()
+        
+        if self.sync and not getattr(self._local, "depth", 0):
+            self.flush()
+    
+    @contextmanager
+    def hold(self):
+        """Отложить синхронную запись до конца блока: пачка обновлений - одна транзакция"""
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if depth == 0 and self.sync and self._events:
+                self.flush()
+    
+    def lookup(self, kind: str, key) -> Optional[tuple]:
+        """Незаписанная строка chats/users/user_stats по ключу (None - нет)"""
+        with self._cond:
+            row = getattr(self, f"_{kind}").get(key)
+            if row is None:
+                row = self._inflight.get(kind, {}).get(key)
+        return row
+    
+    def pending(self) -> int:
+        """Количество строк, ожидающих записи"""
+        return (len(self._chats) + len(self._users) + len(self._user_stats)
+                + len(self._usernames) + len(self._fingerprints) + len(self._events))
+    
+    def _wake(self):
+        """Разбудить поток записи, если набралась пачка"""
+        if self.pending() >= self.batch_size:
+            self._cond.notify()
+    
+    def _take(self) -> Tuple[list, list, list, list, list, list]:
+        """Забрать всё накопленное"""
+        with self._cond:
+            batch = (
+                list(self._chats.values()),
+                list(self._users.values()),
+                list(self._usernames.values()),
+                list(self._fingerprints.values()),
+                self._events,
+                list(self._user_stats.values())
+            )
+            self._inflight = {"chats": self._chats, "users": self._users, "user_stats": self._user_stats}
+            self._chats = {}
+            self._users = {}
+            self._usernames = {}
+            self._fingerprints = {}
+            self._events = []
+            self._user_stats = {}
+        return batch
+    
+    def _restore(self, chats: list, users: list, usernames: list, fingerprints: list,
+                 events: list, user_stats: list):
+        """Вернуть незаписанную пачку (новые изменения важнее старых)"""
+        with self._cond:
+            for row in chats:
+                self._chats.setdefault(row[0], row)
+            for row in users:
+                self._users.setdefault(row[0], row)
+            for row in usernames:
+                self._usernames.setdefault((row[0], row[1]), row)
+            for row in fingerprints:
+                self._fingerprints.setdefault((row[0], row[1]), row)
+            for row in user_stats:
+                self._user_stats.setdefault(row[-1], row)
+            self._events[:0] = events
+    
+    def flush(self):
+        """Записать всё накопленное одной пачкой"""
+        # Пачка забирается под замком базы: параллельный flush (режим sync) не подменит _inflight
+        with self.lock:
+            chats, users, usernames, fingerprints, events, user_stats = self._take()
+            total = (len(chats) + len(users) + len(usernames) + len(fingerprints)
+                     + len(events) + len(user_stats))
+            if not total:
+                return
+            
+            started = time.perf_counter()
+            try:
+                self.storage.write_batch(chats, users, usernames, fingerprints, events, user_stats)
+            except (sqlite3.Error, OSError) as e:
+                self.errors += 1
+                logger.error(f"DB flush error: {e}")
+                self._restore(chats, users, usernames, fingerprints, events, user_stats)
+                return
+            finally:
+                with self._cond:
+                    self._inflight = {}
+        
+        elapsed = time.perf_counter() - started
+        METRICS.observe("tgmon_sqlite_commit_seconds", (), elapsed)
+        self.flushes += 1
+        self.rows_written += total
+        self.last_flush_ms = elapsed * 1000
+    
+    def _run(self):
+        """Фоновый цикл записи"""
+        while True:
+            with self._cond:
+                if not self._stopping and self.pending() < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                stopping = self._stopping
+            
+            self.flush()
+            if stopping:
+                break
+    
+    def stats(self) -> Dict:
+        """Метрики записи"""
+        return {
+            "mode": "sync" if self.sync else "batched",
+            "pending": self.pending(),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "errors": self.errors,
+            "last_flush_ms": round(self.last_flush_ms, 2)
+        }
+    
+    def close(self):
+        """Остановить поток и записать остаток"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        self._thread.join(10)
+        self.flush()
+
+# ========== АГРЕГАТЫ СОБЫТИЙ ==========
+# Ключи общей статистики по типам событий
+TYPE_TOTALS = {
+    AlertType.SCREENSHOT.value: "screenshots",
+    AlertType.FORWARD_OUT.value: "forwards",
+    AlertType.FORWARD_IN.value: "forwards",
+    AlertType.COPY.value: "copies",
+    AlertType.COPY_DETECTED.value: "copies"
+}
+
+class EventMetrics:
+    """Счётчики событий, обновляемые за O(1) на событие.
+    
+    Хранит итоги по типу, важности и чату и кольцо корзин по
+    bucket_seconds для скользящих окон. Снимок для отдачи строится
+    только после изменения счётчиков или смены корзины.
+    """
+    
+    def __init__(self, bucket_seconds: int = 300, history_hours: int = 24, top_chats: int = 10):
+        self.bucket_seconds = bucket_seconds
+        self.buckets_per_hour = max(1, 3600 // bucket_seconds)
+        self.history_hours = history_hours
+        self.history = self.buckets_per_hour * history_hours
+        self.top_chats = top_chats
+        
+        self.by_type: Counter = Counter()
+        self.by_severity: Counter = Counter()
+        self.by_chat: Counter = Counter()
+        # номер корзины -> счётчик по типам
+        self._buckets: Dict[int, Counter] = {}
+        
+        self.version = 0
+        self._lock = threading.Lock()
+        self._snapshot: Optional[Tuple[Tuple[int, int], Dict]] = None
+    
+    def _bucket(self, ts: float) -> int:
+        return int(ts // self.bucket_seconds)
+    
+    def record(self, event_type: str, severity: str, chat_id: int, ts: Optional[float] = None, count: int = 1):
+        """Учесть событие"""
+        bucket = self._bucket(time.time() if ts is None else ts)
+        with self._lock:
+            self.by_type[event_type] += count
+            self.by_severity[severity] += count
+            self.by_chat[chat_id] += count
+            
+            oldest = self._bucket(time.time()) - self.history + 1
+            if bucket >= oldest:
+                counts = self._buckets.get(bucket)
+                if counts is None:
+                    counts = self._buckets[bucket] = Counter()
+                    # Новая корзина вытесняет вышедшие из окна
+                    for stale in [b for b in self._buckets if b < oldest]:
+                        del self._buckets[stale]
+                counts[event_type] += count
+            self.version += 1
+    
+    def load(self, storage: "Storage"):
+        """Восстановить счётчики из хранилища событий (один раз при старте)"""
+        since = (self._bucket(time.time()) - self.history + 1) * self.bucket_seconds
+        for event_type, severity, chat_id, count in storage.event_counts():
+            with self._lock:
+                self.by_type[event_type] += count
+                self.by_severity[severity] += count
+                self.by_chat[chat_id] += count
+        for bucket, event_type, count in storage.event_buckets(self.bucket_seconds, since):
+            self._buckets.setdefault(bucket, Counter())[event_type] += count
+        self.version += 1
+    
+    def _window(self, current: int, size: int) -> Counter:
+        total = Counter()
+        for bucket in range(current - size + 1, current + 1):
+            total.update(self._buckets.get(bucket, ()))
+        return total
+    
+    def snapshot(self) -> Tuple[Tuple[int, int], Dict]:
+        """Ключ снимка (версия, корзина) и сам снимок"""
+        current = self._bucket(time.time())
+        key = (self.version, current)
+        cached = self._snapshot
+        if cached is not None and cached[0] == key:
+            return cached
+        
+        with self._lock:
+            totals = Counter()
+            for event_type, count in self.by_type.items():
+                totals[TYPE_TOTALS.get(event_type, "other")] += count
+            
+            hourly = []
+            for hour in range(self.history // self.buckets_per_hour - 1, -1, -1):
+                end = current - hour * self.buckets_per_hour
+                hourly.append(sum(self._window(end, self.buckets_per_hour).values()))
+            
+            data = {
+                "totals": dict(totals),
+                "by_type": dict(self.by_type),
+                "by_severity": dict(self.by_severity),
+                "top_chats": [
+                    {"chat_id": chat_id, "events": count}
+                    for chat_id, count in self.by_chat.most_common(self.top_chats)
+                ],
+                "last_hour": dict(self._window(current, self.buckets_per_hour)),
+                # Окно истории задаётся METRICS_HISTORY_HOURS
+                "last_window": dict(self._window(current, self.history)),
+                "window_hours": self.history_hours,
+                "hourly": hourly
+            }
+        
+        self._snapshot = (key, data)
+        return self._snapshot
+
+# ========== ИСТОРИЯ СОБЫТИЙ ==========
+EVENT_COLUMNS = (
+    "id", "alert_id", "type", "severity", "user_id", "username", "chat_id", "chat_title",
+    "message_id", "timestamp", "details", "confidence", "source_chat_id", "source_chat_title",
+    "created_at", "group_id"
+)
+
+# Чтение строк событий: username и chat_title старых событий вынесены в event_strings
+EVENT_SELECT = ", ".join(
+    f"COALESCE({column}, (SELECT value FROM event_strings WHERE string_id = {column}_ref))"
+    if column in ("username", "chat_title") else column
+    for column in EVENT_COLUMNS
+)
+
+@dataclass
+class EventRecord:
+    """Строка истории событий; details декодируется только по запросу"""
+    id: int
+    alert_id: str
+    type: str
+    severity: str
+    user_id: int
+    username: Optional[str]
+    chat_id: int
+    chat_title: Optional[str]
+    message_id: int
+    timestamp: str
+    raw_details: Optional[str]
+    confidence: int
+    source_chat_id: Optional[int]
+    source_chat_title: Optional[str]
+    created_at: float
+    group_id: Optional[str]
+    
+    def details(self) -> Dict:
+        """Декодировать details"""
+        if not self.raw_details:
+            return {}
+        try:
+            return json.loads(self.raw_details)
+        except ValueError:
+            return {}
+    
+    def to_dict(self, with_details: bool = False) -> Dict:
+        data = {
+            # Поля таблицы на дашборде
+            "time": self.timestamp,
+            "type": self.type,
+            "user": self.username or self.user_id,
+            "severity": self.severity,
+            
+            "id": self.id,
+            "alert_id": self.alert_id,
+            "user_id": self.user_id,
+            "chat_id": self.chat_id,
+            "chat_title": self.chat_title,
+            "message_id": self.message_id,
+            "confidence": self.confidence,
+            "source_chat_id": self.source_chat_id,
+            "source_chat_title": self.source_chat_title,
+            "created_at": self.created_at,
+            "group_id": self.group_id
+        }
+        if with_details:
+            data["details"] = self.details()
+        return data
+
+@dataclass
+class EventPage:
+    events: List[EventRecord]
+    next_cursor: Optional[str]
+
+def _enum_value(enum_cls, value: Optional[str]) -> Optional[str]:
+    """Значение enum по имени (SCREENSHOT) или по самому значению"""
+    if value is None:
+        return None
+    if value in enum_cls.__members__:
+        return enum_cls[value].value
+    if value in {item.value for item in enum_cls}:
+        return value
+    raise ValueError(f"unknown {enum_cls.__name__}: {value}")
+
+class EventHistory:
+    """Постраничное чтение таблицы событий.
+    
+    Страницы идут от новых к старым по ключу (created_at, id): курсор -
+    ключ последней строки, так что каждая страница - один проход по
+    индексу (фильтр, created_at) без OFFSET. Чтение идёт через отдельные
+    соединения на поток и не ждёт пакетную запись (WAL).
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+    
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = open_database(self.path)
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+    
+    @staticmethod
+    def encode_cursor(record: EventRecord) -> str:
+        return f"{record.created_at!r}:{record.id}"
+    
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[float, int]:
+        created_at, _, event_id = cursor.partition(":")
+        return float(created_at), int(event_id)
+    
+    def build_query(self, user_id: Optional[int] = None, chat_id: Optional[int] = None,
+                    event_type: Optional[str] = None, severity: Optional[str] = None,
+                    since: Optional[float] = None, until: Optional[float] = None,
+                    cursor: Optional[str] = None, limit: int = 50) -> Tuple[str, list]:
+        """SQL и параметры одной страницы"""
+        clauses, params = [], []
+        if user_id is not None:
+            clauses.append("user_id = ?")
+            params.append(user_id)
+        if chat_id is not None:
+            clauses.append("chat_id = ?")
+            params.append(chat_id)
+        if event_type is not None:
+            clauses.append("type = ?")
+            params.append(_enum_value(AlertType, event_type))
+        if severity is not None:
+            clauses.append("severity = ?")
+            params.append(_enum_value(Severity, severity))
+        if since is not None:
+            clauses.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("created_at < ?")
+            params.append(until)
+        if cursor:
+            clauses.append("(created_at, id) < (?, ?)")
+            params.extend(self.decode_cursor(cursor))
+        
+        sql = f"SELECT {EVENT_SELECT} FROM events"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        params.append(limit)
+        return sql, params
+    
+    def page(self, limit: int = 50, **filters) -> EventPage:
+        """Страница событий от новых к старым"""
+        sql, params = self.build_query(limit=limit + 1, **filters)
+        rows = self._conn().execute(sql, params).fetchall()
+        events = [EventRecord(*row) for row in rows[:limit]]
+        next_cursor = self.encode_cursor(events[-1]) if len(rows) > limit else None
+        return EventPage(events, next_cursor)
+
+# ========== ХРАНИЛИЩЕ ==========
+# Периоды свёрток вынесенных событий
+ROLLUP_PERIODS = (("hour", 3600), ("day", 86400))
+
+UPSERT_ROLLUP_SQL = '''
+    INSERT INTO event_rollups (period, bucket, chat_id, user_id, type, severity, count)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(period, bucket, chat_id, user_id, type, severity) DO UPDATE SET count = count + excluded.count
+'''
+
+ROLLUP_EVENTS_SQL = '''
+    INSERT INTO event_rollups (period, bucket, chat_id, user_id, type, severity, count)
+    SELECT ?, CAST(created_at / ? AS INTEGER) * ?, chat_id, user_id, type, severity, COUNT(*)
+    FROM events WHERE created_at < ? AND created_at <= ?
+    GROUP BY 2, chat_id, user_id, type, severity
+    ON CONFLICT(period, bucket, chat_id, user_id, type, severity) DO UPDATE SET count = count + excluded.count
+'''
+
+UPSERT_STATE_SQL = "INSERT INTO state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value"
+
+def _event_line(values: tuple) -> bytes:
+    """Строка журнала/архива: JSON-массив в порядке EVENT_COLUMNS"""
+    return (json.dumps(list(values), ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+class Storage:
+    """Хранилище чатов, пользователей, отпечатков, событий и счётчиков.
+    
+    Запись приходит пачками из PersistenceWriter: строки в порядке
+    параметров *_SQL выше, write_batch вызывается под замком базы.
+    Пользователи и чаты читаются по одному (get_*) по требованию,
+    события - из API (event_page), счётчики - при старте (event_counts).
+    Методы обслуживания вызывает MaintenanceScheduler: каждый делает
+    одну порцию работы и возвращает её размер (0 - делать нечего).
+    """
+    
+    name = "base"
+    
+    def write_batch(self, chats: list, users: list, usernames: list, fingerprints: list,
+                    events: list, user_stats: list):
+        raise NotImplementedError
+    
+    def get_user(self, user_id: int) -> Optional[UserData]:
+        raise NotImplementedError
+    
+    def get_chat(self, chat_id: int) -> Optional[ChatData]:
+        raise NotImplementedError
+    
+    def our_chat_ids(self) -> List[int]:
+        raise NotImplementedError
+    
+    def list_chats(self, our: bool, limit: int) -> List[ChatData]:
+        raise NotImplementedError
+    
+    def count_users(self) -> int:
+        raise NotImplementedError
+    
+    def count_chats(self, our: Optional[bool] = None) -> int:
+        raise NotImplementedError
+    
+    def load_fingerprints(self, limit: int) -> List[Tuple[int, int, int, array]]:
+        """Самые свежие отпечатки, от старых к новым"""
+        raise NotImplementedError
+    
+    def prune_fingerprints(self, keep: int):
+        raise NotImplementedError
+    
+    def find_user_id(self, username: str) -> Optional[int]:
+        raise NotImplementedError
+    
+    def top_risk(self, limit: int) -> List[Tuple[int, float]]:
+        """Пользователи с наибольшим ключом риска: [(user_id, ключ)]"""
+        raise NotImplementedError
+    
+    def event_counts(self) -> List[Tuple[str, str, int, int]]:
+        """Число событий по (тип, важность, чат)"""
+        raise NotImplementedError
+    
+    def event_buckets(self, bucket_seconds: int, since: float) -> List[Tuple[int, str, int]]:
+        """Число событий по (корзина времени, тип) начиная с since"""
+        raise NotImplementedError
+    
+    def event_page(self, limit: int = 50, **filters) -> EventPage:
+        """Страница событий от новых к старым (фильтры как у EventHistory)"""
+        raise NotImplementedError
+    
+    def rollups(self, period: str = "day", chat_id: Optional[int] = None, user_id: Optional[int] = None,
+                since: Optional[float] = None, until: Optional[float] = None, limit: int = 1000) -> List[Dict]:
+        """Свёртки вынесенных событий от новых к старым"""
+        raise NotImplementedError
+    
+    def expire_events(self, before: float, limit: int) -> int:
+        """Свернуть в event_rollups и вынести события старше before"""
+        raise NotImplementedError
+    
+    def prune_rollups(self, period: str, before: float, limit: int) -> int:
+        """Удалить свёртки периода period старше before"""
+        raise NotImplementedError
+    
+    def compact_events(self, before: float, limit: int) -> int:
+        """Вынести повторяющиеся строки событий старше before в справочник"""
+        raise NotImplementedError
+    
+    def vacuum(self, pages: int) -> int:
+        """Вернуть системе до pages свободных страниц"""
+        raise NotImplementedError
+    
+    def stats(self) -> Dict:
+        return {"backend": self.name}
+    
+    def close(self):
+        pass
+
+class SQLiteStorage(Storage):
+    """Всё в одной базе SQLite: пачка пишется одной транзакцией.
+    
+    Вынесенные события при заданном archive_path дописываются в
+    archive_path/events-ГГГГММДД.jsonl.gz в формате журнала событий.
+    """
+    
+    name = "sqlite"
+    COMPACTED_KEY = "events_compacted_until"
+    
+    def __init__(self, conn: sqlite3.Connection, lock, path: str, archive_path: str = ""):
+        self.conn = conn
+        self.lock = lock
+        self.history = EventHistory(path)
+        self.archive_path = archive_path
+        if archive_path:
+            os.makedirs(archive_path, exist_ok=True)
+    
+    def write_batch(self, chats: list, users: list, usernames: list, fingerprints: list,
+                    events: list, user_stats: list):
+        with self.conn:
+            if chats:
+                self.conn.executemany(UPSERT_CHAT_SQL, chats)
+            if users:
+                self.conn.executemany(UPSERT_USER_SQL, users)
+            if usernames:
+                self.conn.executemany(UPSERT_USERNAME_HISTORY_SQL, usernames)
+            if fingerprints:
+                self.conn.executemany(UPSERT_FINGERPRINT_SQL, fingerprints)
+            if events:
+                self.conn.executemany(INSERT_EVENT_SQL, events)
+            if user_stats:
+                self.conn.executemany(UPDATE_USER_STATS_SQL, user_stats)
+    
+    CHAT_COLUMNS = "chat_id, title, username, type, is_our_chat, added_at, message_count"
+    USER_COLUMNS = ("user_id, username, first_name, trust_score, "
+                    "screenshot_count, forward_count, copy_count, last_seen, risk_key")
+    
+    @staticmethod
+    def _chat(row: tuple) -> ChatData:
+        return ChatData(
+            chat_id=row[0],
+            title=_intern(row[1]),
+            username=_intern(row[2]),
+            type=_intern(row[3]),
+            is_our_chat=bool(row[4]),
+            added_at=_epoch(row[5]),
+            message_count=row[6]
+        )
+    
+    @staticmethod
+    def _user(row: tuple) -> UserData:
+        return UserData(
+            user_id=row[0],
+            username=_intern(row[1]),
+            first_name=_intern(row[2]),
+            trust_score=row[3],
+            screenshot_count=row[4],
+            forward_count=row[5],
+            copy_count=row[6],
+            last_seen=_epoch(row[7]),
+            risk_key=row[8]
+        )
+    
+    def get_user(self, user_id: int) -> Optional[UserData]:
+        with self.lock:
+            row = self.conn.execute(f"SELECT {self.USER_COLUMNS} FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return self._user(row) if row else None
+    
+    def get_chat(self, chat_id: int) -> Optional[ChatData]:
+        with self.lock:
+            row = self.conn.execute(f"SELECT {self.CHAT_COLUMNS} FROM chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        return self._chat(row) if row else None
+    
+    def our_chat_ids(self) -> List[int]:
+        # Частичный индекс idx_chats_our: не читает остальные чаты
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT chat_id FROM chats WHERE is_our_chat = 1")]
+    
+    def list_chats(self, our: bool, limit: int) -> List[ChatData]:
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT {self.CHAT_COLUMNS} FROM chats WHERE is_our_chat = ? ORDER BY added_at DESC LIMIT ?",
+                (1 if our else 0, limit)
+            ).fetchall()
+        return [self._chat(row) for row in rows]
+    
+    def count_users(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    
+    def count_chats(self, our: Optional[bool] = None) -> int:
+        with self.lock:
+            if our is None:
+                return self.conn.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM chats WHERE is_our_chat = ?", (1 if our else 0,)
+            ).fetchone()[0]
+    
+    def load_fingerprints(self, limit: int) -> List[Tuple[int, int, int, array]]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT chat_id, message_id, user_id, sketch FROM fingerprints ORDER BY created_at DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        
+        result = []
+        for chat_id, message_id, user_id, blob in reversed(rows):
+            sketch = array('I')
+            sketch.frombytes(blob)
+            result.append((chat_id, message_id, user_id, sketch))
+        return result
+    
+    def prune_fingerprints(self, keep: int):
+        with self.lock, self.conn:
+            self.conn.execute('''
+                DELETE FROM fingerprints WHERE created_at <
+                (SELECT created_at FROM fingerprints ORDER BY created_at DESC LIMIT 1 OFFSET ?)
+            ''', (keep - 1,))
+    
+    def find_user_id(self, username: str) -> Optional[int]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT user_id FROM users WHERE lower(username) = ? ORDER BY last_seen DESC LIMIT 1",
+                (UsernameIndex.key(username),)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def top_risk(self, limit: int) -> List[Tuple[int, float]]:
+        # Обход индекса idx_users_risk с конца, без просмотра таблицы
+        with self.lock:
+            return self.conn.execute(
+                "SELECT user_id, risk_key FROM users WHERE risk_key IS NOT NULL ORDER BY risk_key DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+    
+    def event_counts(self) -> List[Tuple[str, str, int, int]]:
+        # Вынесенные события учтены в дневных свёртках
+        with self.lock:
+            return self.conn.execute('''
+                SELECT type, severity, chat_id, SUM(count) FROM (
+                    SELECT type, severity, chat_id, COUNT(*) AS count FROM events GROUP BY 1, 2, 3
+                    UNION ALL
+                    SELECT type, severity, chat_id, SUM(count) FROM event_rollups WHERE period = 'day' GROUP BY 1, 2, 3
+                ) GROUP BY 1, 2, 3
+            ''').fetchall()
+    
+    def event_buckets(self, bucket_seconds: int, since: float) -> List[Tuple[int, str, int]]:
+        with self.lock:
+            return self.conn.execute(
+                "SELECT CAST(created_at / ? AS INTEGER), type, COUNT(*) FROM events WHERE created_at >= ? GROUP BY 1, 2",
+                (bucket_seconds, since)
+            ).fetchall()
+    
+    def event_page(self, limit: int = 50, **filters) -> EventPage:
+        return self.history.page(limit=limit, **filters)
+    
+    def rollups(self, period: str = "day", chat_id: Optional[int] = None, user_id: Optional[int] = None,
+                since: Optional[float] = None, until: Optional[float] = None, limit: int = 1000) -> List[Dict]:
+        if period not in dict(ROLLUP_PERIODS):
+            raise ValueError(f"unknown period: {period}")
+        
+        clauses, params = ["period = ?"], [period]
+        for clause, value in (("chat_id = ?", chat_id), ("user_id = ?", user_id),
+                              ("bucket >= ?", since), ("bucket < ?", until)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        params.append(limit)
+        
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT bucket, chat_id, user_id, type, severity, count FROM event_rollups"
+                f" WHERE {' AND '.join(clauses)} ORDER BY bucket DESC LIMIT ?",
+                params
+            ).fetchall()
+        return [
+            {"bucket": bucket, "chat_id": chat_id, "user_id": user_id, "type": event_type,
+             "severity": severity, "count": count}
+            for bucket, chat_id, user_id, event_type, severity, count in rows
+        ]
+    
+    def _batch_end(self, where: str, params: tuple, limit: int) -> Optional[float]:
+        """created_at limit-й по времени строки условия (None - строк меньше)"""
+        row = self.conn.execute(
+            f"SELECT created_at FROM events WHERE {where} ORDER BY created_at LIMIT 1 OFFSET ?",
+            (*params, limit - 1)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def _archive_rows(self, where: str, params: tuple):
+        rows = self.conn.execute(f"SELECT {EVENT_SELECT} FROM events WHERE {where}", params).fetchall()
+        if not rows:
+            return
+        path = os.path.join(self.archive_path, f"events-{datetime.now():%Y%m%d}.jsonl.gz")
+        # Каждая порция - отдельный член gzip, файл читается целиком как обычно
+        with gzip.open(path, "ab") as f:
+            f.write(b"".join(_event_line(row) for row in rows))
+    
+    def expire_events(self, before: float, limit: int) -> int:
+        with self.lock:
+            upto = self._batch_end("created_at < ?", (before,), limit)
+            upto = before if upto is None else upto
+            where, params = "created_at < ? AND created_at <= ?", (before, upto)
+            
+            if self.archive_path:
+                self._archive_rows(where, params)
+            with self.conn:
+                for period, seconds in ROLLUP_PERIODS:
+                    self.conn.execute(ROLLUP_EVENTS_SQL, (period, seconds, seconds, *params))
+                return self.conn.execute(f"DELETE FROM events WHERE {where}", params).rowcount
+    
+    def prune_rollups(self, period: str, before: float, limit: int) -> int:
+        with self.lock, self.conn:
+            return self.conn.execute('''
+                DELETE FROM event_rollups WHERE rowid IN
+                (SELECT rowid FROM event_rollups WHERE period = ? AND bucket < ? LIMIT ?)
+            ''', (period, before, limit)).rowcount
+    
+    def compact_events(self, before: float, limit: int) -> int:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM state WHERE key = ?", (self.COMPACTED_KEY,)).fetchone()
+            start = float(row[0]) if row else 0.0
+            if start >= before:
+                return 0
+            
+            upto = self._batch_end("created_at > ? AND created_at < ?", (start, before), limit)
+            upto = before if upto is None else upto
+            where, params = "created_at > ? AND created_at <= ? AND created_at < ?", (start, upto, before)
+            
+            # Новые события пишутся как есть; строки уходят в справочник, когда событие остыло
+            compacted = 0
+            with self.conn:
+                for column in ("username", "chat_title"):
+                    self.conn.execute(
+                        f"INSERT OR IGNORE INTO event_strings (value) "
+                        f"SELECT DISTINCT {column} FROM events WHERE {where} AND {column} IS NOT NULL",
+                        params
+                    )
+                    compacted = max(compacted, self.conn.execute(
+                        f"UPDATE events SET {column}_ref = "
+                        f"(SELECT string_id FROM event_strings WHERE value = events.{column}), {column} = NULL "
+                        f"WHERE {where} AND {column} IS NOT NULL",
+                        params
+                    ).rowcount)
+                self.conn.execute(UPSERT_STATE_SQL, (self.COMPACTED_KEY, repr(min(upto, before))))
+            return compacted
+    
+    def vacuum(self, pages: int) -> int:
+        with self.lock:
+            free = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free:
+                return 0
+            self.conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+            return free - self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+class EventLog:
+    """Журнал событий: только дозапись в сегменты с ротацией по размеру.
+    
+    Строка сегмента - JSON-массив в порядке EVENT_COLUMNS, id событий
+    идут подряд. Сегмент назван по id первого события
+    (events-000000000001.jsonl); закрытые сегменты переносятся в
+    archive/ целиком. В памяти - колонки (id, время, пользователь, чат,
+    тип, важность, смещение) и списки id по пользователю, чату, типу и
+    важности: страница истории читает с диска только свои строки.
+    Время в индексе не убывает (перестановки внутри пачки сглаживаются),
+    поэтому since/until ищутся бинарным поиском.
+    """
+    
+    PREFIX = "events-"
+    SUFFIX = ".jsonl"
+    
+    def __init__(self, path: str, segment_bytes: int = 64 * 1024 * 1024, durable: bool = False):
+        self.path = path
+        self.archive_path = os.path.join(path, "archive")
+        self.segment_bytes = max(1, segment_bytes)
+        self.durable = durable
+        os.makedirs(self.archive_path, exist_ok=True)
+        
+        self._lock = threading.RLock()
+        # Колонки индекса: позиция - порядковый номер события в живых сегментах
+        self._ids = array('q')
+        self._times = array('d')
+        self._users = array('q')
+        self._chats = array('q')
+        self._types = array('B')
+        self._severities = array('B')
+        self._offsets = array('Q')
+        # Ключ -> возрастающие id событий
+        self._by_user: Dict[int, array] = {}
+        self._by_chat: Dict[int, array] = {}
+        self._by_type: Dict[int, array] = {}
+        self._by_severity: Dict[int, array] = {}
+        # Коды строк типа и важности
+        self._codes: Dict[str, int] = {}
+        self._names: List[str] = []
+        # Сегменты: id первого события и путь
+        self._segment_ids: List[int] = []
+        self._segment_paths: List[str] = []
+        
+        self._next_id = 1
+        self._last_time = 0.0
+        self._file = None
+        self._size = 0
+        
+        # Счётчики
+        self.appended = 0
+        self.archived_segments = 0
+        
+        self._recover()
+    
+    # ---------- Запись ----------
+    
+    def _recover(self):
+        """Построить индекс по сегментам на диске, отрезать недописанный хвост"""
+        names = sorted(
+            name for name in os.listdir(self.path)
+            if name.startswith(self.PREFIX) and name.endswith(self.SUFFIX)
+        )
+        for name in names:
+            path = os.path.join(self.path, name)
+            self._segment_ids.append(int(name[len(self.PREFIX):-len(self.SUFFIX)]))
+            self._segment_paths.append(path)
+            
+            valid = self._scan(path)
+            if valid < os.path.getsize(path):
+                logger.warning(f"⚠️ Журнал событий: обрезан недописанный хвост {name}")
+                with open(path, "r+b") as f:
+                    f.truncate(valid)
+        
+        if self._segment_paths:
+            self._file = open(self._segment_paths[-1], "ab", buffering=0)
+            self._size = os.path.getsize(self._segment_paths[-1])
+        else:
+            self._open_segment()
+        
+        if self._ids:
+            logger.info(f"📚 Журнал событий: {len(self._ids)} событий в {len(self._segment_paths)} сегментах")
+    
+    def _scan(self, path: str) -> int:
+        """Проиндексировать сегмент; вернуть длину целой части"""
+        offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self._index(record[0], record[14], record[4], record[6], record[2], record[3], offset)
+                offset += len(line)
+        return offset
+    
+    def _code(self, name: str) -> int:
+        code = self._codes.get(name)
+        if code is None:
+            code = self._codes[name] = len(self._names)
+            self._names.append(name)
+        return code
+    
+    def _index(self, event_id: int, created_at: Optional[float], user_id: Optional[int],
+               chat_id: Optional[int], event_type: str, severity: str, offset: int):
+        created_at = max(created_at or 0.0, self._last_time)
+        self._last_time = created_at
+        type_code = self._code(event_type)
+        severity_code = self._code(severity)
+        
+        self._ids.append(event_id)
+        self._times.append(created_at)
+        self._users.append(user_id or 0)
+        self._chats.append(chat_id or 0)
+        self._types.append(type_code)
+        self._severities.append(severity_code)
+        self._offsets.append(offset)
+        
+        for postings, key in ((self._by_user, user_id or 0), (self._by_chat, chat_id or 0),
+                              (self._by_type, type_code), (self._by_severity, severity_code)):
+            ids = postings.get(key)
+            if ids is None:
+                ids = postings[key] = array('q')
+            ids.append(event_id)
+        
+        self._next_id = event_id + 1
+    
+    def _open_segment(self):
+        path = os.path.join(self.path, f"{self.PREFIX}{self._next_id:012d}{self.SUFFIX}")
+        self._file = open(path, "ab", buffering=0)
+        self._size = 0
+        self._segment_ids.append(self._next_id)
+        self._segment_paths.append(path)
+    
+    def append(self, rows: List[tuple]):
+        """Дописать события (строки в порядке INSERT_EVENT_SQL) одной записью"""
+        if not rows:
+            return
+        
+        with self._lock:
+            # Сегмент меняется только между пачками: пачка целиком в одном файле
+            if self._size >= self.segment_bytes:
+                self._file.close()
+                self._open_segment()
+            
+            start = offset = self._size
+            event_id = self._next_id
+            chunks, entries = [], []
+            for row in rows:
+                line = _event_line((event_id, *row))
+                chunks.append(line)
+                entries.append((event_id, row, offset))
+                offset += len(line)
+                event_id += 1
+            
+            data = memoryview(b"".join(chunks))
+            try:
+                while data:
+                    data = data[self._file.write(data):]
+                if self.durable:
+                    os.fsync(self._file.fileno())
+            except OSError:
+                # Недописанная пачка не должна остаться в журнале: writer повторит её
+                self._file.truncate(start)
+                raise
+            
+            self._size = offset
+            for event_id, row, offset in entries:
+                self._index(event_id, row[13], row[3], row[5], row[1], row[2], offset)
+            self.appended += len(rows)
+    
+    # ---------- Чтение ----------
+    
+    def _segment_path(self, event_id: int) -> str:
+        return self._segment_paths[bisect_right(self._segment_ids, event_id) - 1]
+    
+    def _read(self, locations: List[Tuple[str, int]]) -> List[EventRecord]:
+        """Прочитать строки по (сегмент, смещение)"""
+        records = []
+        handles = {}
+        try:
+            for path, offset in locations:
+                f = handles.get(path)
+                if f is None:
+                    try:
+                        f = handles[path] = open(path, "rb")
+                    except FileNotFoundError:
+                        # Сегмент успели перенести в архив
+                        continue
+                f.seek(offset)
+                records.append(EventRecord(*json.loads(f.readline())))
+        finally:
+            for f in handles.values():
+                f.close()
+        return records
+    
+    def page(self, limit: int = 50, user_id: Optional[int] = None, chat_id: Optional[int] = None,
+             event_type: Optional[str] = None, severity: Optional[str] = None,
+             since: Optional[float] = None, until: Optional[float] = None,
+             cursor: Optional[str] = None) -> EventPage:
+        """Страница событий от новых к старым; курсор совместим по формату с EventHistory"""
+        type_name = _enum_value(AlertType, event_type)
+        severity_name = _enum_value(Severity, severity)
+        cursor_id = EventHistory.decode_cursor(cursor)[1] if cursor else None
+        
+        with self._lock:
+            filters = []
+            for postings, column, key in ((self._by_user, self._users, user_id),
+                                          (self._by_chat, self._chats, chat_id),
+                                          (self._by_type, self._types, type_name),
+                                          (self._by_severity, self._severities, severity_name)):
+                if key is None:
+                    continue
+                if isinstance(key, str):
+                    key = self._codes.get(key)
+                ids = postings.get(key)
+                if ids is None:
+                    return EventPage([], None)
+                filters.append((ids, column, key))
+            
+            lo = bisect_left(self._times, since) if since is not None else 0
+            hi = bisect_left(self._times, until) if until is not None else len(self._ids)
+            if cursor_id is not None:
+                hi = min(hi, bisect_left(self._ids, cursor_id))
+            
+            found = []
+            if lo < hi and filters:
+                # Идём по самому короткому списку, остальные фильтры - по колонкам
+                ids = min(filters, key=lambda item: len(item[0]))[0]
+                low_id = self._ids[lo]
+                j = bisect_right(ids, self._ids[hi - 1])
+                while j and len(found) <= limit:
+                    j -= 1
+                    if ids[j] < low_id:
+                        break
+                    pos = bisect_left(self._ids, ids[j])
+                    if all(column[pos] == key for _, column, key in filters):
+                        found.append(pos)
+            elif lo < hi:
+                found = list(range(hi - 1, max(lo, hi - limit - 1) - 1, -1))
+            
+            locations = [(self._segment_path(self._ids[pos]), self._offsets[pos]) for pos in found]
+        
+        events = self._read(locations)[:limit]
+        next_cursor = EventHistory.encode_cursor(events[-1]) if len(found) > limit and events else None
+        return EventPage(events, next_cursor)
+    
+    def counts(self) -> List[Tuple[str, str, int, int]]:
+        with self._lock:
+            counts = Counter(zip(self._types, self._severities, self._chats))
+            names = list(self._names)
+        return [
+            (names[type_code], names[severity_code], chat_id, count)
+            for (type_code, severity_code, chat_id), count in counts.items()
+        ]
+    
+    def buckets(self, bucket_seconds: int, since: float) -> List[Tuple[int, str, int]]:
+        with self._lock:
+            lo = bisect_left(self._times, since)
+            counts = Counter(
+                (int(self._times[pos] // bucket_seconds), self._types[pos])
+                for pos in range(lo, len(self._times))
+            )
+            names = list(self._names)
+        return [(bucket, names[type_code], count) for (bucket, type_code), count in counts.items()]
+    
+    # ---------- Архив ----------
+    
+    def expired_rollups(self, before: float) -> Optional[Tuple[int, List[tuple]]]:
+        """Свёртки (строки UPSERT_ROLLUP_SQL) старейшего закрытого сегмента,
+        если все его события старше before: (id первого события, строки)"""
+        with self._lock:
+            # Активный (последний) сегмент не трогаем
+            if len(self._segment_ids) < 2:
+                return None
+            cut = bisect_left(self._ids, self._segment_ids[1])
+            if cut and self._times[cut - 1] >= before:
+                return None
+            first_id = self._segment_ids[0]
+            columns = (self._times[:cut], self._chats[:cut], self._users[:cut],
+                       self._types[:cut], self._severities[:cut])
+            names = list(self._names)
+        
+        # Подсчёт по копиям колонок - дозапись в журнал не ждёт
+        counts = Counter()
+        for created_at, chat_id, user_id, type_code, severity_code in zip(*columns):
+            for period, seconds in ROLLUP_PERIODS:
+                counts[(period, int(created_at // seconds) * seconds, chat_id, user_id, type_code, severity_code)] += 1
+        return first_id, [
+            (period, bucket, chat_id, user_id, names[type_code], names[severity_code], count)
+            for (period, bucket, chat_id, user_id, type_code, severity_code), count in counts.items()
+        ]
+    
+    def archive_segment(self, first_id: int) -> int:
+        """Перенести старейший закрытый сегмент в archive/ (gzip); вернуть число событий"""
+        with self._lock:
+            if len(self._segment_ids) < 2 or self._segment_ids[0] != first_id:
+                return 0
+            cut = bisect_left(self._ids, self._segment_ids[1])
+            path = shutil.move(self._segment_paths[0], self.archive_path)
+            self._drop(cut, self._segment_ids[1])
+            del self._segment_ids[0]
+            del self._segment_paths[0]
+            self.archived_segments += 1
+        
+        # Сжатие - вне замка: сегмент уже не в индексе
+        with open(path, "rb") as source, gzip.open(path + ".gz", "wb") as target:
+            shutil.copyfileobj(source, target)
+        os.remove(path)
+        
+        logger.info(f"📦 Журнал событий: в архив перенесено событий: {cut} ({os.path.basename(path)})")
+        return cut
+    
+    def _drop(self, count: int, first_live_id: int):
+        """Убрать из индекса первые count событий"""
+        for column in (self._ids, self._times, self._users, self._chats,
+                       self._types, self._severities, self._offsets):
+            del column[:count]
+        for postings in (self._by_user, self._by_chat, self._by_type, self._by_severity):
+            for key in list(postings):
+                ids = postings[key]
+                cut = bisect_left(ids, first_live_id)
+                if cut == len(ids):
+                    del postings[key]
+                elif cut:
+                    del ids[:cut]
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "events": len(self._ids),
+                "segments": len(self._segment_paths),
+                "active_segment_bytes": self._size,
+                "appended": self.appended,
+                "archived_segments": self.archived_segments,
+                "next_id": self._next_id
+            }
+    
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+class EventLogStorage(SQLiteStorage):
+    """События - в журнал сегментов, остальное - в SQLite.
+    
+    Запись события - только дозапись в конец файла без индексов базы.
+    Пачка сначала коммитится в SQLite, потом дописывается в журнал:
+    при ошибке журнала writer повторит пачку, а upsert'ы SQLite
+    идемпотентны, так что события не задваиваются.
+    """
+    
+    name = "eventlog"
+    
+    ROLLED_KEY = "event_log_rolled_segment"
+    
+    def __init__(self, conn: sqlite3.Connection, lock, path: str, log_path: str,
+                 segment_bytes: int = 64 * 1024 * 1024, durable: bool = False, archive_path: str = ""):
+        super().__init__(conn, lock, path, archive_path)
+        self.log = EventLog(log_path, segment_bytes=segment_bytes, durable=durable)
+    
+    def write_batch(self, chats: list, users: list, usernames: list, fingerprints: list,
+                    events: list, user_stats: list):
+        super().write_batch(chats, users, usernames, fingerprints, [], user_stats)
+        self.log.append(events)
+    
+    def event_counts(self) -> List[Tuple[str, str, int, int]]:
+        # Свёртки и события из таблицы (до перехода на журнал) - из SQLite
+        counts = Counter()
+        for event_type, severity, chat_id, count in super().event_counts() + self.log.counts():
+            counts[(event_type, severity, chat_id)] += count
+        return [(*key, count) for key, count in counts.items()]
+    
+    def event_buckets(self, bucket_seconds: int, since: float) -> List[Tuple[int, str, int]]:
+        return self.log.buckets(bucket_seconds, since)
+    
+    def event_page(self, limit: int = 50, **filters) -> EventPage:
+        return self.log.page(limit=limit, **filters)
+    
+    def expire_events(self, before: float, limit: int) -> int:
+        """Сначала остаток таблицы events, затем журнал - по сегменту за вызов"""
+        expired = super().expire_events(before, limit)
+        if expired:
+            return expired
+        
+        plan = self.log.expired_rollups(before)
+        if plan is None:
+            return 0
+        first_id, rows = plan
+        
+        # Отметка в той же транзакции: после сбоя до переноса сегмент не свернётся дважды
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT value FROM state WHERE key = ?", (self.ROLLED_KEY,)).fetchone()
+            if row is None or int(row[0]) < first_id:
+                self.conn.executemany(UPSERT_ROLLUP_SQL, rows)
+                self.conn.execute(UPSERT_STATE_SQL, (self.ROLLED_KEY, str(first_id)))
+        return self.log.archive_segment(first_id)
+    
+    def stats(self) -> Dict:
+        return {"backend": self.name, **self.log.stats()}
+    
+    def close(self):
+        self.log.close()
+
+class MaintenanceScheduler:
+    """Фоновое обслуживание хранилища.
+    
+    Раз в interval секунд по очереди: свёртка и вынос событий старше
+    retention, удаление почасовых свёрток старше hourly_retention,
+    вынос username/chat_title событий старше compact_after в справочник
+    и incremental VACUUM. Каждая задача идёт порциями по batch строк
+    (страниц) с паузой между ними; пока busy() - например, у writer
+    скопилась очередь, - следующая порция ждёт.
+    """
+    
+    def __init__(self, storage: Storage, busy=None, interval: float = 3600, retention: float = 90 * 86400,
+                 hourly_retention: float = 365 * 86400, compact_after: float = 86400,
+                 batch: int = 2000, pause: float = 0.05):
+        self.storage = storage
+        self.busy = busy or (lambda: False)
+        self.interval = interval
+        self.retention = retention
+        self.hourly_retention = hourly_retention
+        self.compact_after = compact_after
+        self.batch = max(1, batch)
+        self.pause = pause
+        
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        
+        # Счётчики
+        self.runs = 0
+        self.errors = 0
+        self.throttled = 0
+        self.last_run: Optional[float] = None
+        self.last_duration = 0.0
+        self.last_result: Dict[str, int] = {}
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        # Первый проход вскоре после старта, не дожидаясь полного интервала
+        delay = min(self.interval, 60)
+        while not self._stop.wait(delay):
+            try:
+                self.run_once()
+            except (sqlite3.Error, OSError) as e:
+                self.errors += 1
+                logger.error(f"Maintenance error: {e}")
+            delay = self.interval
+    
+    def _drain(self, job, *args) -> int:
+        """Выполнять job порциями, пока есть работа"""
+        total = 0
+        while not self._stop.is_set():
+            while self.busy() and not self._stop.is_set():
+                self.throttled += 1
+                self._stop.wait(self.pause)
+            
+            done = job(*args, self.batch)
+            total += done
+            if not done:
+                break
+            self._stop.wait(self.pause)
+        return total
+    
+    def run_once(self) -> Dict[str, int]:
+        """Один проход всех задач"""
+        started = time.time()
+        result = {}
+        if self.retention > 0:
+            result["expired"] = self._drain(self.storage.expire_events, started - self.retention)
+        if self.hourly_retention > 0:
+            result["rollups_pruned"] = self._drain(self.storage.prune_rollups, "hour", started - self.hourly_retention)
+        result["compacted"] = self._drain(self.storage.compact_events, started - self.compact_after)
+        result["vacuumed_pages"] = self._drain(self.storage.vacuum)
+        
+        self.runs += 1
+        self.last_run = started
+        self.last_duration = time.time() - started
+        self.last_result = result
+        if any(result.values()):
+            logger.info(f"🧹 Обслуживание за {self.last_duration:.1f} с: {result}")
+        return result
+    
+    def stats(self) -> Dict:
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "last_run": self.last_run,
+            "last_duration_s": round(self.last_duration, 2),
+            "last_result": self.last_result
+        }
+    
+    def close(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(10)
+
+# ========== ИСПРАВЛЕННАЯ СИСТЕМА МОНИТОРИНГА ==========
+class FixedTelegramMonitor:
+    def __init__(self, token: str, allowed_ids: List[int]):
+        self.tg = EnhancedTelegramAPI(token)
+        self.allowed_ids = allowed_ids
+        
+        # Исходящие запросы: пулы потоков или один цикл asyncio
+        if RUNTIME not in ("threads", "async"):
+            raise ValueError(f"Unknown RUNTIME: {RUNTIME}")
+        self.runtime: Optional[AsyncRuntime] = None
+        if RUNTIME == "async":
+            self.runtime = AsyncRuntime(token, max_connections=ASYNC_MAX_CONNECTIONS)
+        
+        # В процессе-шарде: канал в главный процесс (см. _shard_main)
+        self.is_shard = SHARD_INDEX is not None
+        self.upstream: Optional[ShardLink] = None
+        self._stopped = False
+        
+        # База данных (соединение общее для всех обработчиков очереди)
+        self.conn = open_database(DB_PATH, durable=PERSIST_MODE == "sync")
+        self.db_lock = threading.RLock()
+        if not self.is_shard:
+            self.init_database()
+            self.migrate_database()
+        self.storage = self._open_storage()
+        self.writer = PersistenceWriter(
+            self.storage,
+            self.db_lock,
+            mode=PERSIST_MODE,
+            batch_size=PERSIST_BATCH_SIZE,
+            flush_interval=PERSIST_FLUSH_MS / 1000
+        )
+        
+        # Кэш данных: пользователи и чаты подгружаются из хранилища по требованию
+        self.our_chats: Set[int] = set()
+        self.users = LazyCache(self._load_user, USER_CACHE_SIZE, on_evict=self._evict_user)
+        self.chats = LazyCache(self._load_chat, CHAT_CACHE_SIZE)
+        self.username_index = UsernameIndex()
+        self._totals: Optional[Tuple[float, int, int]] = None
+        self.fingerprints = FingerprintIndex(max_docs=FINGERPRINT_MAX_DOCS)
+        self.metrics = EventMetrics(
+            bucket_seconds=METRICS_BUCKET_SECONDS,
+            history_hours=METRICS_HISTORY_HOURS,
+            top_chats=METRICS_TOP_CHATS
+        )
+        self._stats_snapshot: Optional[Tuple[str, Dict]] = None
+        self.trust = TrustScorer(TRUST_HALF_LIFE_HOURS * 3600, top_k=TRUST_TOP_K)
+        
+        # Загружаем данные
+        self.load_data()
+        
+        # Для отслеживания копирования
+        self.message_cache = MessageCache(
+            max_entries=MESSAGE_CACHE_SIZE,
+            per_chat=MESSAGE_CACHE_PER_CHAT,
+            ttl=MESSAGE_CACHE_TTL,
+            max_bytes=MESSAGE_CACHE_MB * 1024 * 1024
+        )
+        
+        # Шаблоны скриншотов и копирования
+        self.detector = PatternDetector(PATTERNS_FILE, PATTERNS_RELOAD_SECONDS)
+        
+        # Статус бота в чатах
+        self.admin_resolver = ChatAdminResolver(
+            self.tg,
+            self._apply_chat_status,
+            ttl=ADMIN_STATUS_TTL,
+            negative_ttl=ADMIN_NEGATIVE_TTL,
+            runtime=self.runtime,
+            max_entries=CHAT_CACHE_SIZE
+        )
+        
+        # Живой поток для дашбордов
+        self.stream = AlertStream(
+            buffer_size=STREAM_BUFFER,
+            history=STREAM_HISTORY,
+            max_subscribers=STREAM_MAX_SUBSCRIBERS
+        )
+        
+        # Группировка оповещений перед рассылкой
+        self.aggregator = AlertAggregator(
+            self._send_digest,
+            window=ALERT_WINDOW_SECONDS,
+            samples=ALERT_DIGEST_SAMPLES
+        )
+        
+        # Рассылка оповещений админам (в шардах оповещения уходят в главный процесс)
+        self.notifier = None
+        if not self.is_shard:
+            self.notifier = AlertNotifier(
+                self.tg,
+                self.conn,
+                self.db_lock,
+                workers=NOTIFY_WORKERS,
+                global_rate=NOTIFY_GLOBAL_RATE,
+                chat_rate=NOTIFY_CHAT_RATE,
+                max_attempts=NOTIFY_MAX_ATTEMPTS,
+                runtime=self.runtime,
+                max_inflight=ASYNC_MAX_INFLIGHT
+            )
+        
+        # Очередь входящих обновлений: своя или раздача по шардам
+        if SHARDS > 1 and not self.is_shard:
+            self.ingest = ShardRouter(self, SHARDS, maxsize=SHARD_QUEUE_SIZE)
+        else:
+            self.ingest = IngestQueue(
+                self.process_update,
+                workers=INGEST_WORKERS,
+                maxsize=INGEST_QUEUE_SIZE,
+                dedupe_window=INGEST_DEDUPE_WINDOW,
+                batch_handler=self.process_updates,
+                batch_size=INGEST_BATCH
+            )
+        
+        # Опрос getUpdates (запускается в __main__ при INGEST_MODE=polling)
+        self.poller = None
+        if INGEST_MODE == "polling" and not self.is_shard:
+            self.poller = UpdatePoller(
+                self.tg,
+                self.conn,
+                self.db_lock,
+                self.ingest,
+                limit=POLL_LIMIT,
+                timeout=POLL_TIMEOUT
+            )
+        
+        # Обслуживание хранилища - только в главном процессе
+        self.maintenance = None
+        if MAINTENANCE_INTERVAL > 0 and not self.is_shard:
+            self.maintenance = MaintenanceScheduler(
+                self.storage,
+                busy=lambda: self.writer.pending() >= self.writer.batch_size,
+                interval=MAINTENANCE_INTERVAL,
+                retention=RETENTION_DAYS * 86400,
+                hourly_retention=ROLLUP_HOURLY_DAYS * 86400,
+                compact_after=COMPACT_AFTER_HOURS * 3600,
+                batch=MAINTENANCE_BATCH,
+                pause=MAINTENANCE_PAUSE_MS / 1000
+            )
+            self.maintenance.start()
+        
+        METRICS.add_collector(self._collect_metrics)
+        
+        logger.info(f"✅ Монитор инициализирован. Наших чатов: {len(self.our_chats)}")
+    
+    def shutdown(self):
+        """Остановить обработку и закрыть базу"""
+        if self._stopped:
+            return
+        self._stopped = True
+        
+        if self.poller:
+            self.poller.close()
+        if self.maintenance:
+            self.maintenance.close()
+        self.ingest.shutdown()
+        self.stream.close()
+        self.admin_resolver.close()
+        self.aggregator.close()
+        if self.notifier:
+            self.notifier.close()
+        if self.runtime:
+            self.runtime.close()
+        self.writer.close()
+        self.storage.close()
+        with self.db_lock:
+            self.conn.execute("PRAGMA optimize")
+        logger.info("🛑 Монитор остановлен")
+    
+    def _open_storage(self) -> Storage:
+        """Хранилище по STORAGE_BACKEND (шарды события не пишут, им журнал не нужен)"""
+        if STORAGE_BACKEND not in ("sqlite", "eventlog"):
+            raise ValueError(f"unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+        
+        if STORAGE_BACKEND == "eventlog" and not self.is_shard:
+            return EventLogStorage(
+                self.conn,
+                self.db_lock,
+                DB_PATH,
+                EVENT_LOG_DIR,
+                segment_bytes=EVENT_LOG_SEGMENT_MB * 1024 * 1024,
+                durable=PERSIST_MODE == "sync",
+                archive_path=RETENTION_ARCHIVE_DIR
+            )
+        return SQLiteStorage(self.conn, self.db_lock, DB_PATH, RETENTION_ARCHIVE_DIR)
+    
+    def init_database(self):
+        """Инициализировать базу данных"""
+        cursor = self.conn.cursor()
+        
+        # Таблица чатов
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id INTEGER PRIMARY KEY,
+                title TEXT,
+                username TEXT,
+                type TEXT,
+                is_our_chat INTEGER DEFAULT 0,
+                added_at TIMESTAMP,
+                message_count INTEGER DEFAULT 0
+            )
+        ''')
+        
+        # Таблица пользователей
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
                 first_name TEXT,
@@ -236,7 +4238,51 @@ class FixedTelegramMonitor:
                 screenshot_count INTEGER DEFAULT 0,
                 forward_count INTEGER DEFAULT 0,
                 copy_count INTEGER DEFAULT 0,
-                last_seen TIMESTAMP
+                last_seen TIMESTAMP,
+                risk_key REAL
+            )
+        ''')
+        
+        # История username пользователей
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS username_history (
+                user_id INTEGER,
+                username TEXT,
+                first_seen TIMESTAMP,
+                last_seen TIMESTAMP,
+                PRIMARY KEY (user_id, username)
+            )
+        ''')
+        
+        # Отпечатки текстов наших чатов
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                chat_id INTEGER,
+                message_id INTEGER,
+                user_id INTEGER,
+                created_at REAL,
+                sketch BLOB,
+                PRIMARY KEY (chat_id, message_id)
+            )
+        ''')
+        
+        # Очередь исходящих сообщений
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER,
+                text TEXT,
+                attempts INTEGER DEFAULT 0,
+                next_attempt REAL,
+                created_at REAL
+            )
+        ''')
+        
+        # Служебные значения (смещение getUpdates и т.п.)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT
             )
         ''')
         
@@ -256,109 +4302,271 @@ class FixedTelegramMonitor:
                 details TEXT,
                 confidence INTEGER,
                 source_chat_id INTEGER,
-                source_chat_title TEXT
+                source_chat_title TEXT,
+                created_at REAL,
+                group_id TEXT,
+                username_ref INTEGER,
+                chat_title_ref INTEGER
+            )
+        ''')
+        
+        # Справочник повторяющихся строк старых событий (username, chat_title)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS event_strings (
+                string_id INTEGER PRIMARY KEY,
+                value TEXT UNIQUE
+            )
+        ''')
+        
+        # Свёртки вынесенных событий по часам и дням
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS event_rollups (
+                period TEXT,
+                bucket INTEGER,
+                chat_id INTEGER,
+                user_id INTEGER,
+                type TEXT,
+                severity TEXT,
+                count INTEGER,
+                PRIMARY KEY (period, bucket, chat_id, user_id, type, severity)
             )
         ''')
         
         self.conn.commit()
     
+    def migrate_database(self):
+        """Довести схему существующей базы до SCHEMA_VERSION"""
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        
+        logger.info(f"🛠 Миграция базы: v{version} -> v{SCHEMA_VERSION}")
+        
+        with self.conn:
+            if version < 1:
+                # Сортируемое время события: timestamp хранится строкой для показа
+                columns = {row[1] for row in self.conn.execute("PRAGMA table_info(events)")}
+                if "created_at" not in columns:
+                    self.conn.execute("ALTER TABLE events ADD COLUMN created_at REAL")
+                self.conn.create_function("parse_alert_ts", 1, _parse_alert_timestamp)
+                self.conn.execute(
+                    "UPDATE events SET created_at = parse_alert_ts(timestamp) WHERE created_at IS NULL"
+                )
+                
+                # Старые alert_id могли совпадать у разных чатов
+                self.conn.execute('''
+                    UPDATE events SET alert_id = alert_id || '_' || id
+                    WHERE id NOT IN (SELECT MIN(id) FROM events GROUP BY alert_id)
+                ''')
+                
+                self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_events_alert_id ON events(alert_id)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_events_user_time ON events(user_id, created_at)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_events_chat_time ON events(chat_id, created_at)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_events_type ON events(type)")
+            
+            if version < 2:
+                # Поиск по username для пользователей вне кэша
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users(lower(username))")
+                self.conn.execute('''
+                    INSERT OR IGNORE INTO username_history (user_id, username, first_seen, last_seen)
+                    SELECT user_id, username, last_seen, last_seen FROM users WHERE username != ''
+                ''')
+            
+            if version < 3:
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_fingerprints_time ON fingerprints(created_at)")
+            
+            if version < 5:
+                # Группа оповещения: все события шторма ссылаются на первое
+                columns = {row[1] for row in self.conn.execute("PRAGMA table_info(events)")}
+                if "group_id" not in columns:
+                    self.conn.execute("ALTER TABLE events ADD COLUMN group_id TEXT")
+                self.conn.execute("UPDATE events SET group_id = alert_id WHERE group_id IS NULL")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_events_group ON events(group_id)")
+            
+            if version < 6:
+                # Индексы под постраничную историю: (фильтр, created_at) + неявный id
+                self.conn.execute("DROP INDEX IF EXISTS idx_events_type")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_events_time ON events(created_at)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_events_type_time ON events(type, created_at)")
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_events_severity_time ON events(severity, created_at)")
+            
+            if version < 7:
+                # Ссылки на справочник строк (заполняет обслуживание)
+                columns = {row[1] for row in self.conn.execute("PRAGMA table_info(events)")}
+                for column in ("username_ref", "chat_title_ref"):
+                    if column not in columns:
+                        self.conn.execute(f"ALTER TABLE events ADD COLUMN {column} INTEGER")
+            
+            if version < 8:
+                # При старте читаются только наши чаты
+                self.conn.execute("CREATE INDEX IF NOT EXISTS idx_chats_our ON chats(chat_id) WHERE is_our_chat = 1")
+            
+            if version < 9:
+                # Ключ риска с затуханием (TrustScorer) и индекс под топ при старте
+                columns = {row[1] for row in self.conn.execute("PRAGMA table_info(users)")}
+                if "risk_key" not in columns:
+                    self.conn.execute("ALTER TABLE users ADD COLUMN risk_key REAL")
+                    # Прежние штрафы начинают затухать с момента миграции
+                    now = time.time()
+                    half_life = TRUST_HALF_LIFE_HOURS * 3600
+                    self.conn.executemany(
+                        "UPDATE users SET risk_key = ? WHERE user_id = ?",
+                        [(math.log2(100 - score) + now / half_life, user_id) for user_id, score in
+                         self.conn.execute("SELECT user_id, trust_score FROM users WHERE trust_score < 100")]
+                    )
+                self.conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_users_risk ON users(risk_key) WHERE risk_key IS NOT NULL"
+                )
+            
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        
+        if version < 7:
+            # Освобождённое место возвращается порциями (incremental_vacuum);
+            # режим включается только полным VACUUM вне транзакции
+            self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self.conn.execute("VACUUM")
+        
+        # Статистика для новых индексов - только после миграции и по выборке
+        # строк: на большой базе полный ANALYZE читает все индексы целиком
+        self.conn.execute("PRAGMA analysis_limit = 1000")
+        self.conn.execute("ANALYZE")
+    
     def load_data(self):
-        """Загрузить данные из базы"""
-        cursor = self.conn.cursor()
+        """Загрузить данные из хранилища (пользователи и чаты - по требованию)"""
+        self.our_chats = set(self.storage.our_chat_ids())
         
-        # Загружаем наши чаты
-        cursor.execute("SELECT chat_id FROM chats WHERE is_our_chat = 1")
-        self.our_chats = {row[0] for row in cursor.fetchall()}
-        
-        # Загружаем пользователей
-        cursor.execute("SELECT * FROM users")
-        for row in cursor.fetchall():
-            self.users[row[0]] = UserData(
-                user_id=row[0],
-                username=row[1],
-                first_name=row[2],
-                trust_score=row[3],
-                screenshot_count=row[4],
-                forward_count=row[5],
-                copy_count=row[6],
-                last_seen=row[7]
-            )
+        # Загружаем отпечатки (только самые свежие, остальные удаляем)
+        for chat_id, message_id, user_id, sketch in self.storage.load_fingerprints(FINGERPRINT_MAX_DOCS):
+            self.fingerprints.add(chat_id, message_id, user_id, sketch)
+        
+        # Чистка и счётчики событий - только в главном процессе
+        if not self.is_shard:
+            self.storage.prune_fingerprints(FINGERPRINT_MAX_DOCS)
+            self.metrics.load(self.storage)
+            self.trust.load(self.storage.top_risk(TRUST_TOP_K))
+    
+    def _load_user(self, user_id: int) -> Optional[UserData]:
+        """Пользователь из хранилища с незаписанными изменениями поверх"""
+        user = self.storage.get_user(user_id)
+        row = self.writer.lookup("users", user_id)
+        if row is not None:
+            if user is None:
+                user = UserData(user_id=user_id, username=_intern(row[1]), first_name=_intern(row[2]))
+            else:
+                user.username, user.first_name = _intern(row[1]), _intern(row[2])
+            user.last_seen = _epoch(row[3])
         
-        # Загружаем чаты
-        cursor.execute("SELECT * FROM chats")
-        for row in cursor.fetchall():
-            self.chats[row[0]] = ChatData(
-                chat_id=row[0],
-                title=row[1],
-                username=row[2],
-                type=row[3],
+        stats = self.writer.lookup("user_stats", user_id)
+        if user is not None and stats is not None:
+            (user.screenshot_count, user.forward_count, user.copy_count,
+             user.trust_score, user.risk_key) = stats[:5]
+            user.last_seen = _epoch(stats[5])
+        
+        if user is not None and user.username:
+            self.username_index.update(user_id, None, user.username)
+        return user
+    
+    def _evict_user(self, user_id: int, user: UserData):
+        # Вытесненный ник найдётся через хранилище, если он уже записан
+        if self.writer.lookup("users", user_id) is None:
+            self.username_index.update(user_id, user.username, None)
+    
+    def _load_chat(self, chat_id: int) -> Optional[ChatData]:
+        """Чат из хранилища с незаписанными изменениями поверх"""
+        chat = self.storage.get_chat(chat_id)
+        row = self.writer.lookup("chats", chat_id)
+        if row is not None:
+            chat = ChatData(
+                chat_id=chat_id,
+                title=_intern(row[1]),
+                username=_intern(row[2]),
+                type=_intern(row[3]),
                 is_our_chat=bool(row[4]),
-                added_at=row[5],
-                message_count=row[6]
+                added_at=_epoch(row[5]),
+                message_count=chat.message_count if chat else 0
             )
+        return chat
+    
+    def directory_totals(self) -> Tuple[int, int]:
+        """Число пользователей и чатов в хранилище (пересчёт не чаще DIRECTORY_TOTALS_TTL)"""
+        cached = self._totals
+        if cached is None or time.time() - cached[0] > DIRECTORY_TOTALS_TTL:
+            cached = self._totals = (time.time(), self.storage.count_users(), self.storage.count_chats())
+        return cached[1], cached[2]
     
     def save_chat(self, chat_id: int, title: str, username: str, chat_type: str, is_our: bool = False):
         """Сохранить информацию о чате"""
-        cursor = self.conn.cursor()
+        now = time.time()
+        added_at = datetime.fromtimestamp(now).isoformat()
+        self.writer.queue_chat((chat_id, title, username or "", chat_type, 1 if is_our else 0, added_at))
+        self._cache_chat(chat_id, title, username, chat_type, is_our, now)
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO chats 
-            (chat_id, title, username, type, is_our_chat, added_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (chat_id, title, username or "", chat_type, 1 if is_our else 0, datetime.now().isoformat()))
-        
-        self.conn.commit()
+        # Остальные шарды должны знать, какие чаты наши
+        if self.upstream:
+            self.upstream.send("chat", (chat_id, title, username, chat_type, is_our, added_at))
         
-        # Обновляем кэш
+        logger.info(f"💾 Сохранён чат: {title} ({'наш' if is_our else 'не наш'})")
+    
+    def _cache_chat(self, chat_id: int, title: str, username: str, chat_type: str, is_our: bool, added_at):
+        """Обновить чат в кэше (без записи в базу); added_at - ISO-строка или секунды эпохи"""
         if is_our:
             self.our_chats.add(chat_id)
+        else:
+            self.our_chats.discard(chat_id)
         
-        self.chats[chat_id] = ChatData(
+        self.chats.put(chat_id, ChatData(
             chat_id=chat_id,
-            title=title,
-            username=username,
-            type=chat_type,
+            title=_intern(title),
+            username=_intern(username),
+            type=_intern(chat_type),
             is_our_chat=is_our,
-            added_at=datetime.now().isoformat()
-        )
-        
-        logger.info(f"💾 Сохранён чат: {title} ({'наш' if is_our else 'не наш'})")
+            added_at=_epoch(added_at)
+        ))
     
+    @METRICS.timed("save_user")
     def save_user(self, user_id: int, username: str, first_name: str):
         """Сохранить информацию о пользователе"""
-        cursor = self.conn.cursor()
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO users 
-            (user_id, username, first_name, last_seen)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, username or "", first_name or "", datetime.now().isoformat()))
+        now = time.time()
+        last_seen = datetime.fromtimestamp(now).isoformat()
+        self.writer.queue_user((user_id, username or "", first_name or "", last_seen))
+        is_new, old_username = self._cache_user(user_id, username, first_name, now)
         
-        self.conn.commit()
+        # Смена username: старый ник остаётся в истории
+        renamed = bool(username) and username != old_username
+        if renamed:
+            self.writer.queue_username((user_id, username, last_seen, last_seen))
         
-        # Обновляем кэш
-        if user_id not in self.users:
-            self.users[user_id] = UserData(
+        # Главный процесс ведёт общий справочник пользователей
+        if self.upstream and (is_new or renamed):
+            self.upstream.send("user", (user_id, username, first_name, last_seen))
+    
+    def _cache_user(self, user_id: int, username: str, first_name: str, last_seen) -> Tuple[bool, Optional[str]]:
+        """Обновить пользователя в кэше: (новый ли, прежний username); last_seen - ISO или эпоха"""
+        username = _intern(username)
+        cached = self.users.get(user_id)
+        if cached is None:
+            self.users.put(user_id, UserData(
                 user_id=user_id,
                 username=username,
-                first_name=first_name,
-                last_seen=datetime.now().isoformat()
-            )
+                first_name=_intern(first_name),
+                last_seen=_epoch(last_seen)
+            ))
+            old_username = None
         else:
-            self.users[user_id].last_seen = datetime.now().isoformat()
-            if username and not self.users[user_id].username:
-                self.users[user_id].username = username
+            cached.last_seen = _epoch(last_seen)
+            old_username = cached.username
+            if username:
+                cached.username = username
+        
+        # Старый ник уходит из индекса
+        if username and username != old_username:
+            self.username_index.update(user_id, old_username, username)
+        return cached is None, old_username
     
-    def save_event(self, alert: AlertData):
+    @METRICS.timed("save_event")
+    def save_event(self, alert: AlertData, group_id: Optional[str] = None):
         """Сохранить событие в базу"""
-        cursor = self.conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO events 
-            (alert_id, type, severity, user_id, username, chat_id, chat_title, 
-             message_id, timestamp, details, confidence, source_chat_id, source_chat_title)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+        self.writer.queue_event((
             alert.alert_id,
             alert.type.value,
             alert.severity.value,
@@ -371,73 +4579,172 @@ class FixedTelegramMonitor:
             json.dumps(alert.details, ensure_ascii=False),
             alert.confidence,
             alert.source_chat_id,
-            alert.source_chat_title
+            alert.source_chat_title,
+            time.time(),
+            group_id or alert.alert_id
         ))
         
-        self.conn.commit()
+        self.metrics.record(alert.type.value, alert.severity.value, alert.chat_id)
+        METRICS.inc("tgmon_alerts_total", (alert.type.name, alert.severity.name))
         
         # Обновляем статистику пользователя
-        if alert.user_id in self.users:
-            user = self.users[alert.user_id]
+        user = self.users.get(alert.user_id)
+        if user is not None:
             if alert.type == AlertType.SCREENSHOT:
                 user.screenshot_count += 1
-                user.trust_score = max(0, user.trust_score - 10)
             elif alert.type in [AlertType.FORWARD_OUT, AlertType.FORWARD_IN]:
                 user.forward_count += 1
-                user.trust_score = max(0, user.trust_score - 5)
             elif alert.type in [AlertType.COPY, AlertType.COPY_DETECTED]:
                 user.copy_count += 1
-                user.trust_score = max(0, user.trust_score - 3)
-            
-            # Обновляем в базе
-            cursor.execute('''
-                UPDATE users SET 
-                screenshot_count = ?,
-                forward_count = ?,
-                copy_count = ?,
-                trust_score = ?,
-                last_seen = ?
-                WHERE user_id = ?
-            ''', (
+            
+            # Штраф затухает: храним только ключ риска, балл считается при чтении
+            now = time.time()
+            user.risk_key = self.trust.penalize(user.risk_key, TRUST_PENALTIES.get(alert.type, 0), now)
+            user.trust_score = self.trust.score(user.risk_key, now)
+            self.trust.offer(user.user_id, user.risk_key)
+            
+            # Счётчики уходят в базу вместе со следующей пачкой (повторы схлопываются)
+            self.writer.queue_user_stats((
                 user.screenshot_count,
                 user.forward_count,
                 user.copy_count,
                 user.trust_score,
+                user.risk_key,
                 datetime.now().isoformat(),
                 user.user_id
             ))
-            self.conn.commit()
+    
+    def process_update(self, update: Dict):
+        """Обработать одно обновление Telegram"""
+        self.process_updates([update])
+    
+    def process_updates(self, updates: List[Dict]):
+        """Обработать пачку обновлений Telegram.
+        
+        Поддерживаются message, edited_message, channel_post,
+        edited_channel_post и my_chat_member. Авторы и чаты пачки
+        сохраняются одним проходом (повторы схлопываются), а всё, что
+        пачка пишет в базу, уходит одной транзакцией в конце.
+        """
+        messages: List[Tuple[Dict, bool]] = []
+        with self.writer.hold():
+            for update in updates:
+                # Обработка добавления бота в чат (и удаления из него)
+                if 'my_chat_member' in update:
+                    self._process_chat_member(update['my_chat_member'])
+                elif 'message' in update:
+                    messages.append((update['message'], False))
+                elif 'edited_message' in update:
+                    messages.append((update['edited_message'], True))
+                elif 'channel_post' in update:
+                    messages.append((_channel_message(update['channel_post']), False))
+                elif 'edited_channel_post' in update:
+                    messages.append((_channel_message(update['edited_channel_post']), True))
+            
+            if not messages:
+                return
+            
+            self._save_participants(message for message, _ in messages)
+            for message, edited in messages:
+                if edited:
+                    self.process_edit(message)
+                else:
+                    self._analyze_message(message)
+    
+    def _process_chat_member(self, chat_member: Dict):
+        """Бота добавили в чат или удалили из него"""
+        chat = chat_member.get('chat', {})
+        chat_id = chat.get('id')
+        status = chat_member.get('new_chat_member', {}).get('status', 'member')
+        is_our = status not in GONE_STATUSES
+        
+        self.admin_resolver.update_from_member(chat_id, status)
+        
+        # Добавляем как наш чат
+        self.save_chat(
+            chat_id=chat_id,
+            title=chat.get('title', f'Chat {chat_id}'),
+            username=chat.get('username'),
+            chat_type=chat.get('type', 'unknown'),
+            is_our=is_our
+        )
+        
+        if is_our:
+            logger.info(f"🤖 Бот добавлен в наш чат: {chat.get('title', chat_id)}")
+        else:
+            logger.info(f"👋 Бот удалён из чата: {chat.get('title', chat_id)}")
+    
+    def _save_participants(self, messages):
+        """Один проход upsert по авторам и чатам пачки"""
+        users: Dict[int, Dict] = {}
+        chats: Dict[int, Dict] = {}
+        for message in messages:
+            user = message.get("from") or {}
+            # Отрицательный id - канал, подписавший пост (_channel_message), а не пользователь
+            if user.get("id") is not None and user["id"] > 0:
+                users[user["id"]] = user
+            chat = message.get("chat") or {}
+            if chat.get("id") is not None:
+                chats[chat["id"]] = chat
+        
+        for user_id, user in users.items():
+            self.save_user(user_id, user.get("username", ""), user.get("first_name", ""))
+        
+        for chat_id, chat in chats.items():
+            # Если чат новый - сохраняем его
+            if chat_id not in self.chats:
+                # Определяем, наш ли это чат (если бот в нём админ).
+                # Пока статус неизвестен, чат считается чужим - ответ придёт в фоне
+                self.save_chat(
+                    chat_id,
+                    chat.get("title", f"Chat {chat_id}"),
+                    chat.get("username"),
+                    chat.get("type", "unknown"),
+                    self._is_bot_admin_in_chat(chat_id)
+                )
+            
+            # Статус бота перепроверяется раз в ADMIN_STATUS_TTL
+            if chat.get("type") != "private":
+                self.admin_resolver.ensure(chat_id)
     
     def process_message(self, message: Dict):
         """Обработать входящее сообщение"""
+        with self.writer.hold():
+            self._save_participants([message])
+            self._analyze_message(message)
+    
+    def _remember_text(self, chat_id: int, message_id: int, user_id: int, text: str) -> Optional[array]:
+        """Кэш, отпечаток и реплика текста; возвращает отпечаток"""
+        # Кэшируем сообщение для отслеживания копирования
+        if text and len(text) > 10:  # Сохраняем только текстовые сообщения
+            self.message_cache.put(chat_id, message_id, user_id, text)
+        
+        # Отпечаток текста: тексты наших чатов попадают в индекс
+        sketch = None
+        if text and len(text) >= FINGERPRINT_MIN_LENGTH:
+            sketch = self.fingerprints.sketch(text[:self.message_cache.max_text])
+            if chat_id in self.our_chats:
+                self.fingerprints.add(chat_id, message_id, user_id, sketch)
+                self.writer.queue_fingerprint((chat_id, message_id, user_id, time.time(), sketch.tobytes()))
+        
+        # Тексты наших чатов нужны другим шардам для проверки копирования
+        if self.upstream and chat_id in self.our_chats and text and len(text) > 10:
+            self.upstream.send("replica", (
+                chat_id, message_id, user_id, text[:self.message_cache.max_text],
+                sketch.tobytes() if sketch else b""
+            ))
+        return sketch
+    
+    @METRICS.timed("process_message")
+    def _analyze_message(self, message: Dict):
+        """Проверки сообщения (автор и чат уже сохранены)"""
         try:
-            chat = message.get("chat", {})
-            user = message.get("from", {})
-            
-            chat_id = chat.get("id")
-            user_id = user.get("id")
-            username = user.get("username", "")
-            first_name = user.get("first_name", "")
+            chat_id = message.get("chat", {}).get("id")
+            user_id = message.get("from", {}).get("id")
             message_id = message.get("message_id")
             text = message.get("text", "") or message.get("caption", "")
             
-            # Сохраняем пользователя
-            self.save_user(user_id, username, first_name)
-            
-            # Если чат новый - сохраняем его
-            if chat_id not in self.chats:
-                chat_title = chat.get("title", f"Chat {chat_id}")
-                chat_username = chat.get("username")
-                chat_type = chat.get("type", "unknown")
-                
-                # Определяем, наш ли это чат (если бот в нём админ)
-                is_our_chat = self._is_bot_admin_in_chat(chat_id)
-                
-                self.save_chat(chat_id, chat_title, chat_username, chat_type, is_our_chat)
-            
-            # Кэшируем сообщение для отслеживания копирования
-            if text and len(text) > 10:  # Сохраняем только текстовые сообщения
-                self.message_cache[(chat_id, message_id)] = text[:500]  # Ограничиваем длину
+            sketch = self._remember_text(chat_id, message_id, user_id, text)
             
             # 1. Проверка на скриншоты
             alert = self._check_screenshot(message)
@@ -452,7 +4759,7 @@ class FixedTelegramMonitor:
                 return
             
             # 3. Проверка на копирование
-            alert = self._check_copy(message)
+            alert = self._check_copy(message, sketch)
             if alert:
                 self._send_alert(alert)
                 return
@@ -464,35 +4771,67 @@ class FixedTelegramMonitor:
         except Exception as e:
             logger.error(f"Process message error: {e}", exc_info=True)
     
-    def _is_bot_admin_in_chat(self, chat_id: int) -> bool:
-        """Проверить, является ли бот администратором в чате"""
+    @METRICS.timed("process_edit")
+    def process_edit(self, message: Dict):
+        """Обработать правку сообщения.
+        
+        Новый текст сравнивается с кэшированным оригиналом: если он не
+        изменился (правка разметки или вложения) - ничего не делаем. Иначе
+        обновляем кэш и отпечаток и повторяем только проверку копирования:
+        скриншот и пересылку правка не меняет, команды не повторяются.
+        """
         try:
-            # Простая логика: если бот получил сообщение из чата, 
-            # и это не личные сообщения - считаем что это наш чат
-            chat_info = self.chats.get(chat_id)
-            if chat_info and chat_info.type != "private":
-                return True
-            
-            # Альтернативная проверка через API
-            url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getChatMember"
-            data = {
-                "chat_id": chat_id,
-                "user_id": int(TELEGRAM_TOKEN.split(':')[0])  # ID бота из токена
-            }
+            chat_id = message.get("chat", {}).get("id")
+            user_id = message.get("from", {}).get("id")
+            message_id = message.get("message_id")
+            text = message.get("text", "") or message.get("caption", "")
+            if not text:
+                return
             
-            response = requests.post(url, json=data, timeout=5)
-            if response.status_code == 200:
-                result = response.json()
-                if result.get("ok"):
-                    status = result["result"].get("status", "")
-                    return status in ["administrator", "creator"]
+            original = self.message_cache.get(chat_id, message_id)
+            if original is not None and normalize_text(original.text) == normalize_text(text[:self.message_cache.max_text]):
+                return
             
-            return False
+            sketch = self._remember_text(chat_id, message_id, user_id, text)
+            alert = self._check_copy(message, sketch)
+            if alert:
+                alert.details["is_edit"] = True
+                alert.details["text_before_edit"] = original.text[:100] if original else None
+                self._send_alert(alert)
             
         except Exception as e:
-            logger.error(f"Check bot admin error: {e}")
-            return False
+            logger.error(f"Process edit error: {e}", exc_info=True)
     
+    def _apply_replica(self, chat_id: int, message_id: int, user_id: int, text: str, sketch_bytes: bytes):
+        """Текст нашего чата из другого шарда"""
+        self.message_cache.put(chat_id, message_id, user_id, text)
+        if sketch_bytes:
+            sketch = array('I')
+            sketch.frombytes(sketch_bytes)
+            self.fingerprints.add(chat_id, message_id, user_id, sketch)
+    
+    def _is_bot_admin_in_chat(self, chat_id: int) -> bool:
+        """Проверить, является ли бот администратором в чате (по кэшу)"""
+        return self.admin_resolver.peek(chat_id) in ADMIN_STATUSES
+    
+    def _apply_chat_status(self, chat_id: int, status: str):
+        """Применить статус бота, полученный через getChatMember"""
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return
+        
+        # Админ - чат наш; бота нет в чате - не наш; просто участник - без изменений
+        if status in ADMIN_STATUSES:
+            is_our = True
+        elif status in GONE_STATUSES:
+            is_our = False
+        else:
+            return
+        
+        if chat.is_our_chat != is_our:
+            self.save_chat(chat.chat_id, chat.title, chat.username, chat.type, is_our)
+    
+    @METRICS.timed("check_screenshot")
     def _check_screenshot(self, message: Dict) -> Optional[AlertData]:
         """Проверить на скриншоты"""
         text = message.get("text", "") or message.get("caption", "")
@@ -500,74 +4839,66 @@ class FixedTelegramMonitor:
         if not text:
             return None
         
-        # Шаблоны для обнаружения скриншотов
-        screenshot_patterns = [
-            # Русские шаблоны
-            (r'Пользователь\s+(@?\w+)\s+сделал\s+снимок\s+экрана', 1),
-            (r'(@?\w+)\s+сделал\s+скриншот', 1),
-            (r'(@?\w+)\s+заскринил', 1),
-            (r'Обнаружен\s+снимок\s+экрана\s+от\s+(@?\w+)', 1),
-            (r'(@?\w+)\s+снял\s+скрин', 1),
-            
-            # Английские шаблоны
-            (r'User\s+(@?\w+)\s+made\s+a\s+screenshot', 1),
-            (r'(@?\w+)\s+made\s+a\s+screenshot', 1),
-            (r'(@?\w+)\s+took\s+a\s+screenshot', 1),
-            (r'Screenshot\s+detected\s+from\s+(@?\w+)', 1),
-            (r'(@?\w+)\s+screenshotted', 1),
-            
-            # Украинские шаблоны
-            (r'Користувач\s+(@?\w+)\s+зробив\s+знімок\s+екрану', 1),
-            (r'(@?\w+)\s+зробив\s+скріншот', 1),
-        ]
+        found = self.detector.detect("screenshot", text)
+        if not found:
+            return None
         
-        for pattern, group_idx in screenshot_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
-            if match:
-                username = match.group(group_idx)
-                if username.startswith('@'):
-                    username = username[1:]  # Убираем @
-                
-                chat = message.get("chat", {})
-                user = message.get("from", {})
-                
-                # Ищем ID пользователя по username
-                screenshot_user_id = self._find_user_id_by_username(username)
-                
-                alert = AlertData(
-                    alert_id=f"SCR_{int(time.time())}_{message.get('message_id', 0)}",
-                    type=AlertType.SCREENSHOT,
-                    severity=Severity.HIGH,
-                    user_id=screenshot_user_id or user.get("id", 0),
-                    username=username or "Неизвестно",
-                    chat_id=chat.get("id", 0),
-                    chat_title=chat.get("title", f"Chat {chat.get('id', 0)}"),
-                    message_id=message.get("message_id", 0),
-                    timestamp=datetime.now().strftime("%H:%M:%S %d.%m.%Y"),
-                    details={
-                        "detection_method": "Анализ текста уведомления",
-                        "notification_text": text[:200],
-                        "pattern_matched": pattern,
-                        "raw_username": match.group(group_idx),
-                        "full_text": text[:500],
-                        "user_found": bool(screenshot_user_id),
-                        "confidence_reason": "Системное уведомление Telegram"
-                    },
-                    confidence=95
-                )
-                
-                logger.info(f"📸 Обнаружен скриншот от @{username}")
-                return alert
+        match, group_idx, pattern = found.match, found.group, found.pattern
+        username = match.group(group_idx)
+        if username.startswith('@'):
+            username = username[1:]  # Убираем @
         
-        return None
+        chat = message.get("chat", {})
+        user = message.get("from", {})
+        
+        # Ищем ID пользователя по username
+        screenshot_user_id = self._find_user_id_by_username(username)
+        
+        alert = AlertData(
+            alert_id=self._make_alert_id("SCR", message),
+            type=AlertType.SCREENSHOT,
+            severity=Severity.HIGH,
+            user_id=screenshot_user_id or user.get("id", 0),
+            username=username or "Неизвестно",
+            chat_id=chat.get("id", 0),
+            chat_title=chat.get("title", f"Chat {chat.get('id', 0)}"),
+            message_id=message.get("message_id", 0),
+            timestamp=datetime.now().strftime(ALERT_TIMESTAMP_FORMAT),
+            details={
+                "detection_method": "Анализ текста уведомления",
+                "notification_text": text[:200],
+                "pattern_matched": pattern,
+                "raw_username": match.group(group_idx),
+                "full_text": text[:500],
+                "user_found": bool(screenshot_user_id),
+                "confidence_reason": "Системное уведомление Telegram"
+            },
+            confidence=95
+        )
+        
+        logger.info(f"📸 Обнаружен скриншот от @{username}")
+        return alert
+    
+    def _make_alert_id(self, prefix: str, message: Dict) -> str:
+        """Уникальный ID оповещения (message_id уникален только внутри чата)"""
+        chat_id = message.get("chat", {}).get("id", 0)
+        return f"{prefix}_{int(time.time())}_{chat_id}_{message.get('message_id', 0)}"
     
     def _find_user_id_by_username(self, username: str) -> Optional[int]:
-        """Найти ID пользователя по username в кэше"""
-        for user_id, user_data in self.users.items():
-            if user_data.username and user_data.username.lower() == username.lower():
-                return user_id
-        return None
+        """Найти ID пользователя по username: индекс в памяти, затем хранилище"""
+        if not username:
+            return None
+        
+        user_id = self.username_index.get(username)
+        if user_id is not None:
+            return user_id
+        
+        user_id = self.storage.find_user_id(username)
+        if user_id is not None:
+            self.username_index.update(user_id, None, username)
+        return user_id
     
+    @METRICS.timed("check_forward")
     def _check_forward(self, message: Dict) -> Optional[AlertData]:
         """Проверить на пересылки"""
         if "forward_from_chat" not in message and "forward_from" not in message:
@@ -619,7 +4950,7 @@ class FixedTelegramMonitor:
         has_media = any(key in message for key in ["photo", "video", "document", "audio"])
         
         alert = AlertData(
-            alert_id=f"FWD_{int(time.time())}_{message.get('message_id', 0)}",
+            alert_id=self._make_alert_id("FWD", message),
             type=alert_type,
             severity=severity,
             user_id=user.get("id", 0),
@@ -627,7 +4958,7 @@ class FixedTelegramMonitor:
             chat_id=dest_chat_id,
             chat_title=dest_chat_title,
             message_id=message.get("message_id", 0),
-            timestamp=datetime.now().strftime("%H:%M:%S %d.%m.%Y"),
+            timestamp=datetime.now().strftime(ALERT_TIMESTAMP_FORMAT),
             details={
                 "message_preview": text[:150] if text else "Медиа-сообщение",
                 "has_media": has_media,
@@ -645,7 +4976,8 @@ class FixedTelegramMonitor:
         
         return alert
     
-    def _check_copy(self, message: Dict) -> Optional[AlertData]:
+    @METRICS.timed("check_copy")
+    def _check_copy(self, message: Dict, sketch: Optional[array] = None) -> Optional[AlertData]:
         """Проверить на копирование текста"""
         text = message.get("text", "") or message.get("caption", "")
         
@@ -656,10 +4988,15 @@ class FixedTelegramMonitor:
         user = message.get("from", {})
         
         # Проверяем, не является ли это ответом с копированием текста
-        reply_to_message = message.get("reply_to_message", {})
+        reply_to_message = message.get("reply_to_message") or {}
+        original_text = reply_to_message.get("text")
         
-        if reply_to_message and "text" in reply_to_message:
-            original_text = reply_to_message["text"]
+        # Telegram присылает не весь ответ - берём оригинал из кэша
+        if reply_to_message and not original_text:
+            cached = self.message_cache.get(chat.get("id"), reply_to_message.get("message_id"))
+            original_text = cached.text if cached else None
+        
+        if original_text:
             reply_text = text.lower()
             
             # Проверяем, содержит ли ответ оригинальный текст
@@ -669,7 +5006,7 @@ class FixedTelegramMonitor:
                 
                 if match_percentage > 30:  # Пороговое значение
                     alert = AlertData(
-                        alert_id=f"COPY_{int(time.time())}_{message.get('message_id', 0)}",
+                        alert_id=self._make_alert_id("COPY", message),
                         type=AlertType.COPY_DETECTED,
                         severity=Severity.MEDIUM,
                         user_id=user.get("id", 0),
@@ -677,7 +5014,7 @@ class FixedTelegramMonitor:
                         chat_id=chat.get("id", 0),
                         chat_title=chat.get("title", f"Chat {chat.get('id', 0)}"),
                         message_id=message.get("message_id", 0),
-                        timestamp=datetime.now().strftime("%H:%M:%S %d.%m.%Y"),
+                        timestamp=datetime.now().strftime(ALERT_TIMESTAMP_FORMAT),
                         details={
                             "detection_method": "Анализ ответов с копированием",
                             "original_message_id": reply_to_message.get("message_id"),
@@ -693,73 +5030,242 @@ class FixedTelegramMonitor:
                     logger.info(f"📋 Обнаружено копирование текста от @{user.get('username', 'Неизвестно')}")
                     return alert
         
+        # Дословный повтор сообщения из нашего чата; короткие фразы
+        # ("спасибо большое") повторяются сами по себе и не проверяются
+        original = self.message_cache.find_copy(text) if len(text) >= FINGERPRINT_MIN_LENGTH else None
+        if (original and original.chat_id in self.our_chats
+                and (original.chat_id, original.message_id) != (chat.get("id"), message.get("message_id"))
+                and (original.chat_id != chat.get("id") or original.user_id != user.get("id"))):
+            is_leak = chat.get("id") not in self.our_chats
+            source_chat = self.chats.get(original.chat_id)
+            
+            alert = AlertData(
+                alert_id=self._make_alert_id("COPY", message),
+                type=AlertType.COPY_DETECTED,
+                severity=Severity.HIGH if is_leak else Severity.MEDIUM,
+                user_id=user.get("id", 0),
+                username=user.get("username", user.get("first_name", "Неизвестно")),
+                chat_id=chat.get("id", 0),
+                chat_title=chat.get("title", f"Chat {chat.get('id', 0)}"),
+                message_id=message.get("message_id", 0),
+                timestamp=datetime.now().strftime(ALERT_TIMESTAMP_FORMAT),
+                details={
+                    "detection_method": "Повтор ранее отправленного сообщения",
+                    "original_message_id": original.message_id,
+                    "original_author_id": original.user_id,
+                    "copied_text_preview": original.text[:100],
+                    "is_exact_copy": True,
+                    "is_our_chat_leak": is_leak,
+                    "analysis_confidence": "Высокая"
+                },
+                confidence=90 if is_leak else 80,
+                source_chat_id=original.chat_id,
+                source_chat_title=source_chat.title if source_chat else None
+            )
+            
+            logger.info(f"📋 Повтор сообщения из чата {original.chat_id} от @{user.get('username', 'Неизвестно')}")
+            return alert
+        
+        # Почти-дубликат текста из нашего чата (вставка с правками)
+        if sketch is None and len(text) >= FINGERPRINT_MIN_LENGTH:
+            sketch = self.fingerprints.sketch(text[:self.message_cache.max_text])
+        found = self.fingerprints.find(
+            sketch, (chat.get("id"), message.get("message_id")), FINGERPRINT_THRESHOLD, user.get("id")
+        )
+        if found:
+            is_leak = chat.get("id") not in self.our_chats
+            source_chat = self.chats.get(found.chat_id)
+            source_text = self.message_cache.get(found.chat_id, found.message_id)
+            
+            alert = AlertData(
+                alert_id=self._make_alert_id("COPY", message),
+                type=AlertType.COPY_DETECTED,
+                severity=Severity.HIGH if is_leak else Severity.MEDIUM,
+                user_id=user.get("id", 0),
+                username=user.get("username", user.get("first_name", "Неизвестно")),
+                chat_id=chat.get("id", 0),
+                chat_title=chat.get("title", f"Chat {chat.get('id', 0)}"),
+                message_id=message.get("message_id", 0),
+                timestamp=datetime.now().strftime(ALERT_TIMESTAMP_FORMAT),
+                details={
+                    "detection_method": "Отпечаток текста (MinHash)",
+                    "similarity": f"{found.similarity * 100:.0f}%",
+                    "original_message_id": found.message_id,
+                    "original_author_id": found.user_id,
+                    "copied_text_preview": source_text.text[:100] if source_text else None,
+                    "reply_text_preview": text[:100],
+                    "is_our_chat_leak": is_leak,
+                    "analysis_confidence": "Высокая" if found.similarity >= 0.9 else "Средняя"
+                },
+                confidence=int(60 + 35 * found.similarity),
+                source_chat_id=found.chat_id,
+                source_chat_title=source_chat.title if source_chat else None
+            )
+            
+            logger.info(f"📋 Текст из чата {found.chat_id} повторён на {found.similarity:.0%}")
+            return alert
+        
         # Также проверяем паттерны копирования в тексте
-        copy_patterns = [
-            r'скопировал',
-            r'copy',
-            r'copied',
-            r'сохранил',
-            r'saved',
-            r'взял текст',
-            r'text copied'
-        ]
+        found = self.detector.detect("copy", text)
+        if not found:
+            return None
         
-        for pattern in copy_patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                alert = AlertData(
-                    alert_id=f"COPY_{int(time.time())}_{message.get('message_id', 0)}",
-                    type=AlertType.COPY,
-                    severity=Severity.LOW,
-                    user_id=user.get("id", 0),
-                    username=user.get("username", user.get("first_name", "Неизвестно")),
-                    chat_id=chat.get("id", 0),
-                    chat_title=chat.get("title", f"Chat {chat.get('id', 0)}"),
-                    message_id=message.get("message_id", 0),
-                    timestamp=datetime.now().strftime("%H:%M:%S %d.%m.%Y"),
-                    details={
-                        "detection_method": "Анализ ключевых слов",
-                        "pattern_matched": pattern,
-                        "message_text": text[:200],
-                        "contains_copy_keyword": True,
-                        "analysis_confidence": "Средняя"
-                    },
-                    confidence=70
-                )
-                
-                logger.info(f"📝 Обнаружено упоминание копирования")
-                return alert
+        alert = AlertData(
+            alert_id=self._make_alert_id("COPY", message),
+            type=AlertType.COPY,
+            severity=Severity.LOW,
+            user_id=user.get("id", 0),
+            username=user.get("username", user.get("first_name", "Неизвестно")),
+            chat_id=chat.get("id", 0),
+            chat_title=chat.get("title", f"Chat {chat.get('id', 0)}"),
+            message_id=message.get("message_id", 0),
+            timestamp=datetime.now().strftime(ALERT_TIMESTAMP_FORMAT),
+            details={
+                "detection_method": "Анализ ключевых слов",
+                "pattern_matched": found.pattern,
+                "message_text": text[:200],
+                "contains_copy_keyword": True,
+                "analysis_confidence": "Средняя"
+            },
+            confidence=70
+        )
         
-        return None
+        logger.info(f"📝 Обнаружено упоминание копирования")
+        return alert
     
     def _send_alert(self, alert: AlertData):
         """Отправить оповещение всем админам"""
-        # Сохраняем событие
-        self.save_event(alert)
+        if self.upstream:
+            # Группировка, рассылка и история - в главном процессе
+            self.upstream.send("alert", _alert_to_wire(alert))
+            return
         
-        # Отправляем всем админам
-        for admin_id in self.allowed_ids:
-            try:
-                if self.tg.send_alert(admin_id, alert):
-                    logger.info(f"✅ Оповещение отправлено админу {admin_id}")
-                else:
-                    logger.error(f"❌ Не удалось отправить админу {admin_id}")
-            except Exception as e:
-                logger.error(f"Ошибка отправки админу {admin_id}: {e}")
+        group_id, send_now = self.aggregator.add(alert)
+        
+        # Сохраняем событие (каждое, даже если оно войдёт в сводку)
+        self.save_event(alert, group_id)
+        
+        # Открытые дашборды получают событие сразу
+        self.stream.publish("alert", {
+            "time": alert.timestamp,
+            "type": alert.type.value,
+            "user": alert.username or alert.user_id,
+            "severity": alert.severity.value,
+            "alert_id": alert.alert_id,
+            "user_id": alert.user_id,
+            "chat_id": alert.chat_id,
+            "chat_title": alert.chat_title,
+            "confidence": alert.confidence,
+            "group_id": group_id,
+            "notified": send_now
+        })
+        
+        # Отправляем всем админам (параллельно, в фоне)
+        if send_now:
+            self.notifier.notify(self.allowed_ids, self.tg._format_alert_message(alert))
+    
+    def _send_digest(self, group: AlertGroup):
+        """Отправить сводку по группе оповещений"""
+        logger.info(f"📦 Сводка {group.group_id}: ещё {group.suppressed} событий")
+        self.stream.publish("digest", {
+            "group_id": group.group_id,
+            "total": group.total,
+            "suppressed": group.suppressed,
+            "severity": group.severity.value
+        })
+        self.notifier.notify(self.allowed_ids, self.tg._format_digest_message(group, self.aggregator.window))
     
     def _handle_command(self, user_id: int, text: str):
         """Обработать команду от админа"""
+        if self.upstream:
+            self.upstream.send("command", (user_id, text))
+            return
+        
         if text == '/monitor':
             stats_msg = self._get_monitor_stats()
             self._send_simple_message(user_id, stats_msg)
         elif text == '/chats':
             chats_msg = self._get_chats_list()
             self._send_simple_message(user_id, chats_msg)
+        elif text == '/risk':
+            self._send_simple_message(user_id, self._get_risk_list())
+    
+    def _collect_metrics(self) -> List[Tuple[str, str, Dict, float]]:
+        """Числовые значения stats() компонентов как gauge для /metrics"""
+        components = {
+            "ingest": self.ingest,
+            "persistence": self.writer,
+            "message_cache": self.message_cache,
+            "fingerprints": self.fingerprints,
+            "notifier": self.notifier,
+            "aggregator": self.aggregator,
+            "admin_resolver": self.admin_resolver,
+            "stream": self.stream,
+            "poller": self.poller,
+            "user_cache": self.users,
+            "chat_cache": self.chats
+        }
+        users, chats = self.directory_totals()
+        samples = [
+            ("tgmon_users", "Пользователей в базе", {}, users),
+            ("tgmon_chats", "Чатов в базе", {}, chats),
+            ("tgmon_our_chats", "Наших чатов", {}, len(self.our_chats))
+        ]
+        for component, source in components.items():
+            if source is None:
+                continue
+            for key, value in source.stats().items():
+                name = f"tgmon_{component}_{key}"
+                if isinstance(value, dict):
+                    for kind, item in value.items():
+                        if isinstance(item, (int, float)):
+                            samples.append((name, f"{component}.{key}", {"kind": kind}, item))
+                elif isinstance(value, (int, float)):
+                    samples.append((name, f"{component}.{key}", {}, value))
+        return samples
+    
+    def stats_snapshot(self) -> Tuple[str, Dict]:
+        """ETag и тело /api/stats (пересобирается только при изменениях)"""
+        (version, bucket), metrics = self.metrics.snapshot()
+        users, chats = self.directory_totals()
+        etag = f"{version}-{bucket}-{users}-{chats}-{len(self.our_chats)}"
+        cached = self._stats_snapshot
+        if cached is not None and cached[0] == etag:
+            return cached
+        
+        totals = metrics["totals"]
+        body = {
+            "stats": {
+                "screenshots": totals.get("screenshots", 0),
+                "forwards": totals.get("forwards", 0),
+                "copies": totals.get("copies", 0),
+                "chats": chats,
+                "our_chats": len(self.our_chats),
+                "users": users
+            },
+            "events": metrics,
+            "system": {
+                "version": "v3.0 (Fixed)",
+                "status": "active",
+                "features": [
+                    "✅ Определение скриншотов",
+                    "✅ Определение пересылок",
+                    "✅ Определение копирования",
+                    "✅ Идентификация пользователей"
+                ]
+            },
+            "last_update": datetime.now().isoformat()
+        }
+        self._stats_snapshot = (etag, body)
+        return self._stats_snapshot
     
     def _get_monitor_stats(self) -> str:
         """Получить статистику мониторинга"""
-        total_screenshots = sum(u.screenshot_count for u in self.users.values())
-        total_forwards = sum(u.forward_count for u in self.users.values())
-        total_copies = sum(u.copy_count for u in self.users.values())
+        totals = self.metrics.snapshot()[1]["totals"]
+        users, chats = self.directory_totals()
+        total_screenshots = totals.get("screenshots", 0)
+        total_forwards = totals.get("forwards", 0)
+        total_copies = totals.get("copies", 0)
         
         return f"""
 📊 <b>СТАТИСТИКА МОНИТОРИНГА</b>
@@ -768,8 +5274,8 @@ class FixedTelegramMonitor:
 ├ 📸 Скриншотов: {total_screenshots}
 ├ 📨 Пересылок: {total_forwards}
 ├ 📋 Копирований: {total_copies}
-├ 👥 Пользователей: {len(self.users)}
-├ 💬 Чатов: {len(self.chats)}
+├ 👥 Пользователей: {users}
+├ 💬 Чатов: {chats}
 └ 🔐 Наших чатов: {len(self.our_chats)}
 
 <b>Система:</b>
@@ -790,78 +5296,103 @@ class FixedTelegramMonitor:
     
     def _get_chats_list(self) -> str:
         """Получить список чатов"""
-        our_chats = [c for c in self.chats.values() if c.is_our_chat]
-        other_chats = [c for c in self.chats.values() if not c.is_our_chat]
+        # Из хранилища читаются только показываемые строки
+        our_count = self.storage.count_chats(our=True)
+        other_count = self.storage.count_chats(our=False)
+        our_chats = self.storage.list_chats(our=True, limit=10)
+        other_chats = self.storage.list_chats(our=False, limit=5)
         
         msg = f"""
 📋 <b>СПИСОК ЧАТОВ</b>
 
-<b>Наши чаты ({len(our_chats)}):</b>
-{chr(10).join([f'├ {c.title} (ID: {c.chat_id})' for c in our_chats[:10]])}
-{'' if len(our_chats) <= 10 else f'└ ... и ещё {len(our_chats) - 10}'}
+<b>Наши чаты ({our_count}):</b>
+{chr(10).join([f'├ {c.title} (ID: {c.chat_id})' for c in our_chats])}
+{'' if our_count <= 10 else f'└ ... и ещё {our_count - 10}'}
 
-<b>Другие чаты ({len(other_chats)}):</b>
-{chr(10).join([f'├ {c.title} (ID: {c.chat_id})' for c in other_chats[:5]])}
-{'' if len(other_chats) <= 5 else f'└ ... и ещё {len(other_chats) - 5}'}
+<b>Другие чаты ({other_count}):</b>
+{chr(10).join([f'├ {c.title} (ID: {c.chat_id})' for c in other_chats])}
+{'' if other_count <= 5 else f'└ ... и ещё {other_count - 5}'}
 
-<b>Всего чатов:</b> {len(self.chats)}
+<b>Всего чатов:</b> {our_count + other_count}
+"""
+        return msg
+    
+    def risk_ranking(self, limit: int = 20) -> List[Dict]:
+        """Самые рискованные пользователи из топа TrustScorer (без обхода users)"""
+        ranking = []
+        for user_id, risk in self.trust.top(limit):
+            user = self.users.get(user_id)
+            ranking.append({
+                "user_id": user_id,
+                "username": user.username if user else None,
+                "trust_score": max(0, round(self.trust.base - risk)),
+                "risk": round(risk, 2),
+                "screenshots": user.screenshot_count if user else 0,
+                "forwards": user.forward_count if user else 0,
+                "copies": user.copy_count if user else 0
+            })
+        return ranking
+    
+    def _get_risk_list(self) -> str:
+        """Получить список самых рискованных пользователей"""
+        ranking = self.risk_ranking(10)
+        lines = [
+            f"├ @{_html(entry['username'] or entry['user_id'])}: доверие {entry['trust_score']} "
+            f"(📸 {entry['screenshots']} · 📨 {entry['forwards']} · 📋 {entry['copies']})"
+            for entry in ranking
+        ]
+        
+        msg = f"""
+⚠️ <b>ГРУППА РИСКА</b>
+
+{chr(10).join(lines) or '✅ Нарушений пока не было'}
+
+<i>Штрафы затухают вдвое за {TRUST_HALF_LIFE_HOURS:g} ч</i>
 """
         return msg
     
     def _send_simple_message(self, chat_id: int, text: str):
         """Отправить простое сообщение"""
-        try:
-            url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-            data = {
-                "chat_id": chat_id,
-                "text": text,
-                "parse_mode": "HTML",
-                "disable_web_page_preview": True
-            }
-            requests.post(url, json=data, timeout=10)
-        except Exception as e:
-            logger.error(f"Send simple message error: {e}")
+        self.notifier.notify([chat_id], text)
 
 # ========== FLASK APP ==========
 app = Flask(__name__)
 monitor = FixedTelegramMonitor(TELEGRAM_TOKEN, ALLOWED_IDS)
+atexit.register(monitor.shutdown)
 
 # ========== ВЕБХУК ==========
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    """Основной обработчик вебхука"""
+def accept_update(update) -> Tuple[Dict, int]:
+    """Принять обновление вебхука (или список обновлений): (тело ответа, HTTP-статус).
+    
+    Общая часть для Flask и ASGI (asgi.py).
+    """
     try:
-        update = request.json
+        updates = update if isinstance(update, list) else [update]
+        if not updates or not all(isinstance(item, dict) for item in updates):
+            return {"ok": False, "error": "invalid update"}, 400
         
-        # Логируем получение
-        logger.info(f"📥 Получен вебхук")
-        
-        # Обработка добавления бота в чат
-        if 'my_chat_member' in update:
-            chat_member = update['my_chat_member']
-            chat = chat_member.get('chat', {})
-            chat_id = chat.get('id')
-            
-            # Добавляем как наш чат
-            monitor.save_chat(
-                chat_id=chat_id,
-                title=chat.get('title', f'Chat {chat_id}'),
-                username=chat.get('username'),
-                chat_type=chat.get('type', 'unknown'),
-                is_our=True
-            )
-            
-            logger.info(f"🤖 Бот добавлен в наш чат: {chat.get('title', chat_id)}")
+        logger.debug(f"📥 Получен вебхук {updates[0].get('update_id')} ({len(updates)} шт.)")
         
-        # Обработка сообщений
-        elif 'message' in update:
-            monitor.process_message(update['message'])
+        # Обработка идёт в фоне, Telegram получает ответ сразу.
+        # При переполненной очереди отвечаем 503 - отправитель повторит доставку,
+        # а уже принятые обновления отсеет окно повторов
+        for item in updates:
+            if not monitor.ingest.submit(item):
+                logger.warning("⏳ Очередь обновлений переполнена")
+                return {"ok": False, "error": "ingest queue is full"}, 503
         
-        return jsonify({"ok": True})
+        return {"ok": True}, 200
         
     except Exception as e:
         logger.error(f"❌ Ошибка вебхука: {e}", exc_info=True)
-        return jsonify({"ok": False, "error": str(e)}), 500
+        return {"ok": False, "error": str(e)}, 500
+
+@app.route('/webhook', methods=['POST'])
+@METRICS.timed("webhook")
+def webhook():
+    """Основной обработчик вебхука"""
+    body, status = accept_update(request.get_json(silent=True))
+    return jsonify(body), status
 
 # ========== НАСТРОЙКА ВЕБХУКА ==========
 @app.route('/setup', methods=['GET'])
@@ -877,15 +5408,10 @@ def setup_webhook():
         webhook_url = f"{base_url}/webhook"
         
         # Устанавливаем вебхук
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/setWebhook"
-        data = {
-            "url": webhook_url,
-            "max_connections": 100,
-            "allowed_updates": ["message", "edited_message", "my_chat_member"]
-        }
-        
-        response = requests.post(url, json=data)
-        result = response.json()
+        if monitor.runtime:
+            result = monitor.runtime.run(monitor.runtime.api.set_webhook(webhook_url))
+        else:
+            result = monitor.tg.set_webhook(webhook_url)
         
         if result.get("ok"):
             success_msg = f"""
@@ -904,21 +5430,13 @@ def setup_webhook():
 <b>📊 Команды:</b>
 • /monitor - статистика системы
 • /chats - список чатов
+• /risk - группа риска
 
 <i>Система готова к работе. Добавьте бота в чаты.</i>
 """
             
             # Отправляем сообщение админам
-            for admin_id in ALLOWED_IDS:
-                try:
-                    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-                    requests.post(url, json={
-                        "chat_id": admin_id,
-                        "text": success_msg,
-                        "parse_mode": "HTML"
-                    })
-                except:
-                    pass
+            monitor.notifier.notify(ALLOWED_IDS, success_msg)
             
             return jsonify({
                 "success": True,
@@ -942,55 +5460,182 @@ def index():
 
 @app.route('/api/stats')
 def api_stats():
-    total_screenshots = sum(u.screenshot_count for u in monitor.users.values())
-    total_forwards = sum(u.forward_count for u in monitor.users.values())
-    total_copies = sum(u.copy_count for u in monitor.users.values())
+    etag, body = monitor.stats_snapshot()
+    # Дашборд опрашивает часто: без изменений отвечаем 304 без тела
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(body)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@app.route('/api/dashboard')
+def api_dashboard():
+    """История событий: фильтры и курсор в query string"""
+    args = request.args
+    try:
+        limit = min(max(args.get("limit", HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+        page = monitor.storage.event_page(
+            limit=limit,
+            user_id=args.get("user_id", type=int),
+            chat_id=args.get("chat_id", type=int),
+            event_type=args.get("type"),
+            severity=args.get("severity"),
+            since=args.get("since", type=float),
+            until=args.get("until", type=float),
+            cursor=args.get("cursor")
+        )
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    
+    with_details = args.get("details") == "1"
+    return jsonify({
+        "recent_alerts": [event.to_dict(with_details) for event in page.events],
+        "next_cursor": page.next_cursor
+    })
+
+@app.route('/api/risk')
+def api_risk():
+    """Самые рискованные пользователи с текущим (затухшим) доверием"""
+    limit = min(max(request.args.get("limit", 20, type=int), 1), TRUST_TOP_K)
+    return jsonify({"users": monitor.risk_ranking(limit), "half_life_hours": TRUST_HALF_LIFE_HOURS})
+
+@app.route('/api/rollups')
+def api_rollups():
+    """Почасовые и дневные свёртки вынесенных событий"""
+    args = request.args
+    try:
+        rollups = monitor.storage.rollups(
+            period=args.get("period", "day"),
+            chat_id=args.get("chat_id", type=int),
+            user_id=args.get("user_id", type=int),
+            since=args.get("since", type=float),
+            until=args.get("until", type=float),
+            limit=min(max(args.get("limit", HISTORY_MAX_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+        )
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    return jsonify({"rollups": rollups})
+
+def _last_event_id(value: Optional[str]) -> Optional[int]:
+    """Номер события из Last-Event-ID / query string"""
+    if not value:
+        return None
+    return int(value)
+
+@app.route('/api/stream')
+def api_stream():
+    """Живой поток событий (Server-Sent Events)"""
+    try:
+        last_id = _last_event_id(request.headers.get("Last-Event-ID") or request.args.get("last_event_id"))
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid last event id"}), 400
+    
+    subscriber = monitor.stream.subscribe(last_id)
+    if subscriber is None:
+        return jsonify({"ok": False, "error": "too many subscribers"}), 503
     
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                events = monitor.stream.take(subscriber, STREAM_HEARTBEAT_SECONDS)
+                if events is None:
+                    break
+                if not events:
+                    # Пинг держит соединение через прокси
+                    yield ": ping\n\n"
+                    continue
+                yield "".join(event.encode() for event in events)
+            
+            if subscriber.overflowed:
+                # Клиент переподключится с Last-Event-ID и дочитает из истории
+                yield StreamEvent(None, "overflow", {}).encode()
+        finally:
+            monitor.stream.unsubscribe(subscriber)
+    
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@app.route('/api/poll')
+def api_poll():
+    """Long-poll для клиентов без EventSource"""
+    try:
+        after = _last_event_id(request.args.get("after"))
+    except ValueError:
+        return jsonify({"ok": False, "error": "invalid event id"}), 400
+    
+    timeout = min(request.args.get("timeout", STREAM_POLL_TIMEOUT, type=float), STREAM_POLL_TIMEOUT)
+    events, last_id = monitor.stream.poll(after, timeout)
+    return jsonify({
+        "events": [event.to_dict() for event in events],
+        "last_event_id": last_id
+    })
+
+@app.route('/metrics')
+def metrics():
+    """Метрики процесса в текстовом формате Prometheus"""
+    return Response(METRICS.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route('/api/runtime')
+def api_runtime():
     return jsonify({
-        "stats": {
-            "screenshots": total_screenshots,
-            "forwards": total_forwards,
-            "copies": total_copies,
-            "chats": len(monitor.chats),
-            "our_chats": len(monitor.our_chats),
-            "users": len(monitor.users)
-        },
-        "system": {
-            "version": "v3.0 (Fixed)",
-            "status": "active",
-            "features": [
-                "✅ Определение скриншотов",
-                "✅ Определение пересылок",
-                "✅ Определение копирования",
-                "✅ Идентификация пользователей"
-            ]
-        },
+        "ingest": monitor.ingest.stats(),
+        "persistence": monitor.writer.stats(),
+        "storage": monitor.storage.stats(),
+        "user_cache": monitor.users.stats(),
+        "chat_cache": monitor.chats.stats(),
+        "maintenance": monitor.maintenance.stats() if monitor.maintenance else None,
+        "message_cache": monitor.message_cache.stats(),
+        "fingerprints": monitor.fingerprints.stats(),
+        "trust": monitor.trust.stats(),
+        "notifier": monitor.notifier.stats(),
+        "aggregator": monitor.aggregator.stats(),
+        "admin_resolver": monitor.admin_resolver.stats(),
+        "stream": monitor.stream.stats(),
+        "poller": monitor.poller.stats() if monitor.poller else None,
+        "async_runtime": monitor.runtime.stats() if monitor.runtime else None,
         "last_update": datetime.now().isoformat()
     })
 
 # ========== ЗАПУСК ==========
-if __name__ == "__main__":
+def startup():
+    """Баннер, проверка бота и запуск опроса (общее для Flask и asgi.py)"""
     logger.info("=" * 70)
     logger.info("🚀 ЗАПУСК ИСПРАВЛЕННОГО TELEGRAM MONITOR v3.0")
     logger.info("=" * 70)
     logger.info(f"🤖 Token: {'✓' if TELEGRAM_TOKEN else '✗'}")
     logger.info(f"👮 Allowed IDs: {len(ALLOWED_IDS)} users")
-    logger.info(f"💬 Чатов в базе: {len(monitor.chats)}")
+    logger.info(f"💬 Чатов в базе: {monitor.directory_totals()[1]}")
     logger.info(f"🔐 Наших чатов: {len(monitor.our_chats)}")
-    logger.info(f"👥 Пользователей: {len(monitor.users)}")
+    logger.info(f"👥 Пользователей: {monitor.directory_totals()[0]}")
     logger.info(f"🌐 Port: {PORT}")
+    logger.info(f"📥 Обновления: {INGEST_MODE}")
+    logger.info(f"🗄 Хранилище событий: {monitor.storage.name}")
+    logger.info(f"⚙️ Исходящие запросы: {RUNTIME}")
     logger.info("=" * 70)
     
     # Проверяем бота
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getMe"
-        response = requests.get(url, timeout=10)
-        if response.json().get("ok"):
-            bot = response.json()["result"]
+        if monitor.runtime:
+            result = monitor.runtime.run(monitor.runtime.api.get_me())
+        else:
+            result = monitor.tg.get_me()
+        if result.get("ok"):
+            bot = result["result"]
             logger.info(f"✅ Бот: @{bot.get('username')} (ID: {bot.get('id')})")
         else:
-            logger.error(f"❌ Ошибка бота: {response.json().get('description')}")
+            logger.error(f"❌ Ошибка бота: {result.get('description')}")
     except Exception as e:
         logger.error(f"❌ Не удалось подключиться к боту: {e}")
     
+    # Без вебхука: сами забираем обновления, веб-интерфейс работает как обычно
+    if monitor.poller:
+        monitor.poller.start()
+
+if __name__ == "__main__":
+    startup()
     app.run(host="0.0.0.0", port=PORT, debug=False)
\ No newline at end of file
@@ -0,0 +1,193 @@
+"""ASGI-вход монитора.
+
+Запуск:
+    RUNTIME=async uvicorn asgi:application --host 0.0.0.0 --port 10000
+    python asgi.py            # то же самое, порт из PORT
+
+POST /webhook обрабатывается прямо в цикле событий: тело читается
+без потока на соединение, обновление уходит в очередь обработки.
+Остальные пути (веб-интерфейс, API, SSE) отдаются Flask-приложением
+через мост WSGI в пуле потоков. Исходящие запросы к Bot API идут
+через AsyncRuntime из app.py (RUNTIME=async выставляется по умолчанию).
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, List, Tuple
+
+os.environ.setdefault("RUNTIME", "async")
+
+import app as tgmon
+
+# Потоки для Flask: каждый SSE-подписчик держит поток, пока ждёт событие
+WSGI_THREADS = int(os.environ.get("WSGI_THREADS", tgmon.STREAM_MAX_SUBSCRIBERS + 16))
+MAX_BODY_BYTES = int(os.environ.get("MAX_BODY_BYTES", 1024 * 1024))
+
+_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix="wsgi")
+
+# ========== ОБЩЕЕ ==========
+async def _read_body(receive, limit: int = MAX_BODY_BYTES) -> Tuple[bytes, bool]:
+    """Тело запроса и признак, что клиент ещё на связи"""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return b"", False
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > limit:
+            raise ValueError("request body is too large")
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks), True
+
+async def _send_json(send, body: Dict, status: int = 200):
+    data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(data)).encode())]
+    })
+    await send({"type": "http.response.body", "body": data})
+
+# ========== ВЕБХУК ==========
+async def webhook(scope, receive, send):
+    """POST /webhook без потоков: разбор и постановка в очередь"""
+    started = time.perf_counter()
+    try:
+        try:
+            raw, connected = await _read_body(receive)
+        except ValueError as e:
+            await _send_json(send, {"ok": False, "error": str(e)}, 413)
+            return
+        if not connected:
+            return
+        
+        try:
+            update = json.loads(raw) if raw else None
+        except ValueError:
+            update = None
+        
+        body, status = tgmon.accept_update(update)
+        await _send_json(send, body, status)
+    finally:
+        tgmon.METRICS.observe("tgmon_stage_seconds", ("webhook",), time.perf_counter() - started)
+
+# ========== МОСТ WSGI ==========
+def _environ(scope, body: bytes) -> Dict:
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    for name, value in scope.get("headers", []):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif key != "CONTENT_LENGTH":
+            key = f"HTTP_{key}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+async def wsgi_bridge(scope, receive, send):
+    """Отдать запрос Flask в пуле потоков; ответ идёт по мере генерации"""
+    loop = asyncio.get_running_loop()
+    try:
+        body, connected = await _read_body(receive)
+    except ValueError as e:
+        await _send_json(send, {"ok": False, "error": str(e)}, 413)
+        return
+    if not connected:
+        return
+    
+    started: List = []
+    
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(" ", 1)[0]), headers]
+    
+    result = await loop.run_in_executor(_executor, tgmon.app.wsgi_app, _environ(scope, body), start_response)
+    chunks = iter(result)
+    
+    # Клиент ушёл - прекращаем отдавать поток (важно для SSE)
+    disconnected = asyncio.Event()
+    
+    async def watch():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        disconnected.set()
+    
+    watcher = asyncio.create_task(watch())
+    try:
+        first = await loop.run_in_executor(_executor, next, chunks, None)
+        status, headers = started
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+        })
+        chunk = first
+        while chunk is not None and not disconnected.is_set():
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            chunk = await loop.run_in_executor(_executor, next, chunks, None)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        watcher.cancel()
+        if hasattr(result, "close"):
+            await loop.run_in_executor(_executor, result.close)
+
+# ========== ПРИЛОЖЕНИЕ ==========
+async def lifespan(receive, send):
+    loop = asyncio.get_running_loop()
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await loop.run_in_executor(None, tgmon.startup)
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await loop.run_in_executor(None, tgmon.monitor.shutdown)
+            _executor.shutdown(wait=False, cancel_futures=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope, receive, send):
+    """ASGI 3"""
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif scope["type"] == "http":
+        if scope["path"] == "/webhook" and scope["method"] == "POST":
+            await webhook(scope, receive, send)
+        else:
+            await wsgi_bridge(scope, receive, send)
+
+if __name__ == "__main__":
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("uvicorn is required: pip install uvicorn")
+    uvicorn.run(application, host="0.0.0.0", port=tgmon.PORT, log_level="info")
@@ -0,0 +1,699 @@
+"""Бенчмарки Telegram Monitor.
+
+Запуск:
+    python bench.py detector [--messages 50000]
+    python bench.py render [--alerts 20000] [--admins 5]
+    python bench.py memory [--users 200000]
+    python bench.py history [--rows 1000000]
+    python bench.py storage [--rows 200000]
+    python bench.py polling [--updates 20000]
+    python bench.py replay [--input updates.jsonl] [--batch 100] [--baseline bench_baseline.json]
+
+База создаётся во временном каталоге, сеть не используется (Bot API
+подменяет fake_bot_api.py).
+"""
+import gc
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import logging
+import tempfile
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="tgmon_bench_"), "bench.db"))
+
+import app
+import fake_bot_api
+
+logging.getLogger("app").setLevel(logging.WARNING)
+
+# ========== КОРПУС ==========
+WORDS_RU = [
+    "привет", "как", "дела", "сегодня", "встреча", "в", "офисе", "договорились", "отчёт",
+    "пришлю", "завтра", "смотри", "файл", "нужно", "проверить", "цифры", "по", "проекту",
+    "пользователь", "обнаружен", "сделал", "ок", "спасибо", "текст", "сообщение", "чат",
+]
+WORDS_EN = [
+    "hi", "the", "meeting", "is", "moved", "to", "friday", "please", "review", "draft",
+    "user", "made", "a", "report", "thanks", "will", "send", "later", "check", "numbers",
+]
+SCREENSHOT_NOTES = [
+    "Пользователь @{u} сделал снимок экрана",
+    "{u} сделал скриншот",
+    "@{u} заскринил",
+    "User @{u} made a screenshot",
+    "{u} took a screenshot",
+    "Screenshot detected from @{u}",
+    "Користувач @{u} зробив знімок екрану",
+]
+COPY_NOTES = [
+    "я скопировал твой текст",
+    "copied that, thanks",
+    "сохранил себе",
+    "взял текст отсюда",
+]
+
+def make_corpus(size: int, seed: int = 42) -> list:
+    """Синтетическая переписка: в основном шум, немного уведомлений"""
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        roll = rnd.random()
+        user = f"user{rnd.randint(1, 5000)}"
+        if roll < 0.01:
+            corpus.append(rnd.choice(SCREENSHOT_NOTES).format(u=user))
+        elif roll < 0.03:
+            corpus.append(rnd.choice(COPY_NOTES))
+        else:
+            words = WORDS_RU if rnd.random() < 0.7 else WORDS_EN
+            corpus.append(" ".join(rnd.choice(words) for _ in range(rnd.randint(3, 40))))
+    return corpus
+
+# ========== ДЕТЕКТОР ==========
+def legacy_detect(text: str):
+    """Прежняя схема: список шаблонов собирается и перебирается на каждое сообщение"""
+    screenshot_patterns = [(p, g) for p, g in app.DEFAULT_SCREENSHOT_PATTERNS]
+    for pattern, _ in screenshot_patterns:
+        if re.search(pattern, text, re.IGNORECASE):
+            return pattern
+    
+    copy_patterns = [p for p, _ in app.DEFAULT_COPY_PATTERNS]
+    for pattern in copy_patterns:
+        if re.search(pattern, text, re.IGNORECASE):
+            return pattern
+    return None
+
+def engine_detect(detector: "app.PatternDetector", text: str):
+    """Новая схема: скомпилированные семейства с фильтром по словам"""
+    found = detector.detect("screenshot", text) or detector.detect("copy", text)
+    return found.pattern if found else None
+
+def bench_detector(args):
+    corpus = make_corpus(args.messages)
+    detector = app.PatternDetector()
+    
+    mismatches = sum(1 for text in corpus[:5000] if legacy_detect(text) != engine_detect(detector, text))
+    
+    results = {}
+    for name, fn in (("legacy", legacy_detect), ("engine", lambda t: engine_detect(detector, t))):
+        fn(corpus[0])  # прогрев кэша re
+        started = time.perf_counter()
+        for text in corpus:
+            fn(text)
+        elapsed = time.perf_counter() - started
+        results[name] = len(corpus) / elapsed
+    
+    print(f"Сообщений: {len(corpus)}, расхождений с прежней логикой: {mismatches}")
+    print(f"{'схема':<10}{'msg/s':>14}")
+    for name, rate in results.items():
+        print(f"{name:<10}{rate:>14,.0f}")
+    print(f"Ускорение: x{results['engine'] / results['legacy']:.1f}")
+
+# ========== ФОРМАТИРОВАНИЕ ОПОВЕЩЕНИЙ ==========
+def legacy_format(alert: "app.AlertData") -> str:
+    """Прежняя схема: словарь типов, конкатенация деталей, без экранирования"""
+    type_config = {
+        app.AlertType.SCREENSHOT: ("📸", "#FF5252"),
+        app.AlertType.FORWARD_OUT: ("🚨", "#FF4081"),
+        app.AlertType.FORWARD_IN: ("📨", "#2196F3"),
+        app.AlertType.COPY: ("📋", "#FF9800"),
+        app.AlertType.COPY_DETECTED: ("📝", "#FF9800")
+    }
+    emoji, color = type_config.get(alert.type, ("🔔", "#2196F3"))
+    
+    details_html = ""
+    for key, value in alert.details.items():
+        if key.startswith("_"):
+            continue
+        if isinstance(value, bool):
+            display_value = "✅ Да" if value else "❌ Нет"
+        elif isinstance(value, list):
+            display_value = ", ".join(str(v) for v in value[:3])
+            if len(value) > 3:
+                display_value += f" ... (+{len(value)-3})"
+        elif value is None:
+            display_value = "—"
+        else:
+            display_value = str(value)
+        formatted_key = key.replace("_", " ").title()
+        details_html += f"<b>├ {formatted_key}:</b> {display_value}\n"
+    
+    message = f"""
+{emoji} <b>СИСТЕМА ОБНАРУЖЕНИЯ</b>
+<b>Тип:</b> {alert.type.value}
+<b>Серьёзность:</b> {alert.severity.value}
+<b>Уверенность:</b> {alert.confidence}%
+
+<b>👤 ПОЛЬЗОВАТЕЛЬ</b>
+├ <b>Username:</b> @{alert.username}
+├ <b>User ID:</b> <code>{alert.user_id}</code>
+
+<b>💬 КОНТЕКСТ</b>
+├ <b>Чат:</b> {alert.chat_title}
+├ <b>Chat ID:</b> <code>{alert.chat_id}</code>
+├ <b>Message ID:</b> <code>{alert.message_id}</code>
+├ <b>Время:</b> {alert.timestamp}
+
+<b>📊 ДЕТАЛИ</b>
+{details_html}
+"""
+    if alert.type == app.AlertType.FORWARD_OUT and alert.source_chat_title:
+        message += f"""
+<b>📍 НАПРАВЛЕНИЕ ПЕРЕСЫЛКИ</b>
+├ <b>Из чата:</b> {alert.source_chat_title}
+├ <b>В чат:</b> {alert.chat_title}
+└ <b>⚠️ УТЕЧКА ИЗ ЗАЩИЩЕННОГО ЧАТА!</b>
+"""
+    elif alert.type == app.AlertType.FORWARD_IN and alert.source_chat_title:
+        message += f"""
+<b>📍 НАПРАВЛЕНИЕ ПЕРЕСЫЛКИ</b>
+├ <b>Из чата:</b> {alert.source_chat_title}
+├ <b>В чат:</b> {alert.chat_title}
+└ <b>📥 ВХОДЯЩЕЕ СООБЩЕНИЕ</b>
+"""
+    message += f"\n<code>ID: {alert.alert_id}</code>"
+    return message.strip()
+
+def make_alerts(count: int, seed: int = 42) -> list:
+    """Оповещения всех типов с деталями, как у детекторов"""
+    rnd = random.Random(seed)
+    corpus = make_corpus(count, seed)
+    types = list(app.AlertType)
+    alerts = []
+    for i, text in enumerate(corpus):
+        alert_type = rnd.choice(types)
+        user_id = rnd.randint(1, 5000)
+        chat_id = -1000000000000 - rnd.randint(1, 500)
+        forward = alert_type in (app.AlertType.FORWARD_OUT, app.AlertType.FORWARD_IN)
+        alerts.append(app.AlertData(
+            alert_id=f"bench_{i}",
+            type=alert_type,
+            severity=rnd.choice(list(app.Severity)),
+            user_id=user_id,
+            username=f"user{user_id}",
+            chat_id=chat_id,
+            chat_title=f"Chat {chat_id}",
+            message_id=i,
+            timestamp="12:00:00 01.01.2026",
+            details={
+                "message_preview": text[:100],
+                "pattern_matched": "снимок экрана",
+                "is_reply": rnd.random() < 0.3,
+                "mentioned_users": [f"user{rnd.randint(1, 5000)}" for _ in range(rnd.randint(0, 5))],
+                "similarity": None,
+                "_internal": 1
+            },
+            confidence=rnd.randint(50, 100),
+            source_chat_id=chat_id - 1 if forward else None,
+            source_chat_title=f"Chat {chat_id - 1}" if forward else None
+        ))
+    return alerts
+
+def bench_render(args):
+    alerts = make_alerts(args.alerts)
+    renderer = app.AlertRenderer()
+    admins = range(args.admins)
+    
+    # На тексте без спецсимволов HTML результат должен совпасть с прежним
+    mismatches = sum(1 for alert in alerts[:5000] if legacy_format(alert) != renderer.render(alert))
+    
+    schemes = (
+        # Прежде: рендер на каждого админа
+        ("legacy", lambda alert: [legacy_format(alert) for _ in admins]),
+        # Теперь: один рендер на всю рассылку
+        ("template", lambda alert: [renderer.render(alert)] * len(admins)),
+    )
+    results = {}
+    for name, fn in schemes:
+        fn(alerts[0])
+        started = time.perf_counter()
+        for alert in alerts:
+            fn(alert)
+        results[name] = (time.perf_counter() - started) / len(alerts) * 1e6
+    
+    hostile = alerts[0]
+    hostile.username = "<b>x</b>"
+    hostile.chat_title = "A & B <script>"
+    escaped = "&lt;b&gt;x&lt;/b&gt;" in renderer.render(hostile) and "A &amp; B &lt;script&gt;" in renderer.render(hostile)
+    
+    print(f"Оповещений: {len(alerts)}, админов: {args.admins}, расхождений с прежним текстом: {mismatches}, "
+          f"экранирование: {'да' if escaped else 'НЕТ'}")
+    print(f"{'схема':<10}{'мкс/оповещение':>18}")
+    for name, cost in results.items():
+        print(f"{name:<10}{cost:>18.1f}")
+    print(f"Ускорение: x{results['legacy'] / results['template']:.1f}")
+    return 0 if not mismatches and escaped else 1
+
+# ========== ПАМЯТЬ СПРАВОЧНИКА ==========
+@dataclass
+class LegacyUserData:
+    """Прежняя запись: __dict__, ISO-строки, строки из каждой строки базы"""
+    user_id: int
+    username: str
+    first_name: str
+    trust_score: int = 100
+    screenshot_count: int = 0
+    forward_count: int = 0
+    copy_count: int = 0
+    last_seen: str = None
+
+@dataclass
+class LegacyChatData:
+    chat_id: int
+    title: str
+    username: Optional[str]
+    type: str
+    is_our_chat: bool = False
+    added_at: str = None
+    message_count: int = 0
+
+FIRST_NAMES = ["Алексей", "Мария", "Иван", "Ольга", "Дмитрий", "Анна", "Сергей", "Елена",
+               "Alex", "Maria", "John", "Kate", "Max", "Olga", "Pavel", "Nina"]
+
+def user_rows(count: int, seed: int = 42):
+    """Строки users в том виде, в каком их отдаёт sqlite3: новые str на каждую строку"""
+    rnd = random.Random(seed)
+    start = time.time() - 90 * 86400
+    for user_id in range(1, count + 1):
+        seen = datetime.fromtimestamp(start + rnd.random() * 90 * 86400).isoformat()
+        yield (user_id, f"user{user_id}", "%s" % rnd.choice(FIRST_NAMES), 100,
+               rnd.randint(0, 3), rnd.randint(0, 3), rnd.randint(0, 3), seen, None)
+
+def chat_rows(count: int, seed: int = 42):
+    rnd = random.Random(seed)
+    for i in range(1, count + 1):
+        chat_id = -1000000000000 - i
+        yield (chat_id, f"Chat {chat_id}", None, "%s" % rnd.choice(["group", "supergroup", "channel"]),
+               i % 2, datetime.fromtimestamp(time.time() - i).isoformat(), 0)
+
+def measure_memory(build, rows) -> float:
+    """Прирост памяти на запись (tracemalloc), байт"""
+    gc.collect()
+    tracemalloc.start()
+    kept = build(rows)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return size
+
+def bench_memory(args):
+    index_key = lambda name: name.lstrip('@').lower()
+    
+    def legacy_users(rows):
+        users, index = {}, {}
+        for row in rows:
+            user = users[row[0]] = LegacyUserData(*row[:8])
+            index[index_key(user.username)] = user.user_id
+        return users, index
+    
+    def compact_users(rows):
+        users, index = {}, {}
+        for row in rows:
+            user = users[row[0]] = app.SQLiteStorage._user(row)
+            index[app.UsernameIndex.key(user.username)] = user.user_id
+        return users, index
+    
+    def legacy_chats(rows):
+        return {row[0]: LegacyChatData(*row) for row in rows}
+    
+    def compact_chats(rows):
+        return {row[0]: app.SQLiteStorage._chat(row) for row in rows}
+    
+    results = [
+        ("users", args.users, measure_memory(legacy_users, user_rows(args.users)),
+         measure_memory(compact_users, user_rows(args.users))),
+        ("chats", args.chats, measure_memory(legacy_chats, chat_rows(args.chats)),
+         measure_memory(compact_chats, chat_rows(args.chats))),
+    ]
+    
+    print(f"{'справочник':<12}{'записей':>10}{'было, Б/зап.':>15}{'стало, Б/зап.':>16}{'экономия':>10}")
+    for name, count, legacy, compact in results:
+        print(f"{name:<12}{count:>10,}{legacy / count:>15.0f}{compact / count:>16.0f}{1 - compact / legacy:>10.0%}")
+    print(f"Пример: {app.SQLiteStorage._user(next(user_rows(1)))}")
+    return 0
+
+# ========== ИСТОРИЯ СОБЫТИЙ ==========
+def make_events(rows: int, users: int, chats: int, seed: int = 42):
+    """Синтетическая история событий за 90 дней (строки INSERT_EVENT_SQL)"""
+    rnd = random.Random(seed)
+    types = [t.value for t in app.AlertType]
+    severities = [s.value for s in app.Severity]
+    start = time.time() - 90 * 86400
+    step = 90 * 86400 / rows
+    
+    for i in range(rows):
+        user_id = rnd.randint(1, users)
+        chat_id = -rnd.randint(1, chats)
+        created_at = start + i * step
+        yield (
+            f"bench_{i}", rnd.choice(types), rnd.choice(severities), user_id, f"user{user_id}",
+            chat_id, f"Chat {chat_id}", i, time.strftime("%H:%M:%S %d.%m.%Y", time.localtime(created_at)),
+            '{"note": "bench"}', 90, None, None, created_at, f"bench_{i}"
+        )
+
+def fill_events(conn, rows: int, users: int, chats: int, seed: int = 42):
+    """Заполнить events синтетической историей за 90 дней"""
+    with conn:
+        conn.executemany(app.INSERT_EVENT_SQL, make_events(rows, users, chats, seed))
+    conn.execute("ANALYZE")
+
+def measure(history, runs: int, make_filters) -> list:
+    """Время первой страницы в мс для runs разных фильтров"""
+    timings = []
+    for _ in range(runs):
+        filters = make_filters()
+        started = time.perf_counter()
+        history.page(limit=50, **filters)
+        timings.append((time.perf_counter() - started) * 1000)
+    return sorted(timings)
+
+def bench_history(args):
+    conn = app.monitor.conn
+    rnd = random.Random(7)
+    
+    started = time.perf_counter()
+    fill_events(conn, args.rows, args.users, args.chats)
+    print(f"Событий: {args.rows:,} (заполнение {time.perf_counter() - started:.1f} с)")
+    
+    history = app.monitor.storage.history
+    now = time.time()
+    types = list(app.AlertType.__members__)
+    severities = list(app.Severity.__members__)
+    deep = history.page(limit=5000).next_cursor
+    scenarios = [
+        ("все события", lambda: {}),
+        ("пользователь", lambda: {"user_id": rnd.randint(1, args.users)}),
+        ("чат", lambda: {"chat_id": -rnd.randint(1, args.chats)}),
+        ("тип", lambda: {"event_type": rnd.choice(types)}),
+        ("важность", lambda: {"severity": rnd.choice(severities)}),
+        ("пользователь+тип", lambda: {"user_id": rnd.randint(1, args.users), "event_type": rnd.choice(types)}),
+        ("чат за сутки", lambda: {"chat_id": -rnd.randint(1, args.chats), "since": now - 86400}),
+        ("неделя месяц назад", lambda: {"since": now - 37 * 86400, "until": now - 30 * 86400}),
+        ("страница 101", lambda: {"cursor": deep}),
+    ]
+    
+    print(f"{'фильтр':<22}{'p50, мс':>10}{'p99, мс':>10}  план")
+    worst = 0.0
+    for name, make_filters in scenarios:
+        timings = measure(history, args.runs, make_filters)
+        p50 = timings[len(timings) // 2]
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        worst = max(worst, p99)
+        sql, params = history.build_query(limit=51, **make_filters())
+        plan = " | ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+        print(f"{name:<22}{p50:>10.2f}{p99:>10.2f}  {plan}")
+    
+    # Для сравнения: та же глубокая страница через OFFSET
+    started = time.perf_counter()
+    conn.execute("SELECT * FROM events ORDER BY created_at DESC, id DESC LIMIT 50 OFFSET 5000").fetchall()
+    print(f"OFFSET 5000 для сравнения: {(time.perf_counter() - started) * 1000:.2f} мс")
+    print(f"Худший p99: {worst:.2f} мс ({'OK' if worst < args.budget_ms else 'ПРЕВЫШЕН'} при бюджете {args.budget_ms} мс)")
+
+# ========== ХРАНИЛИЩЕ ==========
+def open_storage(backend: str, directory: str) -> "app.Storage":
+    """Чистое хранилище со схемой рабочей базы"""
+    path = os.path.join(directory, f"{backend}.db")
+    conn = app.open_database(path)
+    for (sql,) in app.monitor.conn.execute(
+        "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY type DESC"
+    ):
+        conn.execute(sql)
+    
+    lock = threading.RLock()
+    if backend == "eventlog":
+        return app.EventLogStorage(conn, lock, path, os.path.join(directory, "event_log"))
+    return app.SQLiteStorage(conn, lock, path)
+
+def bench_storage(args):
+    rows = list(make_events(args.rows, args.users, args.chats))
+    rnd = random.Random(7)
+    print(f"Событий: {args.rows:,}, пачка: {args.batch}")
+    print(f"{'хранилище':<12}{'событий/с':>12}{'p99 пачки, мс':>16}{'страница p50, мс':>18}")
+    
+    for backend in ("sqlite", "eventlog"):
+        storage = open_storage(backend, tempfile.mkdtemp(prefix=f"tgmon_{backend}_"))
+        
+        batches = []
+        started = time.perf_counter()
+        for i in range(0, len(rows), args.batch):
+            batch_started = time.perf_counter()
+            storage.write_batch([], [], [], [], rows[i:i + args.batch], [])
+            batches.append((time.perf_counter() - batch_started) * 1000)
+        rate = len(rows) / (time.perf_counter() - started)
+        
+        pages = []
+        for _ in range(args.runs):
+            filters = {"user_id": rnd.randint(1, args.users)}
+            page_started = time.perf_counter()
+            storage.event_page(limit=50, **filters)
+            pages.append((time.perf_counter() - page_started) * 1000)
+        
+        print(f"{backend:<12}{rate:>12,.0f}{percentile(sorted(batches), 0.99):>16.2f}{percentile(sorted(pages), 0.5):>18.2f}")
+        storage.close()
+
+# ========== ОПРОС getUpdates ==========
+def bench_polling(args):
+    api = fake_bot_api.FakeBotAPI(fake_bot_api.make_updates(args.updates, chats=args.chats))
+    server = fake_bot_api.serve(api)
+    tg = app.EnhancedTelegramAPI("123:bench", api_base=f"http://127.0.0.1:{server.server_address[1]}")
+    
+    ingest = app.monitor.ingest
+    done_before = ingest.processed + ingest.failed
+    poller = app.UpdatePoller(tg, app.monitor.conn, app.monitor.db_lock, ingest, limit=args.limit, timeout=1)
+    
+    started = time.perf_counter()
+    poller.start()
+    while ingest.processed + ingest.failed - done_before < args.updates:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    poller.close()
+    server.shutdown()
+    
+    stats = poller.stats()
+    print(f"Обновлений: {args.updates:,}, вызовов getUpdates: {stats['polls']}, средняя пачка: {stats['avg_batch']}")
+    print(f"Время: {elapsed:.2f} с, {args.updates / elapsed:,.0f} upd/s (от getUpdates до конца обработки)")
+    print(f"Ожиданий переполненной очереди: {stats['queue_full_waits']}, сохранённый offset: {poller._load_offset()}")
+
+# ========== ПРОГОН КОНВЕЙЕРА ==========
+# Этапы process_message: (объект, метод)
+REPLAY_STAGES = [
+    ("save_user", lambda m: m, "save_user"),
+    ("message_cache", lambda m: m.message_cache, "put"),
+    ("sketch", lambda m: m.fingerprints, "sketch"),
+    ("check_screenshot", lambda m: m, "_check_screenshot"),
+    ("check_forward", lambda m: m, "_check_forward"),
+    ("check_copy", lambda m: m, "_check_copy"),
+    ("send_alert", lambda m: m, "_send_alert"),
+    ("save_event", lambda m: m, "save_event"),
+    ("sqlite_flush", lambda m: m.writer, "flush"),
+    ("outbox", lambda m: m.notifier, "notify"),
+]
+
+class StubResponse:
+    """Ответ Bot API без сети"""
+    status_code = 200
+    
+    def json(self):
+        return {"ok": True, "result": {"message_id": 1, "status": "member"}}
+
+def percentile(values: list, q: float) -> float:
+    """Перцентиль по отсортированному списку"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+def instrument(obj, name: str, timings: list):
+    """Подменить метод экземпляра обёрткой с замером времени"""
+    original = getattr(obj, name)
+    
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            timings.append(time.perf_counter() - started)
+    
+    setattr(obj, name, timed)
+
+def load_updates(args) -> list:
+    """Обновления из JSONL или синтетические"""
+    if args.input:
+        with open(args.input, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    
+    updates = fake_bot_api.make_updates(args.updates, chats=args.chats)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            for update in updates:
+                f.write(json.dumps(update, ensure_ascii=False) + "\n")
+    return updates
+
+def bench_replay(args):
+    updates = load_updates(args)
+    monitor = app.monitor
+    
+    # Сеть заглушена; оповещения проходят весь путь до очереди outbox
+    monitor.tg.session.post = lambda *a, **kw: StubResponse()
+    monitor.allowed_ids = [1]
+    
+    # Половина чатов - наши, чтобы работали проверки утечек
+    chat_ids = sorted({u["message"]["chat"]["id"] for u in updates if "message" in u})
+    for chat_id in chat_ids[::2]:
+        monitor.save_chat(chat_id, f"Chat {chat_id}", "", "supergroup", True)
+    
+    timings = {name: [] for name, _, _ in REPLAY_STAGES}
+    for name, target, method in REPLAY_STAGES:
+        instrument(target(monitor), method, timings[name])
+    
+    # Время на обновление; в пачке - среднее по пачке
+    totals = []
+    started = time.perf_counter()
+    for offset in range(0, len(updates), args.batch):
+        batch = updates[offset:offset + args.batch]
+        batch_started = time.perf_counter()
+        monitor.process_updates(batch)
+        totals.extend([(time.perf_counter() - batch_started) / len(batch)] * len(batch))
+    monitor.writer.flush()
+    elapsed = time.perf_counter() - started
+    
+    totals.sort()
+    result = {
+        "updates": len(updates),
+        "throughput": round(len(updates) / elapsed, 1),
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "p50_us": round(percentile(totals, 0.5) * 1e6, 1),
+        "p99_us": round(percentile(totals, 0.99) * 1e6, 1),
+        "stages": {}
+    }
+    
+    print(f"Обновлений: {len(updates):,}, {result['throughput']:,.0f} upd/s, "
+          f"p50 {result['p50_us']:.0f} мкс, p99 {result['p99_us']:.0f} мкс")
+    print(f"{'этап':<18}{'вызовов':>10}{'p50, мкс':>11}{'p99, мкс':>11}{'всего, мс':>11}{'доля':>7}")
+    for name, values in timings.items():
+        values.sort()
+        total = sum(values)
+        stage = {
+            "calls": len(values),
+            "p50_us": round(percentile(values, 0.5) * 1e6, 1),
+            "p99_us": round(percentile(values, 0.99) * 1e6, 1),
+            "total_ms": round(total * 1000, 1)
+        }
+        result["stages"][name] = stage
+        print(f"{name:<18}{stage['calls']:>10,}{stage['p50_us']:>11.1f}{stage['p99_us']:>11.1f}"
+              f"{stage['total_ms']:>11.1f}{total / elapsed:>7.1%}")
+    
+    if args.write_baseline:
+        with open(args.write_baseline, "w", encoding="utf-8") as f:
+            json.dump({"replay": result}, f, ensure_ascii=False, indent=2)
+        print(f"Базовая линия записана: {args.write_baseline}")
+    
+    if args.baseline:
+        return check_regression(result, args.baseline, args.tolerance)
+    return 0
+
+# Доля времени прогона, начиная с которой этап сравнивается с базовой линией
+STAGE_GATE_SHARE = 0.05
+# Разница p50 меньше этой (мкс) - шум планировщика, а не регрессия
+STAGE_GATE_MIN_US = 20
+
+# Абсолютные бюджеты p50 этапов, мкс: не зависят от базовой линии
+STAGE_BUDGETS_US = {
+    "check_copy": 1000,
+}
+
+def check_regression(result: dict, path: str, tolerance: float) -> int:
+    """Сравнить с базовой линией: 1 - если что-то стало медленнее допуска"""
+    with open(path, encoding="utf-8") as f:
+        baseline = json.load(f)["replay"]
+    
+    failures = []
+    if result["throughput"] < baseline["throughput"] * (1 - tolerance):
+        failures.append(f"throughput {result['throughput']:,.0f} < {baseline['throughput']:,.0f} upd/s")
+    for name, stage in baseline["stages"].items():
+        current = result["stages"].get(name)
+        # Этапы с малой долей времени слишком шумные для сравнения
+        if current is None or stage["total_ms"] < baseline["elapsed_ms"] * STAGE_GATE_SHARE:
+            continue
+        if (current["p50_us"] > stage["p50_us"] * (1 + tolerance)
+                and current["p50_us"] - stage["p50_us"] > STAGE_GATE_MIN_US):
+            failures.append(f"{name}: p50 {current['p50_us']:.1f} > {stage['p50_us']:.1f} мкс")
+    for name, budget in STAGE_BUDGETS_US.items():
+        current = result["stages"].get(name)
+        if current and current["calls"] and current["p50_us"] > budget:
+            failures.append(f"{name}: p50 {current['p50_us']:.1f} > бюджета {budget} мкс")
+    
+    if failures:
+        print(f"РЕГРЕССИЯ (допуск {tolerance:.0%}):")
+        for failure in failures:
+            print(f"  {failure}")
+        return 1
+    print(f"Регрессий нет (допуск {tolerance:.0%})")
+    return 0
+
+# ========== ЗАПУСК ==========
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки Telegram Monitor")
+    sub = parser.add_subparsers(dest="command", required=True)
+    
+    detector = sub.add_parser("detector", help="детектор шаблонов: до и после")
+    detector.add_argument("--messages", type=int, default=50000)
+    detector.set_defaults(func=bench_detector)
+    
+    render = sub.add_parser("render", help="форматирование оповещений: до и после")
+    render.add_argument("--alerts", type=int, default=20000)
+    render.add_argument("--admins", type=int, default=5)
+    render.set_defaults(func=bench_render)
+    
+    memory = sub.add_parser("memory", help="память справочника: байт на пользователя и чат")
+    memory.add_argument("--users", type=int, default=200000)
+    memory.add_argument("--chats", type=int, default=20000)
+    memory.set_defaults(func=bench_memory)
+    
+    history = sub.add_parser("history", help="постраничная история событий")
+    history.add_argument("--rows", type=int, default=1000000)
+    history.add_argument("--users", type=int, default=20000)
+    history.add_argument("--chats", type=int, default=500)
+    history.add_argument("--runs", type=int, default=200)
+    history.add_argument("--budget-ms", type=float, default=50)
+    history.set_defaults(func=bench_history)
+    
+    storage = sub.add_parser("storage", help="запись и чтение событий: SQLite и журнал сегментов")
+    storage.add_argument("--rows", type=int, default=200000)
+    storage.add_argument("--users", type=int, default=20000)
+    storage.add_argument("--chats", type=int, default=500)
+    storage.add_argument("--batch", type=int, default=500)
+    storage.add_argument("--runs", type=int, default=200)
+    storage.set_defaults(func=bench_storage)
+    
+    polling = sub.add_parser("polling", help="getUpdates через локальный Bot API, от запроса до обработки")
+    polling.add_argument("--updates", type=int, default=20000)
+    polling.add_argument("--chats", type=int, default=50)
+    polling.add_argument("--limit", type=int, default=100)
+    polling.set_defaults(func=bench_polling)
+    
+    replay = sub.add_parser("replay", help="прогон обновлений через конвейер с замером этапов")
+    replay.add_argument("--input", help="JSONL с обновлениями (по умолчанию - синтетические)")
+    replay.add_argument("--updates", type=int, default=5000)
+    replay.add_argument("--chats", type=int, default=50)
+    replay.add_argument("--batch", type=int, default=1, help="обновлений на вызов process_updates")
+    replay.add_argument("--save", help="сохранить синтетические обновления в JSONL")
+    replay.add_argument("--baseline", help="сравнить с базовой линией (код возврата 1 при регрессии)")
+    replay.add_argument("--tolerance", type=float, default=0.25)
+    replay.add_argument("--write-baseline", help="записать результат как базовую линию")
+    replay.set_defaults(func=bench_replay)
+    
+    args = parser.parse_args()
+    code = args.func(args)
+    app.monitor.shutdown()
+    return code
+
+if __name__ == "__main__":
+    sys.exit(main())
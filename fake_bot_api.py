@@ -0,0 +1,220 @@
+"""Локальный Bot API для тестов и бенчмарков.
+
+Запуск:
+    python fake_bot_api.py [--port 8081] [--updates 10000]
+
+Потом монитор направляется на него:
+    TELEGRAM_API_BASE=http://127.0.0.1:8081 TELEGRAM_TOKEN=123:fake INGEST_MODE=polling python app.py
+
+Поддерживаются getMe, getUpdates (offset/limit/timeout), deleteWebhook,
+setWebhook, sendMessage и getChatMember. Обновления генерируются заранее,
+отправленные сообщения только считаются. Сеть наружу не используется.
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+# ========== ГЕНЕРАТОР ОБНОВЛЕНИЙ ==========
+WORDS = [
+    "привет", "как", "дела", "встреча", "в", "офисе", "отчёт", "пришлю", "завтра",
+    "смотри", "файл", "нужно", "проверить", "цифры", "по", "проекту", "ок", "спасибо",
+    "the", "meeting", "is", "moved", "to", "friday", "please", "review", "draft",
+]
+SCREENSHOT_NOTES = [
+    "Пользователь @{u} сделал снимок экрана",
+    "@{u} заскринил",
+    "User @{u} made a screenshot",
+]
+
+SYLLABLES = ["ра", "то", "ми", "ка", "не", "по", "ст", "во", "ли", "да", "ен", "ко", "ны", "ре", "ло", "ва"]
+
+def make_vocabulary(rnd: random.Random, size: int = 5000) -> List[str]:
+    """Словарь: частые настоящие слова и длинный хвост из слогов"""
+    vocabulary = list(WORDS)
+    while len(vocabulary) < size:
+        vocabulary.append("".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(1, 4))))
+    return vocabulary
+
+def make_updates(count: int, chats: int = 50, users: int = 2000, seed: int = 42,
+                 first_update_id: int = 1) -> List[Dict]:
+    """Синтетические обновления: шум, ответы, пересылки, уведомления о скриншотах"""
+    rnd = random.Random(seed)
+    now = int(time.time())
+    
+    # Частоты слов по закону Ципфа, как в живой переписке
+    vocabulary = make_vocabulary(rnd)
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    
+    def phrase(low: int, high: int) -> str:
+        return " ".join(rnd.choices(vocabulary, weights, k=rnd.randint(low, high)))
+    
+    updates = []
+    for i in range(count):
+        chat_id = -1000000000000 - rnd.randint(1, chats)
+        user_id = rnd.randint(1, users)
+        message = {
+            "message_id": i + 1,
+            "date": now,
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+        }
+        
+        roll = rnd.random()
+        if roll < 0.01:
+            message["text"] = rnd.choice(SCREENSHOT_NOTES).format(u=f"user{rnd.randint(1, users)}")
+        elif roll < 0.03:
+            source_id = -1000000000000 - rnd.randint(1, chats)
+            message["forward_from_chat"] = {"id": source_id, "type": "supergroup", "title": f"Chat {source_id}"}
+            message["text"] = phrase(5, 30)
+        else:
+            message["text"] = phrase(3, 40)
+            if roll < 0.08 and i:
+                message["reply_to_message"] = {"message_id": rnd.randint(1, i), "chat": message["chat"]}
+        
+        updates.append({"update_id": first_update_id + i, "message": message})
+    return updates
+
+# ========== СЕРВЕР ==========
+class FakeBotAPI:
+    """Состояние фейкового Bot API"""
+    
+    def __init__(self, updates: Optional[List[Dict]] = None, admin_chats=(), rate_limit_every: int = 0):
+        self.updates: List[Dict] = list(updates or [])
+        self.admin_chats = set(admin_chats)
+        self.rate_limit_every = rate_limit_every
+        self.webhook_url = ""
+        
+        self._cond = threading.Condition()
+        self.get_updates_calls = 0
+        self.delivered = 0
+        self.sent: List[Tuple[int, str]] = []
+        self.rate_limited = 0
+    
+    def add_updates(self, updates: List[Dict]):
+        """Добавить обновления (разбудит ждущий getUpdates)"""
+        with self._cond:
+            self.updates.extend(updates)
+            self._cond.notify_all()
+    
+    def handle(self, method: str, payload: Dict) -> Tuple[int, Dict]:
+        """Ответ на вызов метода: (HTTP-статус, тело)"""
+        handler = getattr(self, f"_{method}", None)
+        if handler is None:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+        return handler(payload)
+    
+    def _getMe(self, payload: Dict):
+        return 200, {"ok": True, "result": {"id": 123, "is_bot": True, "username": "fake_monitor_bot"}}
+    
+    def _setWebhook(self, payload: Dict):
+        self.webhook_url = payload.get("url", "")
+        return 200, {"ok": True, "result": True}
+    
+    def _deleteWebhook(self, payload: Dict):
+        self.webhook_url = ""
+        return 200, {"ok": True, "result": True}
+    
+    def _getUpdates(self, payload: Dict):
+        if self.webhook_url:
+            return 409, {"ok": False, "error_code": 409,
+                         "description": "Conflict: can't use getUpdates method while webhook is active"}
+        
+        offset = int(payload.get("offset") or 0)
+        limit = max(1, min(int(payload.get("limit", 100)), 100))
+        timeout = float(payload.get("timeout", 0))
+        
+        with self._cond:
+            self.get_updates_calls += 1
+            # Как в Telegram: offset подтверждает всё, что раньше него
+            if offset:
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            self._cond.wait_for(lambda: self.updates, timeout)
+            batch = self.updates[:limit]
+            self.delivered += len(batch)
+        return 200, {"ok": True, "result": batch}
+    
+    def _sendMessage(self, payload: Dict):
+        with self._cond:
+            if self.rate_limit_every and (len(self.sent) + self.rate_limited + 1) % self.rate_limit_every == 0:
+                self.rate_limited += 1
+                return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                             "parameters": {"retry_after": 1}}
+            self.sent.append((payload.get("chat_id"), payload.get("text", "")))
+            message_id = len(self.sent)
+        return 200, {"ok": True, "result": {"message_id": message_id, "chat": {"id": payload.get("chat_id")}}}
+    
+    def _getChatMember(self, payload: Dict):
+        status = "administrator" if payload.get("chat_id") in self.admin_chats else "member"
+        return 200, {"ok": True, "result": {"status": status, "user": {"id": payload.get("user_id")}}}
+    
+    def pending(self) -> int:
+        with self._cond:
+            return len(self.updates)
+
+def make_handler(api: FakeBotAPI):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Заголовки и тело уходят разными write: без этого keep-alive ждёт delayed ACK
+        disable_nagle_algorithm = True
+        
+        def _dispatch(self, payload: Dict):
+            # /bot<token>/<method>
+            method = self.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+            status, body = api.handle(method, payload)
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            try:
+                payload = json.loads(raw) if raw else {}
+            except ValueError:
+                payload = {}
+            self._dispatch(payload)
+        
+        def do_GET(self):
+            self._dispatch({})
+        
+        def log_message(self, format, *args):
+            pass
+    
+    return Handler
+
+def serve(api: FakeBotAPI, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Запустить сервер в фоне; порт 0 - любой свободный"""
+    server = ThreadingHTTPServer((host, port), make_handler(api))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-bot-api", daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный Bot API для тестов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="каждый N-й sendMessage отвечает 429")
+    args = parser.parse_args()
+    
+    api = FakeBotAPI(make_updates(args.updates, chats=args.chats), rate_limit_every=args.rate_limit_every)
+    server = serve(api, args.host, args.port)
+    print(f"Fake Bot API: http://{args.host}:{server.server_address[1]} ({args.updates} обновлений)")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"getUpdates: {api.get_updates_calls}, выдано: {api.delivered}, "
+                  f"осталось: {api.pending()}, sendMessage: {len(api.sent)}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+"""Общая настройка тестов.
+
+app создаёт монитор при импорте, поэтому окружение задаётся до него:
+база во временном каталоге, без токена, обслуживания и фоновых опросов.
+"""
+import os
+import sys
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="tgmon_test_")
+os.environ.setdefault("DB_PATH", os.path.join(_tmp, "test.db"))
+os.environ.setdefault("EVENT_LOG_DIR", os.path.join(_tmp, "event_log"))
+os.environ.setdefault("MAINTENANCE_INTERVAL", "0")
+os.environ.pop("TELEGRAM_TOKEN", None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import app
+
+@pytest.fixture(scope="session", autouse=True)
+def _shutdown_monitor():
+    yield
+    app.monitor.shutdown()
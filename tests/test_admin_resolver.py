@@ -0,0 +1,37 @@
+"""ChatAdminResolver: кэш статуса бота ограничен по размеру"""
+import types
+
+from app import ChatAdminResolver
+
+def resolver(max_entries: int) -> ChatAdminResolver:
+    tg = types.SimpleNamespace(bot_id=None)  # без getChatMember: только обновления my_chat_member
+    return ChatAdminResolver(tg, lambda chat_id, status: None, max_entries=max_entries)
+
+def test_cache_is_bounded_and_keeps_recently_updated():
+    cache = resolver(3)
+    try:
+        for chat_id in (-1, -2, -3):
+            cache.update_from_member(chat_id, "administrator")
+        cache.update_from_member(-1, "administrator")  # -1 обновился последним
+        cache.update_from_member(-4, "left")
+        cache.update_from_member(-5, "member")
+        
+        assert cache.stats()["cached"] == 3
+        assert cache.evictions == 2
+        assert [cache.peek(chat_id) for chat_id in (-1, -2, -3, -4, -5)] == \
+            ["administrator", None, None, "left", "member"]
+    finally:
+        cache.close()
+
+def test_failed_lookup_keeps_known_status():
+    cache = resolver(10)
+    try:
+        cache.update_from_member(-1, "administrator")
+        cache._store(-1, None)
+        assert cache.peek(-1) == "administrator"
+        
+        cache._store(-2, None)
+        assert cache.peek(-2) is None
+        assert cache.stats()["cached"] == 2
+    finally:
+        cache.close()
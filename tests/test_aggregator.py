@@ -0,0 +1,46 @@
+"""AlertAggregator: окна группировки и сводки"""
+import threading
+import time
+
+from app import AlertAggregator, AlertData, AlertType, Severity
+
+def make_alert(alert_id: str, user_id: int = 1, severity: Severity = Severity.MEDIUM) -> AlertData:
+    return AlertData(alert_id, AlertType.SCREENSHOT, severity, user_id, "user", -100, "Чат", 1,
+                     "01.01.2026 00:00:00", {}, 80)
+
+def test_storm_collapses_into_one_digest():
+    digests = []
+    aggregator = AlertAggregator(digests.append, window=60)
+    try:
+        assert aggregator.add(make_alert("a1")) == ("a1", True)
+        assert aggregator.add(make_alert("a2", severity=Severity.HIGH)) == ("a1", False)
+        assert aggregator.add(make_alert("a3")) == ("a1", False)
+        assert aggregator.add(make_alert("b1", user_id=2)) == ("b1", True)
+    finally:
+        aggregator.close()
+    
+    assert len(digests) == 1
+    assert (digests[0].group_id, digests[0].total, digests[0].suppressed) == ("a1", 3, 2)
+    assert digests[0].severity == Severity.HIGH
+    assert aggregator.digests == 1
+
+def test_slow_digest_does_not_block_add():
+    started = threading.Event()
+    release = threading.Event()
+    
+    def on_digest(group):
+        started.set()
+        release.wait(5)
+    
+    aggregator = AlertAggregator(on_digest, window=0.05)
+    try:
+        aggregator.add(make_alert("a1"))
+        aggregator.add(make_alert("a2"))
+        assert started.wait(2)  # фоновый поток отдаёт сводку и висит в ней
+        
+        begun = time.monotonic()
+        assert aggregator.add(make_alert("b1", user_id=2)) == ("b1", True)
+        assert time.monotonic() - begun < 0.5
+    finally:
+        release.set()
+        aggregator.close()
@@ -0,0 +1,62 @@
+"""/api/dashboard: история событий и её вывод на странице"""
+import re
+import time
+
+import app
+
+def event_row(alert_id: str, chat_id: int, created_at: float, username: str = "user") -> tuple:
+    return (alert_id, "КОПИРОВАНИЕ", "СРЕДНИЙ", 1, username, chat_id, "Чат", 1,
+            "01.01.2026 00:00:00", "{}", 80, None, None, created_at, alert_id)
+
+def test_cursor_pages_are_stable_under_inserts():
+    writer = app.monitor.writer
+    chat_id = -7001
+    base = time.time() - 1000
+    for i in range(30):
+        writer.queue_event(event_row(f"page-{i}", chat_id, base + i))
+    writer.flush()
+    
+    client = app.app.test_client()
+    first = client.get(f"/api/dashboard?chat_id={chat_id}&limit=10").get_json()
+    
+    # Новые события между страницами не сдвигают следующие
+    for i in range(30, 40):
+        writer.queue_event(event_row(f"page-{i}", chat_id, base + i))
+    writer.flush()
+    
+    seen = [event["alert_id"] for event in first["recent_alerts"]]
+    cursor = first["next_cursor"]
+    while cursor:
+        page = client.get(f"/api/dashboard?chat_id={chat_id}&limit=10&cursor={cursor}").get_json()
+        seen.extend(event["alert_id"] for event in page["recent_alerts"])
+        cursor = page["next_cursor"]
+    
+    assert seen == [f"page-{i}" for i in range(29, -1, -1)]
+
+def test_bad_cursor_is_rejected():
+    response = app.app.test_client().get("/api/dashboard?cursor=not-a-cursor")
+    assert response.status_code == 400
+
+def test_script_in_first_name_is_escaped_on_dashboard():
+    name = "<script>alert(1)</script>"
+    app.monitor.process_updates([{
+        "update_id": 9001,
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": -7002, "title": "Чат", "type": "supergroup"},
+            "from": {"id": 7002, "first_name": name, "is_bot": False},
+            "text": "я скопировал твой текст"
+        }
+    }])
+    app.monitor.writer.flush()
+    
+    events = app.app.test_client().get("/api/dashboard?user_id=7002").get_json()["recent_alerts"]
+    assert [event["user"] for event in events] == [name]
+    
+    # API отдаёт данные как есть; страница вставляет поля событий только через escapeHtml
+    with open(app.app.jinja_loader.get_source(app.app.jinja_env, "index.html")[1], encoding="utf-8") as f:
+        page = f.read()
+    table = page[page.index("async function updateEventsTable"):page.index("function getAlertColor")]
+    assert re.findall(r"\$\{event\.\w+\}", table) == []
+    assert "${escapeHtml(event.user)}" in table
@@ -0,0 +1,66 @@
+"""Отпечатки текстов: поиск почти-дубликатов и его скорость"""
+import random
+import time
+
+from app import FingerprintIndex
+
+ORIGINAL = ("Квартальный отчёт по проекту: выручка выросла на 12 процентов, "
+            "расходы на инфраструктуру сократились, запуск переносим на март.")
+EDITED = ("Квартальный отчёт по проекту: выручка выросла на 12%, "
+          "расходы на инфраструктуру сократились, запуск переносим на март!")
+
+WORDS = ["привет", "встреча", "отчёт", "завтра", "файл", "проверить", "цифры", "проект",
+         "the", "meeting", "moved", "friday", "review", "draft", "send", "later"]
+
+def make_texts(count: int, seed: int = 7) -> list:
+    rnd = random.Random(seed)
+    return [" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(8, 40))) for _ in range(count)]
+
+def test_near_duplicate_across_chats():
+    index = FingerprintIndex()
+    index.add(-100, 1, 11, index.sketch(ORIGINAL))
+    
+    found = index.find(index.sketch(EDITED), (-200, 5), 0.7, 22)
+    assert found is not None
+    assert (found.chat_id, found.message_id, found.user_id) == (-100, 1, 11)
+    assert found.similarity >= 0.7
+
+def test_author_repeating_self_in_same_chat_is_ignored():
+    index = FingerprintIndex()
+    index.add(-100, 1, 11, index.sketch(ORIGINAL))
+    
+    assert index.find(index.sketch(EDITED), (-100, 2), 0.7, 11) is None
+    assert index.find(index.sketch(EDITED), (-100, 2), 0.7, 22) is not None
+
+def test_unrelated_text_does_not_match():
+    index = FingerprintIndex()
+    index.add(-100, 1, 11, index.sketch(ORIGINAL))
+    
+    other = "Совсем другой текст про погоду, выходные и поездку за город с друзьями."
+    assert index.find(index.sketch(other), (-200, 5), 0.7, 22) is None
+
+def test_similarity_matches_set_estimate():
+    index = FingerprintIndex()
+    texts = make_texts(200)
+    for a, b in zip(texts, texts[1:]):
+        sa, sb = index.sketch(a), index.sketch(b)
+        union = sorted(set(sa) | set(sb))
+        size = min(index.k, len(union))
+        expected = sum(1 for h in set(sa) & set(sb) if h <= union[size - 1]) / size
+        assert index.similarity(sa, sb) == expected
+
+def test_lookup_p50_under_1ms():
+    index = FingerprintIndex()
+    texts = make_texts(20000)
+    for i, text in enumerate(texts):
+        index.add(-(i % 50) - 1, i, i % 500, index.sketch(text))
+    
+    queries = [index.sketch(text) for text in make_texts(500, seed=8)]
+    timings = []
+    for i, sketch in enumerate(queries):
+        started = time.perf_counter()
+        index.find(sketch, (-999, i), 0.7, 1)
+        timings.append(time.perf_counter() - started)
+    
+    timings.sort()
+    assert timings[len(timings) // 2] < 0.001
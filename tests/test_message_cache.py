@@ -0,0 +1,89 @@
+"""Кэш сообщений: вытеснение по TTL, LRU, чату и памяти"""
+import time
+
+import app
+from app import MessageCache
+
+def test_get_and_find_copy_count_hits_and_misses():
+    cache = MessageCache()
+    cache.put(-100, 1, 11, "Отчёт пришлю завтра утром")
+    
+    assert cache.get(-100, 1).text == "Отчёт пришлю завтра утром"
+    assert cache.get(-100, 2) is None
+    assert cache.find_copy("  отчёт ПРИШЛЮ завтра   утром ").message_id == 1
+    assert cache.find_copy("другой текст") is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+def test_ttl_expires_on_get():
+    cache = MessageCache(ttl=0.05)
+    cache.put(-100, 1, 11, "текст")
+    time.sleep(0.1)
+    
+    assert cache.get(-100, 1) is None
+    assert cache.evictions["ttl"] == 1
+    assert len(cache) == 0
+
+def test_ttl_expires_on_find_copy():
+    cache = MessageCache(ttl=0.05)
+    cache.put(-100, 1, 11, "текст для поиска повтора")
+    time.sleep(0.1)
+    
+    assert cache.find_copy("текст для поиска повтора") is None
+    assert cache.evictions["ttl"] == 1
+    assert len(cache) == 0
+
+def test_access_does_not_extend_ttl():
+    cache = MessageCache(ttl=0.5)
+    cache.put(-100, 1, 11, "первое")
+    time.sleep(0.3)
+    cache.put(-100, 2, 11, "второе")
+    assert cache.get(-100, 1) is not None  # первое становится последним по LRU
+    time.sleep(0.3)
+    
+    # Первое устарело, хотя по LRU оно свежее второго
+    cache.put(-100, 3, 11, "третье")
+    assert cache.evictions["ttl"] == 1
+    assert cache.get(-100, 1) is None
+    assert cache.get(-100, 2) is not None
+
+def test_lru_eviction_keeps_recently_used():
+    cache = MessageCache(max_entries=2)
+    cache.put(-100, 1, 11, "один")
+    cache.put(-200, 2, 11, "два")
+    cache.get(-100, 1)
+    cache.put(-300, 3, 11, "три")
+    
+    assert cache.evictions["lru"] == 1
+    assert cache.get(-200, 2) is None
+    assert cache.get(-100, 1) is not None
+
+def test_per_chat_and_memory_limits():
+    cache = MessageCache(per_chat=2)
+    for message_id in range(5):
+        cache.put(-100, message_id, 11, f"сообщение {message_id}")
+    assert cache.evictions["chat"] == 3
+    assert cache.get(-100, 0) is None
+    assert cache.get(-100, 4) is not None
+    
+    cache = MessageCache(max_bytes=MessageCache.ENTRY_OVERHEAD * 3)
+    for message_id in range(5):
+        cache.put(-100, message_id, 11, f"сообщение {message_id}")
+    assert cache.evictions["memory"] >= 3
+    assert cache.bytes <= cache.max_bytes
+
+def test_short_exact_repeat_is_not_a_copy():
+    monitor = app.monitor
+    monitor.save_chat(-1001, "Наш чат", "", "supergroup", True)
+    
+    short = "спасибо большое, коллеги!"
+    monitor.message_cache.put(-1001, 1, 501, short)
+    message = {"message_id": 2, "chat": {"id": -1001}, "from": {"id": 502}, "text": short}
+    assert monitor._check_copy(message) is None
+    
+    long = "Пароль от стенда поменяли, новый лежит в закреплённом сообщении."
+    monitor.message_cache.put(-1001, 3, 501, long)
+    message = {"message_id": 4, "chat": {"id": -1001}, "from": {"id": 502}, "text": long}
+    alert = monitor._check_copy(message)
+    assert alert is not None
+    assert alert.type == app.AlertType.COPY_DETECTED
+    assert alert.details["original_message_id"] == 3
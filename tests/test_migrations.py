@@ -0,0 +1,34 @@
+"""Миграции схемы: user_version и статистика планировщика"""
+import os
+import types
+
+import pytest
+
+import app
+
+@pytest.fixture
+def database(tmp_path):
+    conn = app.open_database(os.path.join(tmp_path, "migrate.db"))
+    yield types.SimpleNamespace(conn=conn)
+    conn.close()
+
+def statements(conn, action) -> list:
+    traced = []
+    conn.set_trace_callback(traced.append)
+    try:
+        action()
+    finally:
+        conn.set_trace_callback(None)
+    return traced
+
+def test_analyze_runs_only_when_schema_changes(database):
+    app.FixedTelegramMonitor.init_database(database)
+    migrate = lambda: app.FixedTelegramMonitor.migrate_database(database)
+    
+    first = statements(database.conn, migrate)
+    assert "ANALYZE" in first
+    assert "PRAGMA analysis_limit = 1000" in first
+    assert database.conn.execute("PRAGMA user_version").fetchone()[0] == app.SCHEMA_VERSION
+    
+    # Перезапуск на актуальной схеме только читает user_version
+    assert statements(database.conn, migrate) == ["PRAGMA user_version"]
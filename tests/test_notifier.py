@@ -0,0 +1,102 @@
+"""AlertNotifier: outbox, 429 и повторы"""
+import os
+import threading
+import time
+import types
+
+import pytest
+
+import app
+
+OK = (200, {"ok": True, "result": {"message_id": 1}})
+RATE_LIMITED = (429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                      "parameters": {"retry_after": 1}})
+SERVER_ERROR = (502, {"ok": False, "description": "Bad Gateway"})
+BLOCKED = (403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"})
+
+class ScriptedAPI:
+    """Bot API с заранее заданными ответами sendMessage (последний повторяется)"""
+    
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+        self._lock = threading.Lock()
+    
+    def send_message(self, chat_id, text):
+        with self._lock:
+            self.calls.append((time.monotonic(), chat_id, text))
+            status, body = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        return app._send_result(status, body)
+
+@pytest.fixture
+def database(tmp_path):
+    db = types.SimpleNamespace(conn=app.open_database(os.path.join(tmp_path, "outbox.db")), lock=threading.RLock())
+    app.FixedTelegramMonitor.init_database(db)
+    app.FixedTelegramMonitor.migrate_database(db)
+    yield db
+    db.conn.close()
+
+def notifier(api, database) -> app.AlertNotifier:
+    return app.AlertNotifier(api, database.conn, database.lock, workers=2, global_rate=100, chat_rate=100)
+
+def outbox(database) -> list:
+    with database.lock:
+        return database.conn.execute("SELECT chat_id, text, attempts FROM outbox").fetchall()
+
+def wait_for(condition, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+def test_429_reschedules_for_retry_after(database):
+    api = ScriptedAPI(RATE_LIMITED, OK)
+    sender = notifier(api, database)
+    try:
+        sender.notify([42], "оповещение")
+        assert wait_for(lambda: sender.rate_limited == 1)
+        assert wait_for(lambda: outbox(database) == [(42, "оповещение", 1)])
+        assert wait_for(lambda: sender.sent == 1)
+    finally:
+        sender.close()
+    
+    assert len(api.calls) == 2
+    assert api.calls[1][0] - api.calls[0][0] >= 0.95
+    assert outbox(database) == []
+    assert (sender.retried, sender.failed) == (1, 0)
+
+def test_pending_rows_are_requeued_after_restart(database):
+    failing = ScriptedAPI(SERVER_ERROR)
+    first = notifier(failing, database)
+    first.notify([7, 8], "после перезапуска")
+    assert wait_for(lambda: len(failing.calls) == 2)
+    assert wait_for(lambda: sorted(outbox(database)) == [(7, "после перезапуска", 1), (8, "после перезапуска", 1)])
+    first.close()
+    
+    # Новый процесс поднимает outbox и досылает после паузы повтора
+    api = ScriptedAPI(OK)
+    second = notifier(api, database)
+    try:
+        assert second.stats()["pending"] == 2
+        assert wait_for(lambda: second.sent == 2, timeout=10)
+    finally:
+        second.close()
+    
+    assert sorted(chat_id for _, chat_id, _ in api.calls) == [7, 8]
+    assert outbox(database) == []
+
+def test_permanent_4xx_drops_the_row(database):
+    api = ScriptedAPI(BLOCKED)
+    sender = notifier(api, database)
+    try:
+        sender.notify([9], "не дойдёт")
+        assert wait_for(lambda: sender.failed == 1)
+        time.sleep(0.2)
+    finally:
+        sender.close()
+    
+    assert len(api.calls) == 1
+    assert outbox(database) == []
+    assert (sender.sent, sender.retried) == (0, 0)
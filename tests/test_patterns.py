@@ -0,0 +1,59 @@
+"""Фильтр шаблонов по обязательному слову"""
+import pytest
+
+from app import PatternDetector, PatternFamily, _required_literal
+
+@pytest.mark.parametrize("pattern, literal", [
+    (r"скопировал", "скопировал"),
+    (r"(foo)?bar", "bar"),
+    (r"ab(cde)*", None),
+    (r"(?:скопировал)?\s*текст", "текст"),
+    (r"(forwarded\s+)?from", "from"),
+    (r"(abcd)+?x", None),
+    (r"(abc)+x", "abc"),
+    (r"colou?r", "colo"),
+    (r"(?!spam)hello", "hello"),
+    (r"foo\.barbaz", "barbaz"),
+    (r"\(text\)copied", "copied"),
+    (r"copy|copied", None),
+    (r"[Сс]охранил", None),
+    (r"sa{2}ved", None),
+    (r"(?i)saved", None),
+])
+def test_required_literal(pattern, literal):
+    assert _required_literal(pattern) == literal
+
+@pytest.mark.parametrize("pattern, text", [
+    (r"(forwarded\s+)?from", "from @bob"),
+    (r"(forwarded\s+)?from", "forwarded from @bob"),
+    (r"(?:скопировал)?\s*текст", "вот текст"),
+    (r"ab(cde)*", "abcdecde"),
+    (r"ab(cde)*", "ab"),
+    (r"copy|сохранил", "я сохранил"),
+    (r"text\.copied", "text.copied"),
+])
+def test_filter_never_hides_a_regex_match(pattern, text):
+    family = PatternFamily("x", [(pattern, 0)])
+    found = family.search(text, text.lower())
+    assert found is not None
+    assert found.match.group(0)
+
+def test_filter_skips_text_without_required_word():
+    family = PatternFamily("x", [(r"(@?\w+)\s+заскринил", 1)])
+    assert family.search("просто текст", "просто текст") is None
+    assert family.search("@bob заскринил", "@bob заскринил").match.group(1) == "@bob"
+
+def test_default_patterns_match_like_plain_regex():
+    detector = PatternDetector()
+    texts = [
+        "Пользователь @bob сделал снимок экрана",
+        "alice took a screenshot",
+        "я скопировал твой текст",
+        "Text copied",
+        "ничего интересного",
+    ]
+    for text in texts:
+        for name, family in detector.families.items():
+            expected = next((p for p, c in zip(family.patterns, family.compiled) if c.search(text)), None)
+            found = family.search(text, text.lower())
+            assert (found.pattern if found else None) == (expected[0] if expected else None)
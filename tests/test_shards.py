@@ -0,0 +1,69 @@
+"""ShardRouter: порядок внутри чата и единственный писатель в базу"""
+import time
+
+import app
+
+class Parent:
+    """Главный процесс без своей обработки: только то, что вызывает ShardRouter"""
+    
+    def __init__(self):
+        self.alerts = []
+        self.rows = []
+        self.users = []
+        self.writer = self
+    
+    def _send_alert(self, alert):
+        self.alerts.append((alert.chat_id, alert.message_id))
+    
+    def _handle_command(self, user_id, text):
+        pass
+    
+    def _cache_chat(self, *args):
+        pass
+    
+    def _cache_user(self, *args):
+        self.users.append(args[0])
+    
+    def queue_batch(self, chats, users, usernames, fingerprints, events, user_stats):
+        self.rows.extend(row[0] for row in users)
+
+def make_update(update_id: int, chat_id: int, message_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "title": f"Chat {chat_id}", "type": "supergroup"},
+            "from": {"id": user_id, "first_name": "Тест", "username": f"shard_user_{user_id}"},
+            "text": f"я скопировал твой текст {message_id}"
+        }
+    }
+
+def test_per_chat_order_and_parent_is_the_only_writer():
+    parent = Parent()
+    router = app.ShardRouter(parent, 2, maxsize=1000)
+    chats = [-8001, -8002, -8003, -8004]
+    per_chat = 20
+    try:
+        update_id = 80000
+        for message_id in range(1, per_chat + 1):
+            for chat_id in chats:
+                update_id += 1
+                assert router.submit(make_update(update_id, chat_id, message_id, -chat_id))
+        
+        deadline = time.monotonic() + 60
+        while len(parent.alerts) < len(chats) * per_chat and time.monotonic() < deadline:
+            time.sleep(0.1)
+    finally:
+        router.shutdown()
+    
+    assert len(parent.alerts) == len(chats) * per_chat
+    for chat_id in chats:
+        order = [message_id for chat, message_id in parent.alerts if chat == chat_id]
+        assert order == list(range(1, per_chat + 1))
+    assert {router.shard_of(chat_id) for chat_id in chats} == {0, 1}
+    
+    # Строки пользователей пришли в главный процесс, сами шарды в базу не писали
+    assert sorted(set(parent.rows)) == sorted(-chat_id for chat_id in chats)
+    for chat_id in chats:
+        assert app.monitor.storage.get_user(-chat_id) is None
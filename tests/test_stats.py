@@ -0,0 +1,38 @@
+"""/api/stats: окно метрик и условные запросы по ETag"""
+import app
+
+def test_snapshot_reports_configured_window():
+    metrics = app.EventMetrics(bucket_seconds=300, history_hours=6)
+    metrics.record("screenshot", "HIGH", -100)
+    
+    _, data = metrics.snapshot()
+    assert data["window_hours"] == 6
+    assert data["last_window"] == {"screenshot": 1}
+    assert len(data["hourly"]) == 6
+    assert "last_24h" not in data
+
+def test_snapshot_is_reused_until_counters_change():
+    metrics = app.EventMetrics()
+    first = metrics.snapshot()
+    assert metrics.snapshot() is first
+    
+    metrics.record("forward", "MEDIUM", -100)
+    assert metrics.snapshot()[0] != first[0]
+
+def test_api_stats_etag_and_304():
+    client = app.app.test_client()
+    
+    response = client.get("/api/stats")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert response.get_json()["events"]["window_hours"] == app.METRICS_HISTORY_HOURS
+    
+    response = client.get("/api/stats", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+    assert response.headers["ETag"] == etag
+    
+    app.monitor.metrics.record("copy", "MEDIUM", -100)
+    response = client.get("/api/stats", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
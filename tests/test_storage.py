@@ -0,0 +1,138 @@
+"""Хранилища событий: общий контракт SQLite и журнала сегментов, восстановление журнала"""
+import os
+import random
+import threading
+import types
+
+import pytest
+
+import app
+
+TYPES = [item.value for item in app.AlertType]
+SEVERITIES = [item.value for item in app.Severity]
+
+def make_events(count: int, seed: int = 18, start: float = 1_700_000_000.0) -> list:
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(count):
+        user_id = rnd.randint(1, 20)
+        rows.append((
+            f"ev-{seed}-{i}", rnd.choice(TYPES), rnd.choice(SEVERITIES), user_id, f"user{user_id}",
+            -rnd.randint(1, 5), "Чат", i, "14:00:00 14.11.2023", '{"n": %d}' % i, 80,
+            None, None, start + i * 60, f"ev-{seed}-{i}"
+        ))
+    return rows
+
+def open_storage(backend: str, path) -> app.Storage:
+    db_path = os.path.join(path, f"{backend}.db")
+    db = types.SimpleNamespace(conn=app.open_database(db_path))
+    app.FixedTelegramMonitor.init_database(db)
+    app.FixedTelegramMonitor.migrate_database(db)
+    lock = threading.RLock()
+    if backend == "eventlog":
+        return app.EventLogStorage(db.conn, lock, db_path, os.path.join(path, "log"), segment_bytes=4096)
+    return app.SQLiteStorage(db.conn, lock, db_path)
+
+@pytest.fixture(params=["sqlite", "eventlog"])
+def storage(request, tmp_path):
+    store = open_storage(request.param, tmp_path)
+    yield store
+    store.close()
+    store.conn.close()
+
+def all_pages(storage: app.Storage, limit: int = 7, **filters) -> list:
+    events, cursor = [], None
+    while True:
+        page = storage.event_page(limit=limit, cursor=cursor, **filters)
+        events.extend(event.to_dict(True) for event in page.events)
+        cursor = page.next_cursor
+        if not cursor:
+            return events
+
+def expected_page(rows: list, user_id=None, chat_id=None, event_type=None, since=None, until=None) -> list:
+    ids = [
+        i + 1 for i, row in enumerate(rows)
+        if (user_id is None or row[3] == user_id) and (chat_id is None or row[5] == chat_id)
+        and (event_type is None or row[1] == event_type)
+        and (since is None or row[13] >= since) and (until is None or row[13] < until)
+    ]
+    return ids[::-1]
+
+@pytest.mark.parametrize("filters", [
+    {},
+    {"user_id": 3},
+    {"chat_id": -2},
+    {"event_type": "SCREENSHOT"},
+    {"user_id": 5, "event_type": app.AlertType.COPY.value},
+    {"since": 1_700_000_000.0 + 60 * 40, "until": 1_700_000_000.0 + 60 * 90},
+])
+def test_event_page_contract(storage, filters):
+    rows = make_events(150)
+    storage.write_batch([], [], [], [], rows[:100], [])
+    storage.write_batch([], [], [], [], rows[100:], [])
+    
+    expected_filters = dict(filters)
+    if expected_filters.get("event_type") == "SCREENSHOT":
+        expected_filters["event_type"] = app.AlertType.SCREENSHOT.value
+    events = all_pages(storage, **filters)
+    assert [event["id"] for event in events] == expected_page(rows, **expected_filters)
+    
+    for event in events:
+        row = rows[event["id"] - 1]
+        assert (event["alert_id"], event["type"], event["severity"], event["user_id"], event["chat_id"]) == \
+            (row[0], row[1], row[2], row[3], row[5])
+        assert event["details"] == {"n": event["id"] - 1}
+        assert event["created_at"] == row[13]
+
+def test_counts_and_directory_contract(storage):
+    rows = make_events(60)
+    storage.write_batch(
+        [(-1, "Чат", "", "supergroup", 1, "2023-11-14T14:00:00")],
+        [(1, "user1", "Один", "2023-11-14T14:00:00")],
+        [], [], rows, []
+    )
+    
+    expected = {}
+    for row in rows:
+        key = (row[1], row[2], row[5])
+        expected[key] = expected.get(key, 0) + 1
+    assert {tuple(item[:3]): item[3] for item in storage.event_counts()} == expected
+    
+    buckets = {}
+    for row in rows:
+        key = (int(row[13] // 600), row[1])
+        buckets[key] = buckets.get(key, 0) + 1
+    assert {(bucket, kind): count for bucket, kind, count in storage.event_buckets(600, 0)} == buckets
+    
+    assert storage.get_user(1).username == "user1"
+    assert storage.our_chat_ids() == [-1]
+
+def test_bad_cursor_is_rejected(storage):
+    with pytest.raises(ValueError):
+        storage.event_page(cursor="garbage")
+
+def test_torn_tail_is_truncated_on_recovery(tmp_path):
+    path = os.path.join(tmp_path, "log")
+    log = app.EventLog(path, segment_bytes=2048)
+    rows = make_events(40)
+    log.append(rows[:30])
+    log.close()
+    
+    # Процесс упал посреди записи: последняя строка без перевода строки
+    last = sorted(name for name in os.listdir(path) if name.endswith(".jsonl"))[-1]
+    segment = os.path.join(path, last)
+    intact = os.path.getsize(segment)
+    with open(segment, "ab") as f:
+        f.write(b'[31, "ev-torn", "\xd0\xa1\xd0')
+    
+    log = app.EventLog(path, segment_bytes=2048)
+    try:
+        assert os.path.getsize(segment) == intact
+        assert log.stats()["events"] == 30
+        
+        log.append(rows[30:])
+        page = log.page(limit=100)
+        assert [event.id for event in page.events] == list(range(40, 0, -1))
+        assert page.events[0].alert_id == rows[39][0]
+    finally:
+        log.close()
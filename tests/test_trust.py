@@ -0,0 +1,103 @@
+"""TrustScorer: затухание штрафов, топ-K и сид миграции v9"""
+import math
+import os
+import random
+import time
+import types
+
+import pytest
+
+import app
+from app import TrustScorer
+
+HALF_LIFE = 3600.0
+
+def approx(value: float):
+    return pytest.approx(value, rel=1e-9)
+
+def test_penalty_halves_over_one_half_life():
+    trust = TrustScorer(HALF_LIFE)
+    key = trust.penalize(None, 40, now=0)
+    
+    assert trust.risk(key, now=0) == approx(40)
+    assert trust.score(key, now=0) == 60
+    assert trust.risk(key, now=HALF_LIFE) == approx(20)
+    assert trust.score(key, now=HALF_LIFE) == 80
+    assert trust.score(None) == 100
+    
+    # Новый штраф складывается с уже затухшим
+    key = trust.penalize(key, 10, now=HALF_LIFE)
+    assert trust.risk(key, now=HALF_LIFE) == approx(30)
+    assert trust.risk(key, now=2 * HALF_LIFE) == approx(15)
+
+def test_top_matches_brute_force():
+    rnd = random.Random(24)
+    trust = TrustScorer(HALF_LIFE, top_k=20)
+    keys = {}
+    now = 0.0
+    for _ in range(5000):
+        now += rnd.uniform(0, 120)
+        user_id = rnd.randint(1, 300)
+        keys[user_id] = trust.penalize(keys.get(user_id), rnd.choice([5, 10, 15, 25]), now)
+        trust.offer(user_id, keys[user_id])
+    
+    expected = sorted(keys, key=keys.get, reverse=True)[:20]
+    ranked = trust.top(now=now)
+    assert [user_id for user_id, _ in ranked] == expected
+    for user_id, risk in ranked:
+        assert risk == approx(trust.risk(keys[user_id], now))
+
+def test_offer_evicts_lowest_through_stale_entries():
+    trust = TrustScorer(HALF_LIFE, top_k=3)
+    for user_id, key in ((1, 1.0), (2, 2.0), (3, 3.0)):
+        trust.offer(user_id, key)
+    
+    # Ключ 1 вырос: в куче остаётся устаревшая запись (1.0, 1)
+    trust.offer(1, 5.0)
+    assert len(trust._heap) == 4
+    
+    # Вытесняется 2 - наименьший актуальный, а не устаревшая запись
+    trust.offer(4, 2.5)
+    assert sorted(trust._top) == [1, 3, 4]
+    
+    # Ключ ниже минимума полного топа не проходит
+    trust.offer(5, 0.5)
+    assert sorted(trust._top) == [1, 3, 4]
+    assert [user_id for user_id, _ in trust.top(now=0)] == [1, 3, 4]
+
+def test_heap_is_rebuilt_when_stale_entries_pile_up():
+    trust = TrustScorer(HALF_LIFE, top_k=2)
+    for step in range(10):
+        trust.offer(1, float(step))
+    assert len(trust._heap) <= 2 * trust.top_k
+    assert trust._top == {1: 9.0}
+
+def test_v9_migration_seeds_risk_key(tmp_path):
+    database = types.SimpleNamespace(conn=app.open_database(os.path.join(tmp_path, "v8.db")))
+    conn = database.conn
+    app.FixedTelegramMonitor.init_database(database)
+    app.FixedTelegramMonitor.migrate_database(database)
+    
+    # База v8: колонки risk_key ещё нет
+    conn.execute("DROP INDEX idx_users_risk")
+    conn.execute("ALTER TABLE users DROP COLUMN risk_key")
+    conn.execute("PRAGMA user_version = 8")
+    conn.executemany(
+        "INSERT INTO users (user_id, username, first_name, last_seen, trust_score) VALUES (?, '', '', '', ?)",
+        [(1, 100), (2, 60), (3, 99), (4, 0)]
+    )
+    conn.commit()
+    
+    started = time.time()
+    app.FixedTelegramMonitor.migrate_database(database)
+    rows = dict(conn.execute("SELECT user_id, risk_key FROM users"))
+    conn.close()
+    
+    # Ключ = log2(100 - trust_score) + t / half_life, t - момент миграции:
+    # сразу после неё балл прежний, дальше штраф затухает
+    trust = TrustScorer(app.TRUST_HALF_LIFE_HOURS * 3600)
+    assert rows[1] is None
+    for user_id, score in ((2, 60), (3, 99), (4, 0)):
+        migrated_at = (rows[user_id] - math.log2(100 - score)) * trust.half_life
+        assert started - 1 <= migrated_at <= time.time() + 1
+        assert trust.score(rows[user_id], now=migrated_at + trust.half_life) == round(100 - (100 - score) / 2)
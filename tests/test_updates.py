@@ -0,0 +1,96 @@
+"""process_updates: правки, посты каналов и запись пачки"""
+import threading
+import time
+
+import pytest
+
+import app
+
+PROTECTED = "Пароль от тестового стенда сменили, новый лежит у дежурного в закрепе."
+
+def message(chat_id: int, message_id: int, user_id: int, text: str, **extra) -> dict:
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "title": f"Chat {chat_id}", "type": "supergroup"},
+        "from": {"id": user_id, "first_name": f"User {user_id}", "username": f"u{user_id}"},
+        "text": text,
+        **extra
+    }
+
+@pytest.fixture
+def alerts(monkeypatch):
+    sent = []
+    monkeypatch.setattr(app.monitor, "_send_alert", sent.append)
+    return sent
+
+def test_unchanged_edit_raises_nothing(alerts):
+    monitor = app.monitor
+    monitor.save_chat(-6001, "Наш чат", "", "supergroup", True)
+    monitor.process_updates([{"update_id": 1, "message": message(-6001, 1, 601, "Встреча в пятницу в десять, не опаздывайте")}])
+    
+    edited = message(-6001, 1, 601, "встреча  в пятницу в десять, НЕ опаздывайте", edit_date=int(time.time()))
+    monitor.process_updates([{"update_id": 2, "edited_message": edited}])
+    assert alerts == []
+
+def test_edit_into_protected_text_is_a_copy(alerts):
+    monitor = app.monitor
+    monitor.save_chat(-6002, "Наш чат", "", "supergroup", True)
+    monitor.process_updates([
+        {"update_id": 3, "message": message(-6002, 1, 602, PROTECTED)},
+        {"update_id": 4, "message": message(-6002, 2, 603, "ок, сейчас посмотрю что там")},
+    ])
+    assert alerts == []
+    
+    edited = message(-6002, 2, 603, PROTECTED, edit_date=int(time.time()))
+    monitor.process_updates([{"update_id": 5, "edited_message": edited}])
+    
+    assert len(alerts) == 1
+    alert = alerts[0]
+    assert alert.type == app.AlertType.COPY_DETECTED
+    assert (alert.user_id, alert.message_id) == (603, 2)
+    assert alert.details["is_edit"] is True
+    assert alert.details["text_before_edit"] == "ок, сейчас посмотрю что там"
+
+def test_channel_post_author_is_not_a_user(alerts):
+    monitor = app.monitor
+    post = {
+        "message_id": 7,
+        "date": int(time.time()),
+        "chat": {"id": -1006003, "title": "Канал", "type": "channel"},
+        "sender_chat": {"id": -1006003, "title": "Канал", "type": "channel", "username": "news"},
+        "text": "я скопировал твой текст из соседнего канала"
+    }
+    monitor.process_updates([{"update_id": 6, "channel_post": post}])
+    monitor.writer.flush()
+    
+    assert [alert.user_id for alert in alerts] == [-1006003]
+    assert monitor.storage.get_user(-1006003) is None
+    with monitor.db_lock:
+        assert monitor.conn.execute("SELECT COUNT(*) FROM users WHERE user_id < 0").fetchone()[0] == 0
+
+def test_sync_batch_is_one_transaction(monkeypatch):
+    monitor = app.monitor
+    batches = []
+    
+    class Recording:
+        def write_batch(self, *rows):
+            batches.append(rows)
+            monitor.storage.write_batch(*rows)
+    
+    writer = app.PersistenceWriter(Recording(), threading.RLock(), mode="sync", flush_interval=60)
+    monkeypatch.setattr(monitor, "writer", writer)
+    try:
+        monitor.process_updates([
+            {"update_id": 7, "message": message(-6004, 1, 604, "я скопировал твой текст")},
+            {"update_id": 8, "message": message(-6005, 1, 605, "обычное сообщение без событий")},
+            {"update_id": 9, "message": message(-6004, 2, 606, "copied that text, thanks a lot")},
+        ])
+    finally:
+        writer.close()
+    
+    assert len(batches) == 1
+    chats, users, usernames, fingerprints, events, user_stats = batches[0]
+    assert {row[0] for row in users} == {604, 605, 606}
+    assert {row[0] for row in chats} == {-6004, -6005}
+    assert len(events) == 2